@@ -0,0 +1,139 @@
+# ----------------------------------------------------------------------
+# arrays
+#
+# Conversion of modeltable.Data to NumPy arrays and Arrow tables for
+# analysis, e.g. with pandas. Cells are numbered as by Indexer, over
+# data.rowdims + data.coldims, so with several input items the input
+# dimension is the last row dimension. Values are floats, empty cells
+# and cells without a numeric value are NaN.
+#
+# Data read from a snapshot is converted from the snapshot's arrays
+# without going through the cells one by one.
+#
+# numpy and pyarrow are only needed when these are used.
+# ----------------------------------------------------------------------
+
+import dimtable
+import modeltable
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("Array export requires numpy")
+    return numpy
+
+def shape(data):
+    return tuple(len(dim) for dim in data.rowdims + data.coldims)
+
+def labels(data):
+    """Representations of the items of each dimension, in shape order"""
+    numpy = _numpy()
+    return [numpy.array([unicode(item.representation()) 
+                         for item in dim.items], dtype=object)
+            for dim in data.rowdims + data.coldims]
+
+def dim_names(data):
+    names = []
+    for i, dim in enumerate(data.rowdims + data.coldims):
+        if dim is data.inputdim:
+            names.append('input')
+        elif dim.items and hasattr(dim.items[0], 'fieldname'):
+            names.append(dim.items[0].fieldname)
+        else:
+            names.append('dim%d' % i)
+    return names
+
+def _value_getter(data, item):
+    # raw value of an input item in a cell, without fetching related objects
+    if isinstance(item, modeltable.AggregateItem):
+        return lambda inst, cix: inst.get(item.name)
+    if isinstance(item, modeltable.ComputedItem):
+        return lambda inst, cix: data.computed.value(cix, item.name)
+    if isinstance(item, modeltable.InputItem):
+        field = modeltable.get_model_field(data.model, item.fieldname)
+        attname = field.attname
+        return lambda inst, cix: getattr(inst, attname)
+    return lambda inst, cix: None
+
+def cells(data):
+    """
+    Returns (cell ints, values) of the filled cells as arrays. Cells of
+    computed items are included only where the cell has an instance.
+    """
+    numpy = _numpy()
+    ncols = dimtable.product(len(dim) for dim in data.coldims)
+    ninputs = len(data.inputdim)
+
+    if (isinstance(data.instdict, modeltable.SnapshotCells) and
+        all(isinstance(item, modeltable.AggregateItem) 
+            for item in data.inputdim.items)):
+        ints, columns = data.instdict.snapshot.arrays()
+        # value range cell int -> cell int with the input index
+        base = (ints // ncols) * (ninputs * ncols) + ints % ncols
+        missing = numpy.full(len(ints), numpy.nan)
+        return (numpy.concatenate([base + ix * ncols
+                                   for ix in range(ninputs)]),
+                numpy.concatenate([columns.get(item.name, missing)
+                                   for item in data.inputdim.items]))
+
+    indexer = dimtable.Indexer(data.valuerange_coldims(),
+                               data.valuerange_rowdims())
+    getters = [_value_getter(data, item) for item in data.inputdim.items]
+    ints   = []
+    values = []
+    for cix, inst in data.instdict.iteritems():
+        v = indexer.cellindex_to_int(cix)
+        base = (v // ncols) * (ninputs * ncols) + v % ncols
+        for ix, getter in enumerate(getters):
+            ints.append(base + ix * ncols)
+            values.append(getter(inst, cix))
+
+    ints = numpy.array(ints, dtype=numpy.int64)
+    try:
+        values = numpy.array(values, dtype=float)
+    except (TypeError, ValueError):
+        values = numpy.array([_to_float(v) for v in values], dtype=float)
+    return ints, values
+
+def _to_float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return float('nan')
+
+def to_numpy(data, sparse=False):
+    """
+    Returns (values, labels). values is an array of shape(data) with NaN
+    in empty cells, or with sparse=True a pair (cell ints, values) of
+    the filled cells. labels has an array of item labels per dimension.
+    """
+    numpy = _numpy()
+    ints, values = cells(data)
+    if sparse:
+        return (ints, values), labels(data)
+
+    dense = numpy.full(dimtable.product(shape(data)), numpy.nan)
+    dense[ints] = values
+    return dense.reshape(shape(data)), labels(data)
+
+def to_arrow(data):
+    """
+    Returns a pyarrow.Table with a row per filled cell: a dictionary
+    encoded column of item labels per dimension and a 'value' column.
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Arrow export requires pyarrow")
+    numpy = _numpy()
+
+    ints, values = cells(data)
+    indexes = numpy.unravel_index(ints, shape(data))
+    columns = [pyarrow.DictionaryArray.from_arrays(
+                   pyarrow.array(ixes.astype(numpy.int32)),
+                   pyarrow.array(list(dimlabels)))
+               for ixes, dimlabels in zip(indexes, labels(data))]
+    columns.append(pyarrow.array(values))
+    return pyarrow.Table.from_arrays(columns, 
+                                     names = dim_names(data) + ['value'])
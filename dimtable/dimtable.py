@@ -1,24 +1,47 @@
 import operator
-from string import maketrans 
-from django.utils.safestring import mark_safe
+
+# The table core doesn't depend on Django, only the Django integration in
+# modeltable and django_dimtable does. Without Django, rendered HTML is
+# returned as a plain unicode string.
+try:
+    from django.utils.safestring import mark_safe
+except ImportError:
+    def mark_safe(s): return s
 
 import html
-from html import *
+from html import lonetag, tagify, th, td, tr, text_input, hidden_input
+
+# Header cells are rendered once per header, so they use a precompiled tag
+HEADER_TH = html.Template('th', ('rowspan', 'class'))
+
+def lean_th(representation, spanattr, span, cssclasses):
+    # header of lean tables, without spans of 1 and empty classes
+    attrs = {}
+    if span > 1:    attrs[spanattr] = span
+    if cssclasses:  attrs['class'] = u' '.join(cssclasses)
+    return tagify('th', html.escape(representation), **attrs)
 
 # ----------------------------------------------------------------------
 # DimItem
 # ----------------------------------------------------------------------
 
-class DimItem:
+# Items are slotted, as large dimensions (e.g. dates) have many of them.
+# Subclasses should declare __slots__ too.
+class DimItem(object):
+    __slots__ = ()
+
     def value(self): return None
     def representation(self): return u'n/a'
     def editable(self): return False
     def css_classes(self): return []
     
 class EmptyItem(DimItem):
+    __slots__ = ()
     def representation(self): return u''
 
 class LabelItem(DimItem):
+    __slots__ = ('_value', 'renderer')
+
     def __init__(self, value, renderer = unicode):
         self._value = value
         self.renderer = renderer
@@ -56,6 +79,8 @@ def make_cellindex(rixes, cixes):
     return CellIndex(tuple((rixes, cixes)))
 
 class CellIndex(tuple):
+    __slots__ = ()
+
     def row_indexes(self): return self[0]
     def col_indexes(self): return self[1]
 
@@ -112,25 +137,38 @@ class DimIter:
         return "DimIter(%s, %s)" % (str(self.ixes), self.finished)
 
 
+def item_classes(dims, ixes):
+    classes = set()
+    for dim, ix in zip(dims, ixes):
+        classes.update(dim.items[ix].css_classes())
+    return sorted(classes)
+
 def product(xs):
     return reduce(operator.mul, xs, 1)
 
 
+def strides(dims):
+    # strides[i] is the number of combinations of the dimensions after i,
+    # i.e. the span of an item of dims[i]
+    lens = [len(dim) for dim in dims]
+    return [product(lens[i+1:]) for i in range(len(lens))]
+
+
 class Indexer:
     def __init__(self, coldims, rowdims):
         self.coldims = coldims
         self.rowdims = rowdims 
 
+        # dimension lengths don't change, so the strides are computed once
+        ncols = product(len(cdim) for cdim in coldims)
+        self._col_strides = strides(coldims)
+        self._row_strides = [s * ncols for s in strides(rowdims)]
+
     def cellindex_to_int(self, cix):
         return (
-            sum(r 
-                 * product(len(rdim) for rdim in self.rowdims[i+1:])
-                 * product(len(cdim) for cdim in self.coldims)
-                 for i,r in enumerate(cix.row_indexes()))
-            + 
-            sum(c
-                * product(len(cdim) for cdim in self.coldims[j+1:])
-                for j,c in enumerate(cix.col_indexes())))
+            sum([r * s for r, s in zip(cix.row_indexes(), self._row_strides)])
+            +
+            sum([c * s for c, s in zip(cix.col_indexes(), self._col_strides)]))
 
     def int_to_cellindex(self, integer):
         v = integer
@@ -172,31 +210,53 @@ class Table:
         self.prefix       = kwargs.get('prefix', 'table')
         self.indexer = Indexer(self.coldims, self.rowdims)
 
+        # Lean tables leave out cell ids and empty attributes: rows have 
+        # their row number in data-row and styles of items are given to 
+        # rows and to the cols of a colgroup. See dimtable.LeanTable.
+        self.lean = kwargs.get('lean', False)
+
+        # spans and repeat counts of headers are needed for every header
+        # cell, so they are computed once for all dimensions
+        self._colspans   = strides(self.coldims)
+        self._rowspans   = strides(self.rowdims)
+        self._colrepeats = [product(len(dim) for dim in self.coldims[:i])
+                            for i in range(len(self.coldims))]
+        self.probe   = kwargs.get('probe', None)
+        if self.probe is None:
+            import instrument
+            self.probe = instrument.probe(self.prefix)
+
     # cell-method should be implemented by subclasses
     def cell(self, cellix):
-        cellid = "table_cell_" + str(self.indexer.cellindex_to_int(cellix))
+        cellid = self.prefix + "_cell_" + str(self.indexer.cellindex_to_int(cellix))
         celldata = unicode(self._data.get(cellix)) if self._data else u'n/a'
-        return u''.join(['<td id="', cellid, '">', celldata, '</td>'])
+        if self.lean:
+            return u''.join(['<td>', html.escape(celldata), '</td>'])
+        return u''.join(['<td id="', cellid, '">', html.escape(celldata), '</td>'])
+
+    # cell_value gives the plain (non-HTML) value of a cell for exports,
+    # subclasses should override it together with cell
+    def cell_value(self, cellix):
+        return unicode(self._data.get(cellix)) if self._data else u''
 
     def colspan(self, ix):
         assert ix < len(self.coldims)
-        if ix + 1 > len(self.coldims) - 1:
-            return 1
-        else:
-            return len(self.coldims[ix + 1].values()) * self.colspan(ix + 1)
+        return self._colspans[ix]
 
     def rowspan(self, ix):
         assert ix < len(self.rowdims)
-        if ix + 1 > len(self.rowdims) - 1:
-            return 1
-        else:
-            return len(self.rowdims[ix + 1].values()) * self.rowspan(ix + 1)
+        return self._rowspans[ix]
+
+    def colrepeat(self, ix):
+        # how many times headers of coldims[ix] are repeated
+        assert ix < len(self.coldims)
+        return self._colrepeats[ix]
 
 
     def render_corner(self):
         return u'<th rowspan="%d" colspan="%d">%s</th>' % (len(self.coldims),
                                                            len(self.rowdims),
-                                                           self.corner_title)
+                                                           html.escape(self.corner_title))
 
     def render_coldim_header(self,ix):
         dim = self.coldims[ix]
@@ -205,15 +265,14 @@ class Table:
         for item in dim.items:
             cssclasses     = item.css_classes()
             representation = item.representation()
-            current = th(representation, 
-                         **{'rowspan': cspan,
-                            'class':  u' '.join(cssclasses)})
-            ths.append(current)
+            if self.lean:
+                ths.append(lean_th(representation, 'colspan', cspan, 
+                                   cssclasses))
+            else:
+                ths.append(HEADER_TH.text(representation, cspan, 
+                                          u' '.join(cssclasses)))
         sub = u''.join(ths)
-
-        x = 1
-        for i in range(ix): x *= len(self.coldims[i].values())
-        return sub * x
+        return sub * self.colrepeat(ix)
 
     def row_headers(self,dix, rixes):
         if dix == len(self.rowdims):
@@ -225,9 +284,12 @@ class Table:
         item = dim.items[vix]
         cssclasses     = item.css_classes()
         representation = item.representation()
-        current = th(representation, 
-                     **{'rowspan': self.rowspan(dix),
-                        'class':  u' '.join(cssclasses)})
+        if self.lean:
+            current = lean_th(representation, 'rowspan', self.rowspan(dix),
+                              cssclasses)
+        else:
+            current = HEADER_TH.text(representation, self.rowspan(dix),
+                                     u' '.join(cssclasses))
         return [current] + self.row_headers(dix + 1, rixes)
         
     def row_cells(self, rixes):
@@ -239,33 +301,81 @@ class Table:
             
         return tds
 
+    def row_parts(self, dix, rixes):
+        with self.probe.phase('row_headers'):
+            ths = self.row_headers(dix, rixes)
+        with self.probe.phase('cells'):
+            tds = self.row_cells(rixes)
+        self.probe.count('cells', len(tds))
+        return ths, tds
+
+    def render_row(self, parts, rixes, attrs={}):
+        if self.lean:
+            attrs = self.row_attributes(rixes, attrs)
+        return tr(parts, **attrs)
+
+    def row_attributes(self, rixes, attrs):
+        attrs = dict(attrs)
+        attrs['data-row'] = sum([r * s for r, s in zip(rixes, self._rowspans)])
+        classes = self.row_classes(rixes)
+        if classes:
+            attrs['class'] = u' '.join(filter(None, [attrs.get('class')] 
+                                                   + classes))
+        return attrs
+
+    # classes of rows and columns of lean tables
+    def row_classes(self, rixes):
+        return item_classes(self.rowdims, rixes)
+
+    def col_classes(self, cixes):
+        return item_classes(self.coldims, cixes)
+
+    def colgroup(self):
+        # one col for the row headers, then runs of columns of equal classes
+        cols = [u'<colgroup>', u'<col span="%d">' % len(self.rowdims)]
+        runs = []
+        citer = DimIter(self.coldims)
+        while not citer.end():
+            classes = u' '.join(self.col_classes(citer.get()))
+            if runs and runs[-1][0] == classes: runs[-1][1] += 1
+            else:                               runs.append([classes, 1])
+            citer.next()
+        for classes, span in runs:
+            attrs = {}
+            if span > 1: attrs['span']  = span
+            if classes:  attrs['class'] = classes
+            cols.append(lonetag('col', **attrs))
+        cols.append(u'</colgroup>')
+        return u''.join(cols)
+
     def rows(self):
         riter = DimIter(self.rowdims)
-        ths = self.row_headers(0, riter.get()) 
-        tds = self.row_cells(riter.get())
+        ths, tds = self.row_parts(0, riter.get())
 
-        rs = [tr(ths + tds)]
+        rs = [self.render_row(ths + tds, riter.get())]
 
 
         use_groups = len(self.rowdims) > 1
+        group_size = self._rowspans[0]
 
+        n = 0
         while True:
             dix = riter.next()
             if riter.end(): break
+            n += 1
 
-            ths = self.row_headers(dix, riter.get())
-            tds = self.row_cells(riter.get())
+            ths, tds = self.row_parts(dix, riter.get())
 
             if (use_groups):
-                if riter.first_of_group():
+                if n % group_size == 0:
                     attrs = {'class':'first-of-group'}
-                elif riter.last_of_group():
+                elif n % group_size == group_size - 1:
                     attrs = {'class': 'last-of-group'}
                 else:
                     attrs = {}
-                rs.append(tr(ths + tds, **attrs))
+                rs.append(self.render_row(ths + tds, riter.get(), attrs))
             else:
-                rs.append(tr(ths + tds))
+                rs.append(self.render_row(ths + tds, riter.get()))
         return rs
 
     def thead(self): 
@@ -291,35 +401,104 @@ class Table:
         return u"\n".join(output)
 
     def hidden_data_dimensions(self, prefix):
-        output = ["<!-- BEGIN hidden_data_dimensions -->"]
+        output = html.Builder()
+        output.raw(u"<!-- BEGIN hidden_data_dimensions -->")
         def dimension_data(dims, tag):
             # dimension count
             name  = u"_".join([prefix, tag, 'dimN'])
             value = str(len(dims))
-            output.append(html.hidden_input(name=name, value=value))
+            output.tag(html.HIDDEN_INPUT, name, value)
             
             # dimension lengths
             for i, dim in enumerate(dims):
                 name  = u"_".join([prefix, tag, 'length', str(i)])
-                value = str(len(dim.values()))
-                output.append(html.hidden_input(name=name, value=value))
+                value = str(len(dim))
+                output.tag(html.HIDDEN_INPUT, name, value)
 
         dimension_data(self.rowdims, 'rdim')
         dimension_data(self.coldims, 'cdim')
 
-        output.append("<!-- END hidden_data_dimensions -->")
-        return u'\n'.join(output)
+        output.raw(u"<!-- END hidden_data_dimensions -->")
+        return output.getvalue(u'\n')
 
 
     def render(self):
-        output = []
-        output.append(self.hidden_data_dimensions(self.prefix))
-        output.append(u'<table class="%s">' % (self.css_class))
-        output.append(self.thead())
-        output.append(self.tbody())
-        output.append(self.tfoot())
-        output.append(u'</table>')
-        return mark_safe(u"\n".join(output))
+        with self.probe.report():
+            output = []
+            with self.probe.phase('hidden'):
+                output.append(self.hidden_data_dimensions(self.prefix))
+            if self.lean:
+                output.append(u'<table class="%s lean" data-prefix="%s">' 
+                              % (self.css_class, html.escape(self.prefix)))
+                output.append(self.colgroup())
+            else:
+                output.append(u'<table class="%s">' % (self.css_class))
+            with self.probe.phase('headers'):
+                output.append(self.thead())
+            output.append(self.tbody())
+            output.append(self.tfoot())
+            output.append(u'</table>')
+            result = u"\n".join(output)
+            if self.probe.enabled:
+                self.probe.count('bytes', len(result.encode('utf-8')))
+            return mark_safe(result)
+
+    # ----------------------------------------------------------------------
+    # Export
+    # ----------------------------------------------------------------------
+
+    def export_header_rows(self, merged=False):
+        corner = [u''] * len(self.rowdims)
+        if corner: corner[0] = self.corner_title
+
+        for ix, dim in enumerate(self.coldims):
+            cspan = self.colspan(ix)
+            sub = []
+            for representation in dim.representations():
+                sub.append(representation)
+                filler = u'' if merged else representation
+                sub.extend([filler] * (cspan - 1))
+            yield corner + sub * self.colrepeat(ix)
+            corner = [u''] * len(self.rowdims)
+
+    def export_rows(self, merged=False):
+        """
+        Yields the table as lists of plain values, first the column header
+        rows and then one list per table row. Header labels are either
+        repeated on every row/column (default) or, when merged is set,
+        only given at the start of their group like in the HTML table.
+        """
+        for row in self.export_header_rows(merged):
+            yield row
+
+        representations = [dim.representations() for dim in self.rowdims]
+
+        riter = DimIter(self.rowdims)
+        dix = 0
+        while not riter.end():
+            rixes = riter.get()
+            row = [reprs[rix] for reprs, rix in zip(representations, rixes)]
+            if merged:
+                for i in range(dix): row[i] = u''
+
+            citer = DimIter(self.coldims)
+            while not citer.end():
+                row.append(self.cell_value(make_cellindex(rixes, citer.get())))
+                citer.next()
+            yield row
+            dix = riter.next()
+
+    def export(self, format='csv', stream=True, merged=False):
+        """
+        Exports the table as 'csv' or 'xlsx'. With stream=True, an iterator
+        of byte chunks is returned (suitable for a streaming HTTP response),
+        otherwise the whole file as a string.
+        """
+        import export
+        chunks = export.chunks(self.export_rows(merged), format)
+        if stream:
+            return chunks
+        return ''.join(chunks)
 
     def render_js(self):
         # TODO(teemu): This uses a hardcoded input field spec, 
@@ -330,6 +509,6 @@ $(document).ready(function() {
    var create_input = function(val, name) {
        return $('<input type="text"/>').val(val).attr({size: 5, maxlength: 6, name: name});
    };
-   dimtable.EditableTable({"create_input": create_input}); 
+   dimtable.%s({"prefix": "%s", "create_input": create_input}); 
 });
-""")
+""" % ('LeanTable' if self.lean else 'EditableTable', self.prefix))
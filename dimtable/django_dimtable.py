@@ -4,9 +4,74 @@
 # Actual implementation is using the old API and old implementation from modeltable, 
 # which is to be replaced later.
 
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import django.db.models.fields.related
+from django.core import exceptions
+from django.utils.safestring import mark_safe
+
+import html
+import dimtable
 import modeltable
 from modeltable import Dim
 
+# ----------------------------------------------------------------------
+# Dimensions built by Model.dim_from_field are cached per process, keyed
+# by the model and SQL of the queryset, the field and the arguments, so
+# that views building a new Model on every request share them. Entries
+# are dropped when an instance of the queryset's model, or of the model 
+# a foreign key refers to, is saved or deleted (post_save and 
+# post_delete signals). As with labelcache, this only happens in the 
+# process that saved it, and changes that bypass signals aren't seen:
+# pass cache=False where the values must be fresh.
+# ----------------------------------------------------------------------
+
+class FieldDimCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._by_model = {} # model -> set of keys
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key)
+            self._entries[key] = value # most recently used last
+            return value
+
+    def set(self, key, value, models):
+        with self._lock:
+            self._entries[key] = value
+            for model in models:
+                self._by_model.setdefault(model, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, model):
+        with self._lock:
+            for key in self._by_model.pop(model, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_model.clear()
+
+field_dims = FieldDimCache(maxsize=1000)
+
+def _field_dims_changed(sender, **kwargs):
+    field_dims.invalidate(sender)
+
+def _connect_field_dims():
+    from django.db.models import signals
+    signals.post_save.connect(_field_dims_changed, weak=False,
+                              dispatch_uid='dimtable.field_dims.save')
+    signals.post_delete.connect(_field_dims_changed, weak=False,
+                                dispatch_uid='dimtable.field_dims.delete')
+
 class Model: 
     def __init__(self, queryset):
         self.queryset = queryset
@@ -15,9 +80,79 @@ class Model:
         return modeltable.valueitems(self.queryset.model, fieldname, 
                                      values, **kwargs)
 
+    def dim_from_field(self, fieldname, order_by=None, limit=None, 
+                       renderer=unicode, cache=True):
+        """
+        Builds a dimension of the distinct values of a field in the queryset.
+        For foreign keys, the related objects are fetched with one query 
+        that selects the distinct ids with a subquery, ordered by order_by
+        (fields of the related model, default is its Meta.ordering) and 
+        limited in the database. For other fields order_by may only 
+        contain the field itself, as with any DISTINCT query.
+
+        Dimensions are cached per process, see FieldDimCache above. The
+        renderer is part of the key, so it should be a module-level 
+        function.
+        """
+        if isinstance(order_by, basestring): order_by = [order_by]
+        key = (queryset_key(self.queryset), fieldname, 
+               tuple(order_by or ()), limit, renderer)
+        if cache:
+            try:
+                return field_dims.get(key)
+            except (KeyError, TypeError):
+                pass # TypeError: unhashable renderer or query
+
+        model = self.djangomodel()
+        field = modeltable.get_model_field(model, fieldname)
+        values = self.queryset.values_list(fieldname, flat=True).distinct()
+        models = [model]
+
+        if isinstance(field, django.db.models.fields.related.ForeignKey):
+            related = field.rel.to
+            ordering = order_by or related._meta.ordering or ['pk']
+            objs = related._default_manager.filter(**{
+                    field.rel.field_name + '__in': values.order_by()})
+            values = list(objs.order_by(*ordering)[:limit])
+            models.append(related)
+        else:
+            values = list(values.order_by(*(order_by or [fieldname]))[:limit])
+
+        dim = Dim(self.valueitems(fieldname, values, renderer=renderer))
+        if cache:
+            _connect_field_dims()
+            try:
+                field_dims.set(key, dim, models)
+            except TypeError:
+                pass
+        return dim
+
+    def date_dim(self, fieldname, start, end, granularity='day', 
+                 renderer=None):
+        """
+        Builds a dimension of the periods of a date field from start to 
+        end (inclusive) at granularity 'year', 'month', 'week' or 'day':
+
+            months = model.date_dim('date', start, end, 'month')
+            start, end, level = months.items[i].zoom()
+            days = model.date_dim('date', start, end, level)
+
+        Coarse levels should be shown with PivotTable, which aggregates 
+        the periods with one query grouped by the period of the date. Day
+        columns are plain date values and can be edited with Table.
+        """
+        return Dim(modeltable.perioditems(self.djangomodel(), fieldname,
+                                          start, end, granularity, renderer))
+
     def cellitem(self, fieldname, **kwargs):
         return modeltable.InputItem(self.queryset.model, fieldname, **kwargs)
 
+    def computeditem(self, name, expression, **kwargs):
+        return modeltable.ComputedItem(name, expression, **kwargs)
+
+    def aggregateitem(self, name, aggregate, **kwargs):
+        return modeltable.AggregateItem(name, aggregate, **kwargs)
+
     def djangomodel(self):
         return self.queryset.model
 
@@ -29,3 +164,332 @@ class Table(modeltable.Table):
                                rowdims, coldims, **kwargs)
         modeltable.Table.__init__(self, data, **kwargs)
 
+
+# Read-only table of aggregates, cells are given by Model.aggregateitem
+class PivotTable(modeltable.Table):
+    def __init__(self, model, celldim, rowdims, coldims, **kwargs):
+        data = modeltable.AggregateData(model.djangomodel(), 
+                                        modeltable.InputDim(celldim.items),
+                                        model.queryset,
+                                        rowdims, coldims, **kwargs)
+        modeltable.Table.__init__(self, data, **kwargs)
+
+def queryset_key(queryset):
+    # Tables whose querysets produce the same SQL can share a query
+    try:
+        return (queryset.model, str(queryset.query))
+    except Exception:
+        # e.g. EmptyResultSet of none(), such querysets aren't merged
+        return id(queryset)
+
+class TableGroup(object):
+    """
+    Loads several tables of a page with as few queries as possible:
+
+        group = TableGroup()
+        group.add(model, celldim, rowdims, coldims, prefix='a', 
+                  fixed_fields=[('product', p1)])
+        group.add(model, celldim, rowdims, coldims, prefix='b', 
+                  fixed_fields=[('product', p2)])
+        table_a, table_b = group.tables()
+
+    Tables whose querysets produce the same SQL are loaded with one query,
+    restricted to the union of their dimension values and fixed field 
+    values. Each instance is then added to the tables whose dimensions and
+    fixed fields it matches, so a table's queryset shouldn't select 
+    instances that differ from its fixed_fields. Querysets that differ in
+    any way, e.g. Sale.objects.filter(product=p1) and .filter(product=p2),
+    run a query each, as an instance can't generally be matched back to 
+    the queryset that would have selected it; give such tables the same
+    queryset and tell them apart with fixed_fields. Dimension indexes are
+    shared by all tables, so dimensions used in several tables are indexed
+    once.
+    """
+    def __init__(self):
+        self._specs  = []
+        self._tables = None
+
+    def add(self, model, celldim, rowdims, coldims, **kwargs):
+        assert self._tables is None, "TableGroup is already loaded"
+        self._specs.append((model, celldim, rowdims, coldims, kwargs))
+
+    def tables(self):
+        if self._tables is None:
+            self._tables = self._load()
+        return self._tables
+
+    def _load(self):
+        dim_indexes = {}
+        datas = []
+        batches = {}
+        for model, celldim, rowdims, coldims, kwargs in self._specs:
+            kwargs = dict(kwargs, dim_indexes = dim_indexes)
+            data = modeltable.Data(model.djangomodel(), 
+                                   modeltable.InputDim(celldim.items),
+                                   [], rowdims, coldims, **kwargs)
+            datas.append((data, kwargs))
+            key = queryset_key(model.queryset)
+            batch = batches.setdefault(key, (model.queryset, []))
+            batch[1].append(data)
+
+        for queryset, batch in batches.itervalues():
+            if len(batch) > 1:
+                queryset = self._merged_queryset(queryset, batch)
+            for inst in queryset:
+                for data in batch:
+                    if data.matches_fixed_fields(inst):
+                        data.add_instance(inst)
+
+        return [modeltable.Table(data, **kwargs) for data, kwargs in datas]
+
+    def _merged_queryset(self, queryset, batch):
+        # only fields restricted in every table can restrict the query
+        restrictions = batch[0].restrictions()
+        for data in batch[1:]:
+            other = data.restrictions()
+            restrictions = dict((fieldname, keys | other[fieldname])
+                                for fieldname, keys in restrictions.iteritems()
+                                if fieldname in other)
+
+        for fieldname, keys in restrictions.iteritems():
+            queryset = queryset.filter(**{fieldname + '__in': list(keys)})
+        return queryset
+
+
+class DrilldownTable(object):
+    """
+    Table whose outermost row dimension is shown as collapsed groups:
+
+        table = DrilldownTable(model, celldim, 
+                               rowdims = [employees, products], 
+                               coldims = [dates],
+                               aggregate = Sum('amount'))
+
+    The initial page has one row per outer item with aggregate over the
+    group in each column, computed by one GROUP BY query. Rows of a group
+    are fetched on demand by dimtable.Drilldown from a view that returns
+    group_response(request), which loads only the instances of that 
+    group. Cell numbers are those of the full table, so saving works as
+    with Table.
+    """
+    def __init__(self, model, celldim, rowdims, coldims, aggregate, **kwargs):
+        assert len(rowdims) > 1, "Drill-down needs nested row dimensions"
+        self.model     = model
+        self.celldim   = celldim
+        self.rowdims   = rowdims
+        self.coldims   = coldims
+        self.aggregate = aggregate
+        self.kwargs    = kwargs
+        self.prefix    = kwargs.get('prefix', 'table')
+        self.outer     = rowdims[0]
+
+        # full table without instances for headers, metadata and saving
+        self.table = self.table_for(model.queryset.none())
+
+    def table_for(self, queryset):
+        return Table(Model(queryset), self.celldim, self.rowdims, self.coldims,
+                     **self.kwargs)
+
+    def group_table(self, index):
+        fieldname = self.outer.items[index].fieldname
+        value     = self.outer.items[index].value()
+        return self.table_for(self.model.queryset.filter(**{fieldname: value}))
+
+    def render_groups(self):
+        celldim = Dim([modeltable.AggregateItem('total', self.aggregate)])
+        pivot = PivotTable(self.model, celldim, [self.outer], self.coldims,
+                           prefix = self.prefix + '_groups')
+
+        colspan = len(self.table.rowdims)
+        rs = []
+        for i, item in enumerate(self.outer.items):
+            tds = []
+            citer = dimtable.DimIter(self.coldims)
+            while not citer.end():
+                cellix = dimtable.make_cellindex((i,), citer.get())
+                tds.append(html.td(html.escape(
+                            pivot.cell_value(cellix))))
+                citer.next()
+            th = html.th(html.escape(item.representation()),
+                                    colspan = colspan)
+            rs.append(html.tr([th] + tds, 
+                                         **{'class': 'group collapsed',
+                                            'data-group': i,
+                                            'data-prefix': self.prefix}))
+        return rs
+
+    def render(self):
+        output = []
+        output.append(self.table.hidden_data_dimensions(self.prefix))
+        output.append(u'<table class="%s">' % (self.table.css_class))
+        output.append(self.table.thead())
+        output.append(u'<tbody>')
+        output.append(u'\n'.join(self.render_groups()))
+        output.append(u'</tbody>')
+        output.append(u'</table>')
+        return mark_safe(u"\n".join(output))
+
+    def as_form(self):
+        output = []
+        output.append(self.table.render_hidden())
+        output.append(self.table.render_errors())
+        output.append(self.render())
+        return mark_safe(u"\n".join(output))
+
+    def group_data(self, index):
+        table = self.group_table(index)
+        return {'rows': u'\n'.join(table.group_rows(index)),
+                'instanceids': json.dumps(table.presenter.cell_instance_ids())}
+
+    def group_response(self, request):
+        from django.http import HttpResponse, HttpResponseBadRequest
+        try:
+            index = int(request.GET['group'])
+            assert 0 <= index < len(self.outer)
+        except (KeyError, ValueError, AssertionError):
+            return HttpResponseBadRequest()
+        return HttpResponse(json.dumps(self.group_data(index)),
+                            content_type = 'application/json')
+
+    def save(self, args):
+        """
+        Saves with a table of the stored instances of the groups that have
+        posted cells, so that updates, constraints and the old values of 
+        upserts and the journal see them. Constraints that span groups
+        need the whole queryset. Errors are shown by as_form.
+        """
+        self.table = self.table_for(self.save_queryset(args))
+        return self.table.save(args)
+
+    def save_queryset(self, args):
+        constraints = self.kwargs.get('constraints', ())
+        if any(c.rows is not None and 0 not in c.rows for c in constraints):
+            return self.model.queryset
+
+        prefix = self.prefix + '_cell_'
+        indexer = self.table.presenter.indexer
+        groups = set()
+        for key in args:
+            if key.startswith(prefix):
+                try:
+                    cellix = indexer.int_to_cellindex(int(key[len(prefix):]))
+                except ValueError:
+                    continue
+                groups.add(cellix.row_indexes()[0])
+        if not groups:
+            return self.model.queryset.none()
+
+        fieldname = self.outer.items[0].fieldname
+        values = [self.outer.items[i].value() for i in sorted(groups)]
+        return self.model.queryset.filter(**{fieldname + '__in': values})
+
+    def render_js(self, url):
+        return mark_safe(u"""
+$(document).ready(function() {
+   var table = dimtable.EditableTable({"prefix": "%s"}); 
+   dimtable.Drilldown({"prefix": "%s", "url": "%s", "table": table}); 
+});
+""" % (self.prefix, self.prefix, url))
+
+
+def table_etag(model, celldim, rowdims, coldims, **kwargs):
+    """
+    Fingerprint of a table, computed without loading it. It covers the 
+    dimensions, cell items, fixed_fields and other options, and a stamp
+    of the queryset restricted to the table's dimensions. The stamp is 
+    given by stamp(queryset), by default modeltable.cell_stamp of the 
+    cell fields in one small query. Give a stamp of your own, e.g. with
+    Max('updated_at'), if anything else the labels depend on changes.
+
+    Renderers are told apart by module and name. Lambdas can't be, so
+    tables rendered with them need key, a string that changes whenever
+    their rendering does.
+    """
+    key = kwargs.pop('key', None)
+    stamp = kwargs.pop('stamp', None)
+    if stamp is None:
+        stamp = modeltable.cell_stamp(
+            model.djangomodel(), 
+            [item.fieldname for item in celldim.items
+             if isinstance(item, modeltable.InputItem)],
+            kwargs.get('journal', None))
+    data = modeltable.Data(model.djangomodel(), 
+                           modeltable.InputDim(celldim.items),
+                           [], rowdims, coldims, **kwargs)
+    queryset = model.queryset
+    for fieldname, keys in sorted(data.restrictions().iteritems()):
+        queryset = queryset.filter(**{fieldname + '__in': list(keys)})
+
+    def item_key(item):
+        return [type(item).__name__,
+                getattr(item, 'fieldname', getattr(item, 'name', None)),
+                repr(modeltable.value_key(item.value())),
+                renderer_key(getattr(item, 'renderer', None), key)]
+
+    try:
+        sql = unicode(queryset.query)
+    except Exception:
+        sql = None # e.g. EmptyResultSet of none()
+    fingerprint = json.dumps([
+            [item_key(item) for item in celldim.items],
+            [[item_key(item) for item in dim.items] for dim in rowdims],
+            [[item_key(item) for item in dim.items] for dim in coldims],
+            [(name, repr(modeltable.value_key(value)))
+             for name, value in kwargs.get('fixed_fields', [])],
+            sorted((name, repr(value)) for name, value in kwargs.iteritems()
+                   if isinstance(value, (bool, int, long, basestring))),
+            sql,
+            stamp(queryset) if sql is not None else None,
+            key], default=repr)
+    return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+
+def renderer_key(renderer, key):
+    if renderer is None: return None
+    name = getattr(renderer, '__name__', None)
+    if name in (None, '<lambda>') and key is None:
+        raise exceptions.ImproperlyConfigured(
+            "table_etag can't tell lambda renderers apart, give a key")
+    return '%s.%s' % (getattr(renderer, '__module__', None), name)
+
+def etag_matches(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH', '')
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'): tag = tag[2:]
+        if tag == '*' or tag.strip('"') == etag:
+            return True
+    return False
+
+def etag_response(request, etag, make_response):
+    """
+    Returns 304 Not Modified if the client has the etag, otherwise 
+    make_response() with the ETag header set:
+
+        etag = table_etag(model, celldim, rowdims, coldims)
+        return etag_response(request, etag, 
+                             lambda: render_to_response(...))
+    """
+    from django.http import HttpResponseNotModified
+    if request.method in ('GET', 'HEAD') and etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = make_response()
+    response['ETag'] = '"%s"' % etag
+    return response
+
+def changes_response(request, table_key, limit=1000):
+    """
+    JSON of the journaled changes of a table after the sequence number
+    in GET parameter 'since', for clients that catch up incrementally:
+    {"seq": <last seq>, "changes": [[seq, cell, old, new], ...]}
+    """
+    import journal
+    from django.http import HttpResponse, HttpResponseBadRequest
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        return HttpResponseBadRequest()
+    changes = journal.changes_since(table_key, since, limit)
+    seq = changes[-1][0] if changes else since
+    return HttpResponse(json.dumps({'seq': seq, 'changes': changes}),
+                        content_type = 'application/json')
@@ -0,0 +1,69 @@
+# ----------------------------------------------------------------------
+# export
+#
+# Writers that turn rows produced by dimtable.Table.export_rows into
+# CSV or XLSX. Writers consume rows one at a time and yield byte
+# chunks, so a table is never rendered fully in memory.
+# ----------------------------------------------------------------------
+
+import csv
+import tempfile
+
+CONTENT_TYPES = {
+    'csv':  'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# csv.writer wants a file, but for streaming we only need what it would
+# write. writerow returns the return value of write, i.e. the line.
+class _Echo(object):
+    def write(self, line):
+        return line
+
+def _encode(value, encoding):
+    if isinstance(value, unicode):
+        return value.encode(encoding)
+    return value
+
+def csv_chunks(rows, encoding='utf-8', **fmtparams):
+    writer = csv.writer(_Echo(), **fmtparams)
+    for row in rows:
+        yield writer.writerow([_encode(v, encoding) for v in row])
+
+def xlsx_chunks(rows, chunk_size=64 * 1024):
+    # openpyxl is only needed for xlsx, so it's an optional dependency
+    try:
+        import openpyxl
+    except ImportError:
+        raise ImportError("xlsx export requires openpyxl")
+
+    # write-only workbooks keep constant memory regardless of row count
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for row in rows:
+        sheet.append(row)
+
+    # xlsx is a zip file that can't be written incrementally to a socket,
+    # so spool it through a temporary file and stream that out
+    tmp = tempfile.TemporaryFile()
+    try:
+        workbook.save(tmp)
+        tmp.seek(0)
+        while True:
+            chunk = tmp.read(chunk_size)
+            if not chunk: break
+            yield chunk
+    finally:
+        tmp.close()
+
+WRITERS = {
+    'csv':  csv_chunks,
+    'xlsx': xlsx_chunks,
+}
+
+def chunks(rows, format):
+    try:
+        writer = WRITERS[format]
+    except KeyError:
+        raise ValueError("Unknown export format: %s" % format)
+    return writer(rows)
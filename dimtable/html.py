@@ -1,10 +1,105 @@
+# ----------------------------------------------------------------------
+# html
+#
+# Small helpers for generating HTML. Attribute values are always
+# escaped, element content only through the text variants, as content
+# of tr etc. is markup.
+#
+# For tags that are rendered many times, such as th of row headers, use
+# Template: it builds the constant parts of the tag once, so rendering
+# is just escaping the values and joining the parts.
+# ----------------------------------------------------------------------
+
+# str.replace is implemented in C and a chain of them is faster than
+# regular expressions or translate tables for the short strings here
+def escape(s):
+    if hasattr(s, '__html__'):
+        # already safe markup, e.g. Django's mark_safe
+        return s.__html__()
+    if not isinstance(s, basestring):
+        s = unicode(s)
+    return (s.replace('&', '&amp;')
+             .replace('<', '&lt;')
+             .replace('>', '&gt;')
+             .replace('"', '&quot;')
+             .replace("'", '&#39;'))
+
+def attributes(kwargs):
+    return u''.join([u''.join([u' ', key, u'="', escape(value), u'"'])
+                     for key, value in kwargs.iteritems()])
+
 def lonetag(tag, **kwargs):
-    attrs = ['%s="%s"' % (key, value) for key,value in kwargs.iteritems()]
-    return u'<%s>' % (u' '.join([tag] + attrs))
+    return u''.join([u'<', tag, attributes(kwargs), u'>'])
+
+def tagify(tag, content, **kwargs):
+    return u''.join([u'<', tag, attributes(kwargs), u'>',
+                     unicode(content), u'</', tag, u'>'])
+
+class Template(object):
+    """
+    Precompiled tag with fixed attributes and named variable attributes:
+
+        TH = Template('th', ('rowspan', 'class'), scope='row')
+        TH.text(u'Smith & Co', 2, 'first')
+        => u'<th scope="row" rowspan="2" class="first">Smith &amp; Co</th>'
+    """
+    __slots__ = ('tag', 'pieces', 'close', 'lone')
+
+    def __init__(self, tag, names=(), lone=False, **fixed):
+        self.tag  = tag
+        self.lone = lone
+        self.close = u' />' if lone else u'>'
+        head = u''.join([u'<', tag, attributes(fixed)])
+        self.pieces = []
+        for name in names:
+            self.pieces.append(u''.join([head, u' ', name, u'="']))
+            head = u'"'
+        self.pieces.append(head)
+
+    def open(self, *values):
+        parts = []
+        for piece, value in zip(self.pieces, values):
+            parts.append(piece)
+            parts.append(escape(value))
+        parts.append(self.pieces[-1])
+        parts.append(self.close)
+        return u''.join(parts)
+
+    def element(self, markup, *values):
+        return u''.join([self.open(*values), unicode(markup),
+                         u'</', self.tag, u'>'])
+
+    def text(self, text, *values):
+        return u''.join([self.open(*values), escape(text),
+                         u'</', self.tag, u'>'])
+
+
+class Builder(object):
+    """
+    Collects output into a shared buffer, so that parts of a page can be
+    written by several functions and joined only once at the end.
+    """
+    def __init__(self):
+        self.parts = []
+
+    def raw(self, markup):
+        self.parts.append(markup)
+
+    def text(self, text):
+        self.parts.append(escape(text))
+
+    def tag(self, template, *values):
+        self.parts.append(template.open(*values))
+
+    def element(self, template, markup, *values):
+        self.parts.append(template.element(markup, *values))
+
+    def text_element(self, template, text, *values):
+        self.parts.append(template.text(text, *values))
+
+    def getvalue(self, separator=u''):
+        return separator.join(self.parts)
 
-def tagify(tag, content, **kwargs): 
-    attrs = ['%s="%s"' % (key, value) for key,value in kwargs.iteritems()]
-    return u'<%s>%s</%s>' % (u" ".join([tag] + attrs), unicode(content), tag)
 
 def th(content, **kwargs): return tagify('th', content, **kwargs)
 def td(content, **kwargs): return tagify('td', content, **kwargs)
@@ -15,14 +110,14 @@ def tr(content, **kwargs):
     else:
         return tagify('tr', content, **kwargs)
 
-def input(**kwargs): 
+def input(**kwargs):
     return lonetag('input', **kwargs)
 
-def text_input(**kwargs): 
+def text_input(**kwargs):
     kwargs['type'] = 'text'
     return input(**kwargs)
 
+HIDDEN_INPUT = Template('input', ('name', 'value'), lone=True, type='hidden')
 
 def hidden_input(name, value):
-    return u'<input type="hidden" name="%s" value="%s" />' % (name, value)
-
+    return HIDDEN_INPUT.open(name, value)
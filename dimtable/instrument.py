@@ -0,0 +1,118 @@
+# ----------------------------------------------------------------------
+# instrument
+#
+# Optional instrumentation of table loading and rendering. Tables and
+# Data get a Probe that collects per-phase timings and counters. When
+# a table has been rendered, the probe is passed to all registered
+# listeners:
+#
+#    def show(probe):
+#        print probe.name, probe.timings, probe.counts
+#    instrument.add_listener(show)
+#
+# or, to log through the 'dimtable.instrument' logger (configurable with
+# Django's LOGGING setting):
+#
+#    instrument.add_listener(instrument.log_probe)
+#
+# Without listeners tables get NULL_PROBE, which does nothing.
+# ----------------------------------------------------------------------
+
+import time
+import logging
+
+logger = logging.getLogger('dimtable.instrument')
+
+_listeners = []
+
+def add_listener(listener):
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+def remove_listener(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+def log_probe(probe):
+    logger.info(probe.summary())
+
+
+class _Timer(object):
+    def __init__(self, probe, phase):
+        self.probe = probe
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        timings = self.probe.timings
+        timings[self.phase] = (timings.get(self.phase, 0.0)
+                               + time.time() - self.start)
+
+
+class Probe(object):
+    enabled = True
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = {} # seconds by phase
+        self.counts  = {} # e.g. cells, queries, bytes
+        self._depth  = 0
+
+    def phase(self, name):
+        return _Timer(self, name)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    # report wraps a top-level operation such as Table.render, listeners
+    # are notified when the outermost one finishes
+    def report(self):
+        return _Report(self)
+
+    def notify(self):
+        for listener in list(_listeners):
+            listener(self)
+        self.timings = {}
+        self.counts  = {}
+
+    def summary(self):
+        timings = ' '.join('%s=%.1fms' % (phase, t * 1000)
+                           for phase, t in sorted(self.timings.iteritems()))
+        counts  = ' '.join('%s=%d' % (name, n)
+                           for name, n in sorted(self.counts.iteritems()))
+        return u'%s: %s %s' % (self.name, timings, counts)
+
+
+class _Report(object):
+    def __init__(self, probe):
+        self.probe = probe
+
+    def __enter__(self):
+        self.probe._depth += 1
+
+    def __exit__(self, *exc_info):
+        self.probe._depth -= 1
+        if self.probe._depth == 0:
+            self.probe.notify()
+
+
+class _NullContext(object):
+    def __enter__(self): pass
+    def __exit__(self, *exc_info): pass
+
+_NULL_CONTEXT = _NullContext()
+
+class NullProbe(object):
+    enabled = False
+    name = None
+
+    def phase(self, name): return _NULL_CONTEXT
+    def count(self, name, n=1): pass
+    def report(self): return _NULL_CONTEXT
+
+NULL_PROBE = NullProbe()
+
+def probe(name):
+    return Probe(name) if _listeners else NULL_PROBE
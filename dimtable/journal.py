@@ -0,0 +1,47 @@
+# ----------------------------------------------------------------------
+# journal
+#
+# Append-only journal of cell edits. Data with journal=<table key>
+# records every change it applies as a CellChange (table key, cell int,
+# old value, new value), with the id of the CellChange as its sequence
+# number. Changes of Presenter.save_data are written with one bulk
+# insert in the transaction of the save, so downstream caches and 
+# clients can catch up from the last sequence number they've seen:
+#
+#    for seq, cell, old, new in journal.changes_since('sales', seq):
+#        ...
+#
+# Values are stored as unicode strings. Sequence numbers grow with
+# inserts, but concurrent transactions may commit out of order, so a
+# reader that needs every change should re-read a little before its
+# last seen number. Requires 'dimtable' in INSTALLED_APPS.
+# ----------------------------------------------------------------------
+
+def to_string(value):
+    return None if value is None else unicode(value)
+
+def write(table_key, changes, batch_size=1000):
+    """Writes [(cell int, old string, new string)] of a table"""
+    from models import CellChange
+    CellChange.objects.bulk_create([CellChange(table_key = table_key, 
+                                               cell      = cell, 
+                                               old_value = old, 
+                                               new_value = new)
+                                    for cell, old, new in changes],
+                                   batch_size=batch_size)
+
+def changes_since(table_key, seq=0, limit=None):
+    """Returns [(seq, cell int, old, new)] of changes after seq, in order"""
+    from models import CellChange
+    changes = (CellChange.objects.filter(table_key=table_key, id__gt=seq)
+               .order_by('id')
+               .values_list('id', 'cell', 'old_value', 'new_value'))
+    if limit is not None:
+        changes = changes[:limit]
+    return list(changes)
+
+def last_seq(table_key):
+    from models import CellChange
+    from django.db.models import Max
+    return (CellChange.objects.filter(table_key=table_key)
+            .aggregate(seq=Max('id'))['seq'] or 0)
@@ -0,0 +1,129 @@
+# ----------------------------------------------------------------------
+# labelcache
+#
+# Process-wide LRU cache of rendered and serialized dimension items, so
+# that e.g. a dimension of 1000 employees isn't rendered and serialized
+# again on every request. Enable it once, e.g. in settings or urls:
+#
+#    from dimtable import labelcache
+#    labelcache.enable(maxsize=10000)
+#
+# Entries are keyed by (kind, model, field, value key), where kind
+# includes the renderer for rendered labels and the value key of a
+# model instance is its primary key. Entries of an instance are dropped
+# when the instance is saved or deleted (post_save and post_delete
+# signals). Changes that bypass signals, such as QuerySet.update, aren't
+# seen until the entry is evicted.
+#
+# The cache and its invalidation are per process: a save in one worker
+# process doesn't drop the entries of other processes, which keep 
+# showing the old label until it is evicted. Use a small maxsize, or
+# leave the cache off, where labels of other processes must be fresh.
+#
+# Renderers are part of the key, so they should be module-level
+# functions: a renderer defined inside a view is a new function on
+# every request and never hits the cache.
+# ----------------------------------------------------------------------
+
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._by_instance = {} # (model, pk) -> set of keys
+        self._instance_of = {} # key -> (model, pk)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key)
+            self._entries[key] = value # most recently used last
+            return value
+
+    def set(self, key, value, instance_key=None):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = value
+            if instance_key is not None:
+                self._by_instance.setdefault(instance_key, set()).add(key)
+                self._instance_of[key] = instance_key
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        # drops an entry and its instance index entry, lock held
+        self._entries.pop(key, None)
+        instance_key = self._instance_of.pop(key, None)
+        if instance_key is not None:
+            keys = self._by_instance[instance_key]
+            keys.discard(key)
+            if not keys:
+                del self._by_instance[instance_key]
+
+    def invalidate(self, instance_key):
+        """Drops the entries of an instance, in this process only"""
+        with self._lock:
+            for key in list(self._by_instance.get(instance_key, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_instance.clear()
+            self._instance_of.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+_cache = None
+
+def enable(maxsize=10000):
+    global _cache
+    from django.db.models import signals
+    signals.post_save.connect(_instance_changed, weak=False,
+                              dispatch_uid='dimtable.labelcache.save')
+    signals.post_delete.connect(_instance_changed, weak=False,
+                                dispatch_uid='dimtable.labelcache.delete')
+    _cache = LRUCache(maxsize)
+
+def disable():
+    global _cache
+    _cache = None
+
+def _instance_changed(sender, instance, **kwargs):
+    if _cache is not None:
+        _cache.invalidate((sender, instance.pk))
+
+def cached(kind, item, compute):
+    """
+    Returns compute(item) through the cache, if the cache is enabled and
+    the item's value can be used as a key. kind tells apart what is 
+    computed, e.g. ('representation', renderer).
+    """
+    if _cache is None:
+        return compute(item)
+
+    value = item.value()
+    pk = getattr(value, 'pk', None)
+    if pk is not None:
+        valuekey = pk
+        instance_key = (type(value), pk)
+    elif hasattr(value, 'pk'):
+        return compute(item) # unsaved instance
+    else:
+        valuekey = value
+        instance_key = None
+
+    key = (kind, item.model, item.fieldname, valuekey)
+    try:
+        return _cache.get(key)
+    except KeyError:
+        pass
+    except TypeError:
+        return compute(item) # unhashable value
+
+    result = compute(item)
+    _cache.set(key, result, instance_key)
+    return result
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CellChange',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('table_key', models.CharField(max_length=100)),
+                ('cell', models.BigIntegerField()),
+                ('old_value', models.TextField(null=True)),
+                ('new_value', models.TextField(null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='cellchange',
+            index_together=set([('table_key', 'id')]),
+        ),
+    ]
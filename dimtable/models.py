@@ -0,0 +1,19 @@
+from django.db import models
+
+# Models of the optional dimtable app. Add 'dimtable' to INSTALLED_APPS
+# to use the change journal (see module journal).
+
+class CellChange(models.Model):
+    # id is the sequence number of the change
+    table_key = models.CharField(max_length=100)
+    cell      = models.BigIntegerField()
+    old_value = models.TextField(null=True)
+    new_value = models.TextField(null=True)
+
+    def __unicode__(self):
+        return u"%s #%d cell %d: %s -> %s" % (self.table_key, self.id, 
+                                              self.cell, self.old_value,
+                                              self.new_value)
+
+    class Meta:
+        index_together = [('table_key', 'id')]
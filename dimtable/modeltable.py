@@ -3,12 +3,15 @@
 # ---------------------------------------------------------------------------
 
 import logging
+import operator
 import json
+import datetime
+import contextlib
 
 from django.utils.safestring import mark_safe
 from django.core import exceptions
+from django.db import transaction, connection, IntegrityError
 import django.db.models.fields.related
-from django.forms.widgets import TextInput
 import django.db.models.fields
 
 import html
@@ -38,6 +41,25 @@ def write_list(xs):
 def read_list(s):
     return s.split(',') 
 
+@contextlib.contextmanager
+def counting_queries(probe):
+    if not probe.enabled:
+        yield
+    elif hasattr(connection, 'execute_wrapper'):
+        def count(execute, sql, params, many, context):
+            probe.count('queries')
+            return execute(sql, params, many, context)
+        with connection.execute_wrapper(count):
+            yield
+    else:
+        # before Django 2.0 queries are only recorded with a debug cursor,
+        # which CaptureQueriesContext forces on also when DEBUG is off
+        from django.test.utils import CaptureQueriesContext
+        queries = CaptureQueriesContext(connection)
+        with queries:
+            yield
+        probe.count('queries', len(queries))
+
 def parse_value(valstr, field):
     value = None
     error = None
@@ -49,27 +71,35 @@ def parse_value(valstr, field):
     return value, error
 
 
-class CellError:
+# CellError keeps only the messages of the error, not the exception
+class CellError(object):
+    __slots__ = ('_messages', 'cellix', 'inputted_value')
+
     def __init__(self, err, cellix, inputted_value):
-        self.err = err
+        if hasattr(err, 'messages'):
+            msgs = err.messages
+            if type(msgs) == dict:
+                msgs = msgs.values()
+        else:
+            msgs = [unicode(err)]
+        self._messages = tuple(msgs)
         self.cellix = cellix
         self.inputted_value = inputted_value
 
     def messages(self):
-        if hasattr(self.err, 'messages'):
-            msgs = self.err.messages
-            if type(msgs) == dict:
-                return msgs.values()
-            else:
-                return msgs
-        else:
-            return [unicode(self.err)]
+        return list(self._messages)
+
+
+class ReadOnlyError(TypeError):
+    """Raised when cells of read-only Data are saved or made editable"""
 
 # ----------------------------------------------------------------------
 # modeltable ValueItem
 # ----------------------------------------------------------------------
 
 class ValueItem(dimtable.LabelItem):
+    __slots__ = ('model', 'fieldname')
+
     def __init__(self, model, fieldname, value, renderer = unicode):
         dimtable.LabelItem.__init__(self, value, renderer)
         self.model      = model
@@ -82,7 +112,16 @@ class ValueItem(dimtable.LabelItem):
     def get_field(self):
         return get_model_field(self.model, self.fieldname)
 
+    def representation(self):
+        import labelcache
+        return labelcache.cached(('representation', self.renderer), self,
+                                 dimtable.LabelItem.representation)
+
     def hidden_serialize(self):
+        import labelcache
+        return labelcache.cached('hidden', self, ValueItem._hidden_serialize)
+
+    def _hidden_serialize(self):
         field = self.get_field()
         v = self.value()
         if isinstance(field,   django.db.models.fields.related.ForeignKey):
@@ -97,10 +136,148 @@ class ValueItem(dimtable.LabelItem):
 def valueitems(model, fieldname, values, renderer = unicode):
     return [ValueItem(model, fieldname, v, renderer) for v in values]
 
+def value_key(value):
+    # values() and <field>_id attributes give primary keys for foreign keys
+    return getattr(value, 'pk', value)
+
+def dim_index(dim):
+    """
+    Maps value keys of ValueItems to item indexes, for looking up 
+    instances by value instead of calling matches_instance on each item.
+    """
+    return dict((value_key(item.value()), i) 
+                for i, item in enumerate(dim.items))
+
+def label_index(dim):
+    """
+    Maps labels of a dimension back to item indexes. Both the rendered
+    representation and the hidden serialization of an item are accepted,
+    if labels collide the first item wins.
+    """
+    index = {}
+    for i, item in enumerate(dim.items):
+        index.setdefault(unicode(item.representation()), i)
+        if isinstance(item, ValueItem):
+            index.setdefault(unicode(item.hidden_serialize()), i)
+        else:
+            index.setdefault(unicode(item.value()), i)
+    return index
+
+# ----------------------------------------------------------------------
+# Date hierarchy
+#
+# PeriodItems are ValueItems of a date field at granularity of year,
+# month, week (starting on Monday, as in SQL) or day. The value of an
+# item is the first day of its period. At day granularity they behave
+# like plain ValueItems, coarser levels are meant for AggregateData, 
+# which groups by the period of the date with one GROUP BY query.
+# ----------------------------------------------------------------------
+
+GRANULARITIES = ('year', 'month', 'week', 'day')
+
+def truncate_date(d, granularity):
+    if isinstance(d, datetime.datetime): d = d.date()
+    if granularity == 'year':  return d.replace(month=1, day=1)
+    if granularity == 'month': return d.replace(day=1)
+    if granularity == 'week':  return d - datetime.timedelta(d.weekday())
+    return d
+
+def next_period(d, granularity):
+    if granularity == 'year':  return d.replace(year=d.year + 1)
+    if granularity == 'month':
+        if d.month == 12: return d.replace(year=d.year + 1, month=1)
+        else:             return d.replace(month=d.month + 1)
+    if granularity == 'week':  return d + datetime.timedelta(7)
+    return d + datetime.timedelta(1)
+
+def period_starts(start, end, granularity):
+    """First days of the periods that overlap start..end (inclusive)"""
+    d = truncate_date(start, granularity)
+    starts = []
+    while d <= end:
+        starts.append(d)
+        d = next_period(d, granularity)
+    return starts
+
+# module-level renderers, so that labels of periods can be cached
+def show_year(d):  return d.strftime('%Y')
+def show_month(d): return d.strftime('%b %Y')
+def show_week(d):  return d.strftime('Wk %d/%m/%Y')
+def show_day(d):   return d.strftime('%d/%m/%Y')
+
+PERIOD_RENDERERS = {'year': show_year, 'month': show_month,
+                    'week': show_week, 'day': show_day}
+
+class PeriodItem(ValueItem):
+    __slots__ = ('granularity',)
+
+    def __init__(self, model, fieldname, value, granularity, renderer = None):
+        assert granularity in GRANULARITIES, granularity
+        ValueItem.__init__(self, model, fieldname, value, 
+                           renderer or PERIOD_RENDERERS[granularity])
+        self.granularity = granularity
+
+    def matches_instance(self, instance):
+        fieldvalue = getattr(instance, self.fieldname)
+        return truncate_date(fieldvalue, self.granularity) == self.value()
+
+    def period(self):
+        """Returns (first day, first day of the next period)"""
+        return self.value(), next_period(self.value(), self.granularity)
+
+    def zoom(self, granularity = None):
+        """
+        Returns (start, end, granularity) for showing this period at a 
+        finer granularity, by default the next level of GRANULARITIES.
+        """
+        if granularity is None:
+            level = GRANULARITIES.index(self.granularity)
+            granularity = GRANULARITIES[min(level + 1, len(GRANULARITIES) - 1)]
+        start, end = self.period()
+        return start, end - datetime.timedelta(1), granularity
+
+    def editable(self): return self.granularity == 'day'
+
+def perioditems(model, fieldname, start, end, granularity, renderer = None):
+    return [PeriodItem(model, fieldname, d, granularity, renderer) 
+            for d in period_starts(start, end, granularity)]
+
+def period_case_sql(model, field, dimitems):
+    """
+    SQL and params of a CASE expression giving the index of the period of
+    a date field, for grouping by periods. Date truncation functions 
+    differ by database and Django version, and weeks have none at all.
+    """
+    qn = connection.ops.quote_name
+    column = '%s.%s' % (qn(model._meta.db_table), qn(field.column))
+    whens = []
+    params = []
+    for i, item in dimitems:
+        start, end = item.period()
+        whens.append('WHEN %s >= %%s AND %s < %%s THEN %d' 
+                     % (column, column, i))
+        params.extend(field.get_db_prep_value(field.to_python(d), connection)
+                      for d in (start, end))
+    return 'CASE %s END' % ' '.join(whens), params
+
+def field_items(dim):
+    # (index, item) of the items of a dimension that stand for a value of
+    # a model field, leaving out e.g. CustomItems of totals
+    return [(i, item) for i, item in enumerate(dim.items)
+            if getattr(item, 'fieldname', None)]
+
+def dim_granularity(dim):
+    # granularity of a dimension of PeriodItems, None for other dimensions
+    if dim.items and all(isinstance(item, PeriodItem) for item in dim.items):
+        return dim.items[0].granularity
+    return None
+
 # ----------------------------------------------------------------------
 # modeltable InputItem
 # ----------------------------------------------------------------------
 class InputItem(dimtable.LabelItem):
+    __slots__ = ('model', 'fieldname')
+
     def __init__(self, model, fieldname, renderer=None):
         if renderer is None:
             renderer = self.show_verbose_name
@@ -129,12 +306,62 @@ class InputItem(dimtable.LabelItem):
             return unicode(fieldvalue)
 
 class CustomItem(dimtable.LabelItem):
+    __slots__ = ()
+
     def __init__(self, name):
         dimtable.LabelItem.__init__(self, name)
         
     def editable(self): return False
     def render_instance(self, inst, cellindex):
         return u'n/a'
+
+class ComputedItem(dimtable.LabelItem):
+    """
+    Derived cell of the input dimension. expression gets a CellRef of the
+    value range cell and returns the value of the cell, e.g.
+
+        ComputedItem('margin', lambda cell: cell['price'] - cell['cost'])
+        ComputedItem('change', 
+                     lambda cell: cell['amount'] - cell.relative('amount', cols=(-1,)))
+
+    Values are computed only for rendered cells and memoized in Data.
+    Empty operands are None, and expressions failing on them with a 
+    TypeError or an ArithmeticError give an empty cell.
+    """
+    __slots__ = ('name', 'expression', 'format')
+
+    def __init__(self, name, expression, renderer = unicode, format = unicode):
+        dimtable.LabelItem.__init__(self, name, renderer)
+        self.name       = name
+        self.expression = expression
+        self.format     = format
+
+    def editable(self): return False
+
+    def render_instance(self, inst, cellindex):
+        # computed values come from Data.computed_value, see Presenter
+        return u''
+
+    def render_value(self, value):
+        return u'' if value is None else self.format(value)
+
+class AggregateItem(dimtable.LabelItem):
+    """
+    Cell item of AggregateData, shows an aggregate expression such as
+    Sum('amount') computed over all instances of the cell.
+    """
+    __slots__ = ('name', 'aggregate')
+
+    def __init__(self, name, aggregate, renderer = unicode):
+        dimtable.LabelItem.__init__(self, name, renderer)
+        self.name      = name
+        self.aggregate = aggregate
+
+    def editable(self): return False
+    def render_instance(self, row, cellindex):
+        if row is None: return u''
+        value = row[self.name]
+        return u'' if value is None else unicode(value)
     
 
 # ----------------------------------------------------------------------
@@ -145,6 +372,162 @@ class InputDim(dimtable.Dim):
     def __init__(self, items): 
         dimtable.Dim.__init__(self, items)
 
+# ----------------------------------------------------------------------
+# Computed holds memoized values of ComputedItems. While an expression is
+# evaluated, every cell it reads is recorded as its dependency, so an 
+# edit of a value range cell invalidates only the computed cells that
+# (transitively) read it.
+#
+# Items that read each other in the same cell are a configuration error,
+# found when Data is built by tracing the expressions with stand-in 
+# operands. Reading other cells of the same item, e.g. a running total
+# reading the previous column, is fine.
+# ----------------------------------------------------------------------
+
+class CellRef(object):
+    __slots__ = ('computed', 'cix')
+
+    def __init__(self, computed, cix):
+        self.computed = computed
+        self.cix      = cix
+
+    def __getitem__(self, name):
+        return self.computed.value(self.cix, name)
+
+    def relative(self, name, rows=(), cols=()):
+        """
+        Value of a cell at index offsets from this one, e.g. cols=(-1,) 
+        is the previous item of the first column dimension. None if the 
+        offset goes outside the table.
+        """
+        cix = self.computed.shift(self.cix, rows, cols)
+        if cix is None: return None
+        return self.computed.value(cix, name)
+
+class Traced(object):
+    """Stand-in operand of traced expressions, any arithmetic gives itself"""
+    __slots__ = ()
+
+    def __float__(self):   return 0.0
+    def __int__(self):     return 0
+    def __long__(self):    return 0L
+    def __nonzero__(self): return True
+
+def _traced_operation(self, *args):
+    return self
+
+for _name in ['add', 'sub', 'mul', 'div', 'truediv', 'floordiv', 'mod', 
+              'pow', 'divmod']:
+    setattr(Traced, '__%s__' % _name, _traced_operation)
+    setattr(Traced, '__r%s__' % _name, _traced_operation)
+for _name in ['neg', 'pos', 'abs']:
+    setattr(Traced, '__%s__' % _name, _traced_operation)
+
+TRACED = Traced()
+
+class TraceRef(object):
+    """CellRef that records the names an expression reads from its cell"""
+    def __init__(self):
+        self.names = set()
+
+    def __getitem__(self, name):
+        self.names.add(name)
+        return TRACED
+
+    def relative(self, name, rows=(), cols=()):
+        if not any(rows) and not any(cols):
+            self.names.add(name)
+        return TRACED
+
+class Computed(object):
+    def __init__(self, data):
+        self.data = data
+        self.items = dict((item.name, item) for item in data.inputdim.items
+                          if isinstance(item, ComputedItem))
+        self.memo = {}       # (cix, name) -> value
+        self.dependents = {} # cix or (cix, name) -> set of (cix, name)
+        self._evaluating = []
+        self.check_cycles()
+
+    def check_cycles(self):
+        """Raises ImproperlyConfigured if computed items read each other"""
+        reads = {}
+        for name, item in self.items.iteritems():
+            ref = TraceRef()
+            try:
+                item.expression(ref)
+            except Exception:
+                pass # only the names read before failing are needed
+            reads[name] = sorted(ref.names & set(self.items))
+
+        done = set()
+        def visit(name, path):
+            if name in path:
+                cycle = path[path.index(name):] + [name]
+                raise exceptions.ImproperlyConfigured(
+                    "Computed items depend on themselves: %s" 
+                    % u' -> '.join(cycle))
+            if name in done: return
+            for other in reads[name]:
+                visit(other, path + [name])
+            done.add(name)
+
+        for name in sorted(self.items):
+            visit(name, [])
+
+    def value(self, cix, name):
+        item = self.items.get(name, None)
+        key = (cix, name) if item is not None else cix
+        if self._evaluating:
+            self.dependents.setdefault(key, set()).add(self._evaluating[-1])
+
+        if item is None:
+            inst = self.data.instdict.get(cix, None)
+            if inst is None: return None
+            if isinstance(inst, dict): return inst.get(name, None)
+            return getattr(inst, name)
+
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+
+        if key in self._evaluating:
+            # a cycle through other cells that tracing doesn't see
+            logger.error("Computed cell %s %s depends on itself" 
+                         % (name, str(cix)))
+            return None
+        self._evaluating.append(key)
+        try:
+            try:
+                value = item.expression(CellRef(self, cix))
+            except (TypeError, ArithmeticError):
+                value = None
+        finally:
+            self._evaluating.pop()
+        self.memo[key] = value
+        return value
+
+    def shift(self, cix, rows, cols):
+        def shifted(ixes, deltas, dims):
+            deltas = tuple(deltas) + (0,) * (len(ixes) - len(deltas))
+            result = tuple(ix + d for ix, d in zip(ixes, deltas))
+            if all(0 <= ix < len(dim) for ix, dim in zip(result, dims)):
+                return result
+            return None
+        rixes = shifted(cix.row_indexes(), rows, self.data.valuerange_rowdims())
+        cixes = shifted(cix.col_indexes(), cols, self.data.valuerange_coldims())
+        if rixes is None or cixes is None: return None
+        return dimtable.make_cellindex(rixes, cixes)
+
+    def invalidate(self, cix):
+        if not self.memo: return
+        stale = self.dependents.pop(cix, set())
+        while stale:
+            key = stale.pop()
+            self.memo.pop(key, None)
+            stale.update(self.dependents.pop(key, ()))
+
 # ----------------------------------------------------------------------
 # Data. 
 # Modeltables are used to show and edit instances of a single Django model.
@@ -180,6 +563,8 @@ class InputDim(dimtable.Dim):
 # ----------------------------------------------------------------------
 
 class Data(object):
+    read_only = False
+
     def __init__(self, model, inputdim, instances, rowdims, coldims, **kwargs):
         self.model        = model
         self.inputdim     = inputdim
@@ -189,19 +574,162 @@ class Data(object):
         self.coldims      = coldims
         self.fixed_fields = kwargs.get('fixed_fields', [])
 
+        # with a writebehind.SaveQueue, saved cells are queued instead
+        self.write_behind = kwargs.get('write_behind', None)
+
+        # with upsert, cells are saved by their dimension and fixed field
+        # values instead of instance ids, see upsert
+        self.upsert_mode = kwargs.get('upsert', False)
+
+        # with a table key, applied changes are recorded, see journal
+        self.journal  = kwargs.get('journal', None)
+        self._changes = []
+        self._batching = 0
+        self._indexer = None
+
         # instdict is an internal data structure 
         # for fast instance lookups by cell index
         self.instdict     = {} 
 
-        self._create_instdict(instances, 
-                              self.valuerange_rowdims(), 
-                              self.valuerange_coldims())
+        self.probe = kwargs.get('probe', None)
+        if self.probe is None:
+            import instrument
+            self.probe = instrument.probe(kwargs.get('prefix', 'table'))
+
+        # dimension indexes can be shared between Data of the same page,
+        # see django_dimtable.TableGroup
+        self._dim_indexes = kwargs.get('dim_indexes', {})
+        self._interned = {}
+        self._fixed_keys = None
+        self.computed = Computed(self)
+        self._row_lookups = [self.dim_lookup(dim) 
+                             for dim in self.valuerange_rowdims()]
+        self._col_lookups = [self.dim_lookup(dim) 
+                             for dim in self.valuerange_coldims()]
+
+        with counting_queries(self.probe):
+            self._create_instdict(instances, 
+                                  self.valuerange_rowdims(), 
+                                  self.valuerange_coldims())
 
     def _create_instdict(self, instances, rowdims, coldims):
+        # iterating a queryset caches all of it anyway, so evaluating it 
+        # first costs nothing and lets the query be timed separately
+        with self.probe.phase('queryset'):
+            instances = list(instances)
+
+        with self.probe.phase('instdict'):
+            self._add_instances(instances, rowdims, coldims)
+        self.probe.count('instances', len(instances))
+
+        if self.write_behind is not None:
+            with self.probe.phase('pending'):
+                self._add_pending()
+
+    def _add_instances(self, instances, rowdims, coldims):
         for v in instances:
-            rixes = tuple(self.dimindex_for_instance(dim, v) for dim in rowdims)
-            cixes = tuple(self.dimindex_for_instance(dim, v) for dim in coldims)
-            self.instdict[dimtable.CellIndex(tuple((rixes,cixes)))] = v
+            self.add_instance(v)
+
+    def add_instance(self, inst):
+        """
+        Adds an instance to instdict. Returns False if the instance doesn't
+        match an item of every dimension, in which case it's not added.
+        """
+        cix = self.cellindex_for_instance(inst)
+        if cix is None:
+            return False
+        self.instdict[cix] = inst
+        return True
+
+    def cellindex_for_instance(self, inst):
+        # value range cell index of an instance, or None
+        try:
+            rixes = tuple([lookup(inst) for lookup in self._row_lookups])
+            cixes = tuple([lookup(inst) for lookup in self._col_lookups])
+        except (KeyError, StopIteration):
+            return None
+
+        # Equal index tuples are interned, so that cell indexes of the same
+        # row or column share them instead of each having their own copy
+        rixes = self._interned.setdefault(rixes, rixes)
+        cixes = self._interned.setdefault(cixes, cixes)
+        return dimtable.CellIndex(tuple((rixes,cixes)))
+
+    def _add_pending(self):
+        # shows queued writes on top of the instances from the database
+        import writebehind
+        pending = self.write_behind.pending(self.model)
+        for rowkey, fieldname, op, value in pending:
+            inst = self.model(**writebehind.parse_rowkey(self.model, rowkey))
+            if not self.matches_fixed_fields(inst):
+                continue
+            cix = self.cellindex_for_instance(inst)
+            if cix is None:
+                continue
+            if op == writebehind.DELETE:
+                self.instdict.pop(cix, None)
+            else:
+                inst = self.instdict.setdefault(cix, inst)
+                setattr(inst, fieldname, 
+                        writebehind.parse_value(self.model, fieldname, value))
+
+    def rowkey(self, cellix):
+        """
+        Natural key of a cell: {fieldname: value string} of the fields of
+        its dimension items and of the fixed fields.
+        """
+        key = {}
+        for item in self.items_for_cellix(cellix):
+            if isinstance(item, ValueItem):
+                key[item.fieldname] = unicode(value_key(item.value()))
+        for fieldname, value in self.fixed_fields:
+            key[fieldname] = unicode(value_key(value))
+        return key
+
+    def dim_lookup(self, dim):
+        # Dimensions of ValueItems are looked up from a dict by the field's
+        # attname, which for foreign keys is <field>_id, so that related 
+        # objects aren't fetched. Other dimensions use matches_instance.
+        if not (dim.items and 
+                all(isinstance(item, ValueItem) for item in dim.items)):
+            return lambda inst: self.dimindex_for_instance(dim, inst)
+
+        key = id(dim)
+        if key not in self._dim_indexes:
+            field = get_model_field(self.model, dim.items[0].fieldname)
+            self._dim_indexes[key] = (dim, field.attname, dim_index(dim))
+        dim, attname, index = self._dim_indexes[key]
+
+        granularity = dim_granularity(dim)
+        if granularity not in (None, 'day'):
+            return lambda inst: index[truncate_date(getattr(inst, attname),
+                                                    granularity)]
+        return lambda inst: index[getattr(inst, attname)]
+
+    def restrictions(self):
+        """
+        Returns {fieldname: set of value keys} of the dimension fields and
+        fixed fields, i.e. values that instances of this Data can have.
+        """
+        result = {}
+        for dim in self.valuerange_rowdims() + self.valuerange_coldims():
+            if dim_granularity(dim) not in (None, 'day'):
+                continue # values are period starts, not field values
+            if all(isinstance(item, ValueItem) for item in dim.items):
+                result[dim.items[0].fieldname] = set(dim_index(dim))
+        for fieldname, value in self.fixed_fields:
+            result[fieldname] = set([value_key(value)])
+        return result
+
+    def matches_fixed_fields(self, inst):
+        if self._fixed_keys is None:
+            self._fixed_keys = [(get_model_field(self.model, fieldname).attname,
+                                 value_key(value))
+                                for fieldname, value in self.fixed_fields]
+        for attname, key in self._fixed_keys:
+            if getattr(inst, attname) != key:
+                return False
+        return True
 
     def is_single_input(self):
         return len(self.inputdim) == 1
@@ -240,7 +768,100 @@ class Data(object):
         cix = self.valuerange_cellindex(cellindex)
         return self.instdict.get(cix, None)
 
+    def computed_value(self, cellindex, item):
+        cix = self.valuerange_cellindex(cellindex)
+        return self.computed.value(cix, item.name)
+
+    def changed(self, cix):
+        # called with the value range cell index after instdict changes
+        self.computed.invalidate(cix)
+
+    def record_change(self, cellix, old, new):
+        if self.journal is None: return
+        import journal
+        if self._indexer is None:
+            self._indexer = dimtable.Indexer(self.coldims, self.rowdims)
+        self._changes.append((self._indexer.cellindex_to_int(cellix),
+                              journal.to_string(old), journal.to_string(new)))
+        if not self._batching:
+            self.write_journal()
+
+    def record_instance(self, cix, instance, old_values, deleted=False):
+        # records changes of all input fields of the instance of cix,
+        # old_values has the values before the change
+        for fix, fieldname in enumerate(self.inputdim.values()):
+            old = old_values.get(fieldname, None)
+            new = None if deleted else getattr(instance, fieldname, None)
+            if old != new:
+                self.record_change(self.full_cellindex(cix, fix), old, new)
+
+    def input_values(self, instance):
+        if instance is None: return {}
+        return dict((fieldname, getattr(instance, fieldname, None))
+                    for fieldname in self.inputdim.values())
+
+    def full_cellindex(self, cix, fix):
+        # cell index of input fix of a value range cell index
+        if self.is_single_input(): return cix
+        return dimtable.make_cellindex(cix.row_indexes() + (fix,),
+                                       cix.col_indexes())
+
+    def write_journal(self):
+        import journal
+        if self._changes:
+            journal.write(self.journal, self._changes)
+            self._changes = []
+
+    @contextlib.contextmanager
+    def journaling(self):
+        """
+        Collects the changes recorded in the block and writes them with
+        one insert, in the same transaction as the changes themselves.
+        """
+        if self.journal is None:
+            yield
+            return
+        self._batching += 1
+        try:
+            with transaction.atomic():
+                yield
+                if self._batching == 1:
+                    self.write_journal()
+        finally:
+            self._batching -= 1
+            if not self._batching:
+                self._changes = []
+
+    def changes_since(self, seq=0, limit=None):
+        import journal
+        return journal.changes_since(self.journal, seq, limit)
+
+    def to_numpy(self, sparse=False):
+        """Cell values as a NumPy array, see arrays.to_numpy"""
+        import arrays
+        return arrays.to_numpy(self, sparse)
+
+    def to_arrow(self):
+        """Cell values as a pyarrow.Table, see arrays.to_arrow"""
+        import arrays
+        return arrays.to_arrow(self)
+
     def save(self, cellix, instance_id, value):
+        if self.write_behind is not None:
+            # like below, an emptied cell deletes its instance, which may
+            # also be one that so far exists only in the queue (instdict
+            # has those, see _add_pending)
+            cix = self.valuerange_cellindex(cellix)
+            if value is None and (instance_id > 0 or cix in self.instdict):
+                cellixes = [self.full_cellindex(cix, fix)
+                            for fix in range(len(self.inputdim))]
+                return self.queue_many(instance_id, dict(
+                        (c, (None, None)) for c in cellixes))
+            if value is not None:
+                default = django.db.models.fields.NOT_PROVIDED
+                self.queue_many(instance_id, {cellix: (value, default)})
+            return
+
         if instance_id > 0:
             if value is None:
                 # get all the other values and check if they are null
@@ -252,6 +873,9 @@ class Data(object):
                 self.create(cellix, value)
 
     def save_many(self, instance_id, valuedict):
+        if self.write_behind is not None:
+            return self.queue_many(instance_id, valuedict)
+
         if instance_id > 0:
             if ((len(valuedict) == len(self.inputdim))
                 and 
@@ -263,6 +887,54 @@ class Data(object):
             if not all(v[0] is None for v in valuedict.values()):
                 self.create_from_many(valuedict)
 
+    def queue_many(self, instance_id, valuedict):
+        """
+        Like save_many, but appends the values to the write-behind queue
+        and updates instdict with unsaved instances. Values are validated 
+        as by save_many before anything is queued. The values the cells 
+        have now are queued with them, see writebehind.
+        """
+        import writebehind
+        cellix = valuedict.keys()[0]
+        rowkey = self.rowkey(self.valuerange_cellindex(cellix))
+        cix    = self.valuerange_cellindex(cellix)
+        empty  = all(v[0] is None for v in valuedict.values())
+        old    = self.instdict.get(cix, None)
+        # the row exists in the database or, unsaved, in the queue
+        exists = instance_id > 0 or old is not None
+        def expected(fieldnames):
+            return dict((fieldname, None if old is None else
+                         writebehind.to_string(getattr(old, fieldname)))
+                        for fieldname in fieldnames)
+
+        if exists and empty and len(valuedict) == len(self.inputdim):
+            fieldnames = [item.fieldname for item in self.inputdim.items
+                          if isinstance(item, InputItem)]
+            self.write_behind.put(self.model, [(rowkey, '', instance_id,
+                                                writebehind.DELETE, None,
+                                                expected(fieldnames))])
+            self.instdict.pop(cix, None)
+        elif exists or not empty:
+            for value, default in valuedict.itervalues():
+                if (value is None and 
+                    default is django.db.models.fields.NOT_PROVIDED):
+                    raise exceptions.ValidationError("Empty input and default value isn't provided")
+
+            entries = []
+            inst = old or self.new_instance(cix)
+            for c, (value, default) in valuedict.iteritems():
+                fieldname = self.inputdim[self.input_index(c)]
+                entries.append((rowkey, fieldname, instance_id, 
+                                writebehind.SET, writebehind.to_string(value),
+                                expected([fieldname])))
+                if (value is None and 
+                    default is not django.db.models.fields.NOT_PROVIDED):
+                    value = default
+                setattr(inst, fieldname, value)
+            self.write_behind.put(self.model, entries)
+            self.instdict[cix] = inst
+        self.changed(cix)
+
     def create(self, cellix, value):
         logger.debug("Creating instance %s" % (str(cellix)))
         instance = self.model()
@@ -286,6 +958,8 @@ class Data(object):
         instance.save()
 
         self.instdict[cellix] = instance # update internal data structure
+        self.changed(self.valuerange_cellindex(cellix))
+        self.record_change(cellix, None, getattr(instance, self.inputdim[fix]))
 
     def create_from_many(self, valuedict):
         logger.debug("Creating instance")
@@ -329,16 +1003,257 @@ class Data(object):
         instance.save()
 
         self.instdict[cellix] = instance # update internal data structure
+        self.changed(self.valuerange_cellindex(cellix))
+        self.record_instance(self.valuerange_cellindex(cellix), instance, {})
 
 
+    def new_instance(self, cix):
+        instance = self.model()
+        for item in self.items_for_cellix(cix):
+            if isinstance(item, ValueItem):
+                setattr(instance, item.fieldname, item.value())
+
+        for field, value in self.fixed_fields:
+            setattr(instance, field, value)
+        return instance
+
+    def bulk_save(self, inputs_by_cix, batch_size=1000):
+        """
+        Saves values of many cells in one transaction. inputs_by_cix maps
+        value range cell indexes to {cellix: value} dicts. Cells that have
+        no instance are created with one bulk insert, the others are
+        updated one by one, saving only the posted fields.
+        """
+        logger.debug("Bulk saving %d instances" % (len(inputs_by_cix)))
+        created = []
+        updated = []
+        fieldnames = set()
+        old_values = {}
+        instances = {}
+        for cix, values in inputs_by_cix.iteritems():
+            instance = self.instdict.get(cix, None)
+            old_values[cix] = self.input_values(instance)
+            if instance is None:
+                instance = self.new_instance(cix)
+                created.append((cix, instance))
+            else:
+                updated.append(instance)
+            instances[cix] = instance
+
+            for cellix, value in values.iteritems():
+                fieldname = self.inputdim[self.input_index(cellix)]
+                setattr(instance, fieldname, value)
+                fieldnames.add(fieldname)
+
+        with self.journaling(), transaction.atomic():
+            if created:
+                self.model.objects.bulk_create([inst for cix, inst in created],
+                                               batch_size=batch_size)
+            self.read_pks([inst for cix, inst in created])
+            for instance in updated:
+                instance.save(update_fields=list(fieldnames))
+            for cix, instance in instances.iteritems():
+                self.record_instance(cix, instance, old_values[cix])
+
+        for cix, instance in created:
+            self.instdict[cix] = instance # update internal data structure
+        for cix in inputs_by_cix:
+            self.changed(cix)
+
+    def natural_key(self):
+        """Fields that identify the instance of a cell"""
+        dims = self.valuerange_rowdims() + self.valuerange_coldims()
+        return ([dim.items[0].fieldname for dim in dims 
+                 if dim.items and isinstance(dim.items[0], ValueItem)]
+                + [fieldname for fieldname, value in self.fixed_fields])
+
+    def instance_key(self, instance):
+        # natural key values of an instance, foreign keys as ids
+        return tuple(getattr(instance, 
+                             get_model_field(self.model, fieldname).attname)
+                     for fieldname in self.natural_key())
+
+    def find_by_key(self, instances, batch_size=300):
+        """
+        Returns {natural key: stored instance} of the rows that have the
+        natural keys of instances, with a query per batch_size instances.
+        """
+        attnames = [get_model_field(self.model, fieldname).attname
+                    for fieldname in self.natural_key()]
+        found = {}
+        for start in range(0, len(instances), batch_size):
+            batch = instances[start:start + batch_size]
+            condition = reduce(operator.or_,
+                               [django.db.models.Q(**dict(zip(
+                                   attnames, self.instance_key(inst))))
+                                for inst in batch])
+            for stored in self.model.objects.filter(condition):
+                found[self.instance_key(stored)] = stored
+        return found
+
+    def read_pks(self, instances):
+        """
+        Sets the pks of instances created with bulk_create, which doesn't
+        set them, by reading them back by natural key.
+        """
+        instances = [inst for inst in instances if inst.pk is None]
+        found = self.find_by_key(instances)
+        for inst in instances:
+            stored = found.get(self.instance_key(inst), None)
+            inst.pk = None if stored is None else stored.pk
+
+    def key_values(self, cix):
+        key = dict((item.fieldname, item.value()) 
+                   for item in self.items_for_cellix(cix)
+                   if isinstance(item, ValueItem))
+        key.update(dict(self.fixed_fields))
+        return key
+
+    def upsert(self, inputs_by_cix, batch_size=1000):
+        """
+        Saves values of many cells keyed on the natural key, regardless of
+        instance ids, in one transaction. Cells that post the same fields
+        are written with one statement per batch, without reading the rows
+        first: INSERT ... ON CONFLICT DO UPDATE on PostgreSQL 9.5+ and 
+        SQLite 3.24+, INSERT ... ON DUPLICATE KEY UPDATE on MySQL. These 
+        need the natural key in the model's unique_together. Otherwise the
+        cells without an instance in instdict are created with bulk_create
+        and the others updated with one CASE UPDATE per batch; a row 
+        inserted or deleted meanwhile by someone else then raises 
+        IntegrityError. Old values of the journal are those of instdict.
+        inputs_by_cix maps value range cell indexes to {cellix: value}.
+        """
+        instances = {}
+        old_values = {}
+        groups = {}
+        for cix, values in inputs_by_cix.iteritems():
+            posted = dict((self.inputdim[self.input_index(cellix)], value)
+                          for cellix, value in values.iteritems())
+            instance = self.instdict.get(cix, None)
+            old_values[cix] = self.input_values(instance)
+            if instance is None:
+                instance = self.new_instance(cix)
+            for fieldname, value in posted.iteritems():
+                setattr(instance, fieldname, value)
+            instances[cix] = instance
+            groups.setdefault(tuple(sorted(posted)), []).append(instance)
+
+        native = self.native_upsert()
+        with self.journaling(), transaction.atomic():
+            for fieldnames, group in groups.iteritems():
+                for start in range(0, len(group), batch_size):
+                    batch = group[start:start + batch_size]
+                    if native:
+                        self.upsert_rows(batch, fieldnames)
+                    else:
+                        self.model.objects.bulk_create(
+                            [inst for inst in batch if inst.pk is None])
+                        self.update_rows([inst for inst in batch 
+                                          if inst.pk is not None], fieldnames)
+            self.read_pks(instances.values())
+            for cix, instance in instances.iteritems():
+                self.record_instance(cix, instance, old_values[cix])
+
+        for cix, instance in instances.iteritems():
+            self.instdict[cix] = instance # update internal data structure
+            self.changed(cix)
+
+    def native_upsert(self):
+        # ON CONFLICT needs a unique constraint on exactly the natural key
+        key = set(self.natural_key())
+        if not any(set(fields) == key 
+                   for fields in self.model._meta.unique_together):
+            return False
+        if connection.vendor == 'mysql':
+            return True
+        if connection.vendor == 'sqlite':
+            return connection.Database.sqlite_version_info >= (3, 24)
+        if connection.vendor == 'postgresql':
+            return connection.pg_version >= 90500
+        return False
+
+    def upsert_rows(self, instances, fieldnames):
+        # inserts the rows of instances, updating fieldnames of the rows
+        # that exist, in as few statements as the backend's limit on query
+        # parameters allows
+        qn = connection.ops.quote_name
+        meta = self.model._meta
+        fields = [field for field in meta.concrete_fields
+                  if not isinstance(field, django.db.models.fields.AutoField)]
+        columns = [get_model_field(self.model, fieldname).column 
+                   for fieldname in fieldnames]
+        if connection.vendor == 'mysql':
+            tail = 'ON DUPLICATE KEY UPDATE ' + ', '.join(
+                '%s = VALUES(%s)' % (qn(column), qn(column)) 
+                for column in columns)
+        else:
+            keys = [get_model_field(self.model, fieldname).column
+                    for fieldname in self.natural_key()]
+            tail = 'ON CONFLICT (%s) DO UPDATE SET %s' % (
+                ', '.join(qn(key) for key in keys),
+                ', '.join('%s = excluded.%s' % (qn(column), qn(column))
+                          for column in columns))
+        row = '(%s)' % ', '.join(['%s'] * len(fields))
+
+        size = max(connection.ops.bulk_batch_size(fields, instances), 1)
+        with connection.cursor() as cursor:
+            for start in range(0, len(instances), size):
+                batch = instances[start:start + size]
+                params = []
+                for inst in batch:
+                    for field in fields:
+                        value = field.pre_save(inst, True)
+                        params.append(field.get_db_prep_save(value, connection))
+                cursor.execute('INSERT INTO %s (%s) VALUES %s %s' % (
+                        qn(meta.db_table), 
+                        ', '.join(qn(field.column) for field in fields),
+                        ', '.join([row] * len(batch)), tail), params)
+
+    def update_rows(self, instances, fieldnames):
+        # one UPDATE of fieldnames of the rows of instances, with a CASE on
+        # the pk per field
+        if not instances: return
+        from django.db.models import Case, When, Value
+        updates = {}
+        for fieldname in fieldnames:
+            field = get_model_field(self.model, fieldname)
+            whens = [When(pk=inst.pk, then=Value(getattr(inst, fieldname)))
+                     for inst in instances]
+            updates[fieldname] = Case(*whens, output_field=field)
+        updated = (self.model.objects
+                   .filter(pk__in=[inst.pk for inst in instances])
+                   .update(**updates))
+        if updated != len(instances):
+            raise IntegrityError("Rows were deleted meanwhile")
+
+    def delete_by_key(self, cixes):
+        """Deletes the instances of cells by natural key, with one query"""
+        if not cixes: return
+        condition = reduce(operator.or_, 
+                           [django.db.models.Q(**self.key_values(cix))
+                            for cix in cixes])
+        old_values = dict((cix, self.input_values(self.instdict.get(cix, None)))
+                          for cix in cixes)
+        with self.journaling():
+            self.model.objects.filter(condition).delete()
+            for cix in cixes:
+                self.record_instance(cix, None, old_values[cix], deleted=True)
+
+        for cix in cixes:
+            self.instdict.pop(cix, None) # update internal data structure
+            self.changed(cix)
+
     def delete(self, cellix, instance_id):
         logger.debug("Deleting instance %d %s" % (instance_id, 
                                                   str(cellix)))
         instance = self.model.objects.get(pk = instance_id)
+        old_values = self.input_values(instance)
         instance.delete()
 
         cix = self.valuerange_cellindex(cellix)
-        self.instdict.pop(cix) # update internal data structure
+        self.instdict.pop(cix, None) # update internal data structure
+        self.changed(cix)
+        self.record_instance(cix, instance, old_values, deleted=True)
 
 
     def update(self, cellix, instance_id, value):
@@ -347,16 +1262,20 @@ class Data(object):
         instance = self.model.objects.get(pk = instance_id)
 
         fix = self.input_index(cellix)
+        old = getattr(instance, self.inputdim[fix])
         setattr(instance, self.inputdim[fix], value)
         instance.save()
+        self.record_change(cellix, old, value)
 
         cix = self.valuerange_cellindex(cellix)
         self.instdict[cix] = instance # update internal data structure
+        self.changed(cix)
 
     def update_from_many(self, instance_id, valuedict):
         logger.debug("Updating instance %d" % (instance_id))
 
         instance = self.model.objects.get(pk = instance_id)
+        old_values = self.input_values(instance)
 
         for cellix, value_and_default in valuedict.iteritems():
             value = value_and_default[0]
@@ -375,15 +1294,338 @@ class Data(object):
 
         cix = self.valuerange_cellindex(cellix)
         self.instdict[cix] = instance # update internal data structure
+        self.changed(cix)
+        self.record_instance(cix, instance, old_values)
+
+
+# ----------------------------------------------------------------------
+# AggregateData is a read-only pivot of a queryset. Row and column
+# dimensions are used as GROUP BY keys and cells are aggregates given 
+# by AggregateItems of the input dimension. The whole table is filled
+# with a single values().annotate() query, and instdict maps cell 
+# indexes to the resulting value dicts instead of model instances.
+# ----------------------------------------------------------------------
+
+class AggregateData(Data):
+    """
+    With snapshot=<path>, the cells are written to a snapshot file (see
+    module snapshot) and later read from it in place, as long as the 
+    table's query and its stamp stay the same. The stamp is computed by
+    snapshot_stamp(queryset) from the restricted queryset, by default 
+    its row count and max pk, which doesn't notice rows that are updated
+    in place: for those, include e.g. Max('updated_at') in the stamp.
+    """
+    read_only = True
 
+    def __init__(self, model, inputdim, instances, rowdims, coldims, **kwargs):
+        self.snapshot_path  = kwargs.get('snapshot', None)
+        self.snapshot_stamp = kwargs.get('snapshot_stamp', default_stamp)
+        Data.__init__(self, model, inputdim, instances, rowdims, coldims,
+                      **kwargs)
+
+    def _create_instdict(self, queryset, rowdims, coldims):
+        # dimensions without field items have no cells to aggregate
+        dims = list(rowdims) + list(coldims)
+        items = [field_items(dim) for dim in dims]
+        if not all(items): return
+
+        keys = [dict((value_key(item.value()), i) for i, item in dimitems)
+                for dimitems in items]
+        # computed items are evaluated from the aggregated rows
+        aggregates = dict((item.name, item.aggregate) 
+                          for item in self.inputdim.items
+                          if isinstance(item, AggregateItem))
+
+        fieldnames = []
+        for dix, dimitems in enumerate(items):
+            queryset, fieldname, keys[dix] = self._restrict(
+                queryset, dimitems, keys[dix])
+            fieldnames.append(fieldname)
+
+        # order_by() clears the default ordering, which would otherwise
+        # be added to the GROUP BY clause
+        rows = queryset.order_by().values(*fieldnames).annotate(**aggregates)
+
+        if self.snapshot_path:
+            with self.probe.phase('snapshot'):
+                signature = self._signature(rows, dims)
+                if signature:
+                    stamp = json.loads(json.dumps(
+                            self.snapshot_stamp(queryset)))
+                    if self._open_snapshot(signature, stamp, 
+                                           rowdims, coldims):
+                        return
+
+        with self.probe.phase('queryset'):
+            rows = list(rows)
+
+        with self.probe.phase('instdict'):
+            self._add_rows(rows, rowdims, fieldnames, keys)
+        self.probe.count('instances', len(rows))
+
+        if self.snapshot_path and signature:
+            with self.probe.phase('snapshot'):
+                self._write_snapshot(signature, stamp, rowdims, coldims)
+
+    def _signature(self, rows, dims):
+        # the query and the order of dimension items, which gives cell ints
+        import hashlib
+        try:
+            sql = unicode(rows.query)
+        except Exception:
+            return None # e.g. EmptyResultSet
+        items = [[repr(value_key(item.value())) for item in dim.items]
+                 for dim in dims]
+        return hashlib.sha1(json.dumps([sql, items]).encode('utf-8')).hexdigest()
+
+    def _open_snapshot(self, signature, stamp, rowdims, coldims):
+        import snapshot
+        try:
+            snap = snapshot.load(self.snapshot_path)
+        except snapshot.SnapshotError as e:
+            logger.warning(u"Ignoring snapshot: %s" % e)
+            return False
+        if snap is None or (snap.signature, snap.stamp) != (signature, stamp):
+            return False
+        self.instdict = SnapshotCells(snap, rowdims, coldims)
+        self.probe.count('snapshot_cells', len(self.instdict))
+        return True
+
+    def _write_snapshot(self, signature, stamp, rowdims, coldims):
+        import snapshot
+        indexer = dimtable.Indexer(coldims, rowdims)
+        names = [item.name for item in self.inputdim.items
+                 if isinstance(item, AggregateItem)]
+        cells = dict((indexer.cellindex_to_int(cix), 
+                      dict((name, row[name]) for name in names))
+                     for cix, row in self.instdict.iteritems())
+        size = dimtable.product(len(dim) 
+                                for dim in list(rowdims) + list(coldims))
+        try:
+            snapshot.write(self.snapshot_path, signature, stamp, size, cells,
+                           names)
+        except (snapshot.SnapshotError, IOError, OSError) as e:
+            logger.warning(u"Can't write snapshot: %s" % e)
+
+    def _restrict(self, queryset, dimitems, dimkeys):
+        # Returns the queryset restricted to the values of a dimension's 
+        # field items (index, item), the name to group by and the keys
+        # mapping its values to item indexes. PeriodItems are restricted 
+        # by date range and grouped by the index of their period.
+        items = [item for i, item in dimitems]
+        fieldname = items[0].fieldname
+        if not all(isinstance(item, PeriodItem) for item in items):
+            return (queryset.filter(**{fieldname + '__in': dimkeys.keys()}),
+                    fieldname, dimkeys)
+
+        granularity = items[0].granularity
+        periods = [item.period() for item in items]
+        queryset = queryset.filter(**{
+                fieldname + '__gte': min(start for start, end in periods),
+                fieldname + '__lt':  max(end for start, end in periods)})
+        field = get_model_field(self.model, fieldname)
+        if (granularity == 'day' and 
+            not isinstance(field, django.db.models.fields.DateTimeField)):
+            return queryset, fieldname, dimkeys
+
+        alias = '%s_%s' % (fieldname, granularity)
+        sql, params = period_case_sql(self.model, field, dimitems)
+        queryset = queryset.extra(select={alias: sql}, select_params=params)
+        return queryset, alias, dict((i, i) for i, item in dimitems)
+
+    def _add_rows(self, rows, rowdims, fieldnames, keys):
+        nrowdims = len(rowdims)
+        for row in rows:
+            ixes = tuple(k[row[f]] for k, f in zip(keys, fieldnames))
+            self.instdict[dimtable.make_cellindex(ixes[:nrowdims], 
+                                                  ixes[nrowdims:])] = row
+
+    def save(self, cellix, instance_id, value):
+        raise ReadOnlyError("AggregateData is read-only")
+
+    def save_many(self, instance_id, valuedict):
+        raise ReadOnlyError("AggregateData is read-only")
+
+    def bulk_save(self, inputs_by_cix, batch_size=1000):
+        raise ReadOnlyError("AggregateData is read-only")
+
+
+def default_stamp(queryset):
+    from django.db.models import Count, Max
+    result = queryset.aggregate(count=Count('pk'), last=Max('pk'))
+    return [result['count'], result['last']]
+
+NUMERIC_FIELDS = (django.db.models.fields.IntegerField,
+                  django.db.models.fields.FloatField,
+                  django.db.models.fields.DecimalField)
+
+def cell_stamp(model, fieldnames, journal_key=None):
+    """
+    Returns a stamp function for querysets of editable tables, which 
+    also changes when cells are updated in place: besides the row count
+    and max pk, the sum of each cell field and its sum weighted by pk, 
+    and with journal_key the last seq of the change journal. Fields that
+    can't be summed need the journal, or a stamp of your own.
+    """
+    from django.db.models import Count, Max, Sum, F
+    fields = [get_model_field(model, fieldname) for fieldname in fieldnames]
+    if journal_key is None and not all(isinstance(field, NUMERIC_FIELDS)
+                                       for field in fields):
+        raise exceptions.ImproperlyConfigured(
+            "Updates of non-numeric cell fields can't be stamped, "
+            "give a journal or a stamp")
+
+    aggregates = {'count': Count('pk'), 'last': Max('pk')}
+    for i, field in enumerate(fields):
+        if isinstance(field, NUMERIC_FIELDS):
+            aggregates['sum%d' % i] = Sum(field.name)
+            aggregates['weighted%d' % i] = Sum(F('pk') * F(field.name),
+                                               output_field=field)
+
+    def stamp(queryset):
+        result = queryset.aggregate(**aggregates)
+        values = [result[name] for name in sorted(result)]
+        if journal_key is not None:
+            import journal
+            values.append(journal.last_seq(journal_key))
+        return values
+    return stamp
+
+class SnapshotCells(object):
+    """
+    instdict of AggregateData that is read from a snapshot.Snapshot. 
+    Rows are looked up by the cell int of the value range dimensions.
+    """
+    def __init__(self, snap, rowdims, coldims):
+        self.snapshot = snap
+        self.indexer  = dimtable.Indexer(coldims, rowdims)
+
+    def get(self, cix, default=None):
+        row = self.snapshot.get(self.indexer.cellindex_to_int(cix))
+        if row is None: return default
+        return row
+
+    def __getitem__(self, cix):
+        row = self.get(cix)
+        if row is None: raise KeyError(cix)
+        return row
+
+    def __contains__(self, cix):
+        return self.get(cix) is not None
+
+    def __iter__(self):
+        return (self.indexer.int_to_cellindex(i) 
+                for i in self.snapshot.cellints())
+
+    def iteritems(self):
+        return ((cix, self[cix]) for cix in self)
+
+    def __len__(self):
+        return self.snapshot.ncells
+
+
+# ----------------------------------------------------------------------
+# Constraints are rules over groups of cells, checked for posted values
+# before anything is saved. Cells that have the same indexes in the
+# row dimensions listed in rows and the column dimensions listed in 
+# cols form a group (None lists all dimensions of the value range), 
+# and check is called with the non-empty values of each group that has
+# posted cells. Values are the posted ones merged over the stored ones.
+#
+#    # at most 60 hours per employee (rowdims[0]) in the table's week
+#    Constraint(lambda vs: sum(vs) <= 60, u"Over 60 hours", rows=[0])
+#    # shares of products of an employee on a day sum up to 100
+#    Constraint(lambda vs: sum(vs) == 100, u"Shares must sum to 100%",
+#               rows=[0], cols=[0])
+#
+# A violated constraint is reported as a CellError on each posted cell
+# of the group. Each input field is checked separately, unless input 
+# names the field to check.
+# ----------------------------------------------------------------------
+
+class Constraint(object):
+    def __init__(self, check, message, rows=(), cols=(), input=None):
+        self.check   = check
+        self.message = message
+        self.rows    = rows
+        self.cols    = cols
+        self.input   = input
+
+    def group_key(self, cix, fix):
+        # cix is a value range cell index
+        rixes, cixes = cix.row_indexes(), cix.col_indexes()
+        rows = range(len(rixes)) if self.rows is None else self.rows
+        cols = range(len(cixes)) if self.cols is None else self.cols
+        return (tuple(rixes[d] for d in rows), 
+                tuple(cixes[d] for d in cols), fix)
+
+def row_constraint(check, message, input=None):
+    return Constraint(check, message, rows=None, input=input)
+
+def column_constraint(check, message, input=None):
+    return Constraint(check, message, cols=None, input=input)
+
+def check_constraints(data, constraints, posted):
+    """
+    Returns {cellix: message} of posted cells in groups that violate 
+    constraints. posted maps cell indexes to validated values.
+    """
+    violations = {}
+    fieldnames = data.inputdim.values()
+    for constraint in constraints:
+        fixes = [fix for fix, fieldname in enumerate(fieldnames)
+                 if constraint.input in (None, fieldname)]
+
+        # groups of posted cells, and posted values by value range cell
+        groups = {}
+        posted_values = {}
+        for cellix, value in posted.iteritems():
+            fix = data.input_index(cellix)
+            if fix not in fixes: continue
+            cix = data.valuerange_cellindex(cellix)
+            key = constraint.group_key(cix, fix)
+            groups.setdefault(key, {'cells': [], 'values': []})
+            groups[key]['cells'].append(cellix)
+            posted_values[(cix, fix)] = value
+
+        if not groups: continue
+        for (cix, fix), value in posted_values.iteritems():
+            if value is not None:
+                groups[constraint.group_key(cix, fix)]['values'].append(value)
+
+        # one pass over the stored cells of the touched groups
+        for cix, inst in data.instdict.iteritems():
+            for fix in fixes:
+                if (cix, fix) in posted_values: continue
+                group = groups.get(constraint.group_key(cix, fix), None)
+                if group is None: continue
+                value = getattr(inst, fieldnames[fix], None)
+                if value is not None:
+                    group['values'].append(value)
+
+        for group in groups.itervalues():
+            try:
+                ok = constraint.check(group['values'])
+            except (TypeError, ArithmeticError):
+                ok = False
+            if not ok:
+                for cellix in group['cells']:
+                    violations.setdefault(cellix, constraint.message)
+    return violations
+
+
+ERROR_LI = html.Template('li')
 
 class Presenter(object):
-    def __init__(self, data, prefix):
+    def __init__(self, data, prefix, constraints=()):
         self.data = data
+        self.constraints = constraints
         #assert all(isinstance(item, InputItem) for item in self.data.inputdim.items)
-        self.cell_fields  = [get_model_field(item.model, item.fieldname)
-                             for item in self.data.inputdim.items 
-                             if isinstance(item, InputItem)]
+        # fields of the input items by fieldname, computed items have none
+        self.cell_fields  = dict((item.fieldname, 
+                                  get_model_field(item.model, item.fieldname))
+                                 for item in self.data.inputdim.items 
+                                 if isinstance(item, InputItem))
         self.cell_errors  = {} # indexed by cellindex
         self.other_errors = []
 
@@ -438,6 +1680,9 @@ class Presenter(object):
         fix = self.data.input_index(cellindex)
         item = self.data.inputdim.items[fix]
 
+        if isinstance(item, ComputedItem):
+            value = self.data.computed_value(cellindex, item)
+            return inst, item.render_value(value)
         return inst, item.render_instance(inst, cellindex)
 
 
@@ -477,22 +1722,24 @@ class Presenter(object):
         return u'\n'.join(output)
 
     def hidden_data_dimvalues(self, prefix):
-        output = ["<!-- BEGIN hidden_data_dimvalues -->"]
+        output = html.Builder()
+        output.raw(u"<!-- BEGIN hidden_data_dimvalues -->")
         def dimension_values(dims, tag):
             for i, dim in enumerate(dims):
                 if not isinstance(dim, InputDim):
                     name  = u"_".join([prefix, tag, 'values', str(i)])
                     value = self.dim_hidden_representations(dim)
-                    output.append(html.hidden_input(name=name, value=value))
+                    output.tag(html.HIDDEN_INPUT, name, value)
 
         dimension_values(self.data.rowdims, 'rdim')
         dimension_values(self.data.coldims, 'cdim')
 
-        output.append("<!-- END hidden_data_dimvalues -->")
-        return u'\n'.join(output)
+        output.raw(u"<!-- END hidden_data_dimvalues -->")
+        return output.getvalue(u'\n')
 
 
     def cell_instance_ids(self):
+        if self.data.read_only: return []
         ids = []
         indexer = dimtable.Indexer(self.data.coldims, self.data.rowdims)
         for cellix, inst in self.data.instdict.iteritems():
@@ -518,13 +1765,13 @@ class Presenter(object):
             for err in self.other_errors:
                 if type(err.messages) == list:
                     for msg in err.messages:
-                        output.append('<li>' + msg + '</li>')
+                        output.append(ERROR_LI.text(msg))
                 else:
-                        output.append('<li>' + str(err.messages) + '</li>')
+                        output.append(ERROR_LI.text(err.messages))
 
             for cellix, err in self.cell_errors.iteritems():
                 for msg in err.messages():
-                    output.append('<li>' + msg + '</li>')
+                    output.append(ERROR_LI.text(msg))
 
             output.append('</ul>')
         return u"\n".join(output)
@@ -543,19 +1790,24 @@ class Presenter(object):
             raise err
         return cellix, instance_id
 
+    def cell_field(self, cellix):
+        item = self.data.inputdim.items[self.data.input_index(cellix)]
+        return self.cell_fields.get(getattr(item, 'fieldname', None), None)
+
     def validate_cell(self, cellix, valuestr):
-        fix = self.data.input_index(cellix)
+        field = self.cell_field(cellix)
+        if field is None:
+            raise exceptions.ValidationError(u"Cell isn't editable")
         value = None
         try:
-            if valuestr or self.cell_fields[fix].empty_strings_allowed:
-                value = self.cell_fields[fix].to_python(valuestr)            
+            if valuestr or field.empty_strings_allowed:
+                value = field.to_python(valuestr)            
         except exceptions.ValidationError, err:
             raise err
         return value
 
     def default_for_cell(self, cellix):
-        fix = self.data.input_index(cellix)
-        return self.cell_fields[fix].default
+        return self.cell_field(cellix).default
 
     def save_cell(self, cellix, instance_id, valuestr):
         try:
@@ -594,7 +1846,18 @@ class Presenter(object):
             
         if had_errors: return 
 
-        self.data.save_many(instance_id, valuedict)
+        try:
+            self.data.save_many(instance_id, valuedict)
+        except exceptions.ValidationError, err:
+            # emptied cells without a default
+            cellixes = [cellix for cellix, (value, default) 
+                        in valuedict.iteritems() if value is None and 
+                        default is django.db.models.fields.NOT_PROVIDED]
+            for cellix in cellixes:
+                self.cell_errors[cellix] = CellError(err, cellix, 
+                                                     inputs[cellix][1])
+            if not cellixes:
+                self.other_errors.append(err)
         #try:
         #    self.data.save_many(instance_id, values)
         # except Exception, err:
@@ -604,6 +1867,64 @@ class Presenter(object):
 
 
 
+    def validate_constraints(self, inputs_by_cix):
+        # Checks constraints against valid posted values, before anything
+        # is saved. Returns False and adds CellErrors on violations.
+        posted = {}
+        errors = {}
+        for inputs in inputs_by_cix.itervalues():
+            for cellix, (instance_id, valuestr) in inputs.iteritems():
+                try:
+                    posted[cellix] = self.validate_cell(cellix, valuestr)
+                except exceptions.ValidationError, err:
+                    errors[cellix] = CellError(err, cellix, valuestr)
+
+        violations = check_constraints(self.data, self.constraints, posted)
+        if not violations:
+            return True # field errors are reported when cells are saved
+
+        for cellix, message in violations.iteritems():
+            cix = self.data.valuerange_cellindex(cellix)
+            valuestr = inputs_by_cix[cix][cellix][1]
+            errors[cellix] = CellError(message, cellix, valuestr)
+        self.cell_errors.update(errors)
+        return False
+
+    def upsert_cells(self, inputs_by_cix):
+        # Validates all cells and saves them with Data.upsert, ignoring
+        # instance ids. Cells of which every input is emptied are deleted.
+        values_by_cix = {}
+        deleted = []
+        for cix, inputs in inputs_by_cix.iteritems():
+            values = {}
+            for cellix, (instance_id, valuestr) in inputs.iteritems():
+                try:
+                    values[cellix] = self.validate_cell(cellix, valuestr)
+                except exceptions.ValidationError, err:
+                    self.cell_errors[cellix] = CellError(err, cellix, valuestr)
+            if len(values) < len(inputs):
+                continue
+
+            if (all(v is None for v in values.itervalues()) and 
+                len(values) == len(self.data.inputdim)):
+                if cix in self.data.instdict: deleted.append(cix)
+                continue
+
+            for cellix, value in values.items():
+                default = self.default_for_cell(cellix)
+                if (value is None and 
+                    default is not django.db.models.fields.NOT_PROVIDED):
+                    values[cellix] = default
+            values_by_cix[cix] = values
+
+        try:
+            with self.data.journaling():
+                if values_by_cix: self.data.upsert(values_by_cix)
+                self.data.delete_by_key(deleted)
+        except IntegrityError:
+            self.other_errors.append(exceptions.ValidationError(
+                    u"The table was changed meanwhile, please save again"))
+
     def fast_td(self, id, content, cssclass = None, title = None):
         # we could use more versatile html.td, but this is a way faster
         classattr = ('class="%s"' % (cssclass)) if cssclass else ''
@@ -632,25 +1953,113 @@ class Presenter(object):
         error = self.cell_errors.get(cellindex, None)
         if error:
             cssclasses.add('error')
-            title = '&#10;'.join(error.messages())
+            title = '&#10;'.join([html.escape(msg) for msg in error.messages()])
             value = error.inputted_value
 
         return self.fast_td(ixstr, 
-                            valuestr,
+                            html.escape(valuestr),
                             cssclass=' '.join(cssclasses),
                             title=title)
 
+    def render_lean_cell(self, cellindex):
+        # cell of a lean table: editability and item classes are given by
+        # the row and the col, only errors are marked on the cell
+        inst, valuestr = self.instance_and_value_string(cellindex)
+        error = self.cell_errors.get(cellindex, None)
+        if error:
+            title = '&#10;'.join([html.escape(msg) for msg in error.messages()])
+            return u''.join([u'<td class="error" title="', title, u'">',
+                             html.escape(valuestr), u'</td>'])
+        return u''.join([u'<td>', html.escape(valuestr), u'</td>'])
+
     def read_instanceids(self, args):
+        # Besides <prefix>_instanceids, drill-down tables post the ids of
+        # each loaded group as <prefix>_instanceids_<group>
         name = u"_".join([self.prefix, "instanceids"]) 
 
+        ids = dict()
         for key, value in args:
-            if key == name:
+            if key == name or key.startswith(name + u'_'):
                 data = value
                 instanceids = json.loads(data)
-                return dict([(p[0], p[1]) for p in instanceids])
-        return dict()
+                ids.update((p[0], p[1]) for p in instanceids)
+        return ids
             
+    def import_rows(self, rows):
+        """
+        Imports rows in the layout of dimtable.Table.export_rows: column
+        header rows first, then one row per table row with row labels
+        followed by cell values. Blank labels continue the previous label
+        (merged layout) and blank cells are left untouched.
+
+        All cells are validated before anything is written. Errors are
+        stored in cell_errors and other_errors, as with save_data.
+        """
+        self.check_writable()
+        rowdims = self.data.rowdims
+        coldims = self.data.coldims
+        row_index = [label_index(dim) for dim in rowdims]
+        col_index = [label_index(dim) for dim in coldims]
+
+        def lookup(index, label, what):
+            try:
+                return index[label]
+            except KeyError:
+                self.other_errors.append(exceptions.ValidationError(
+                        u"Unknown %s label: %s" % (what, label)))
+                return None
+
+        rows = iter(rows)
+        try:
+            header = [rows.next() for dim in coldims]
+        except StopIteration:
+            self.other_errors.append(exceptions.ValidationError(
+                    u"Missing column headers"))
+            return False
+
+        colixes = []
+        current = [None] * len(coldims)
+        for col in range(len(rowdims), max(len(h) for h in header)):
+            for dix, hrow in enumerate(header):
+                label = hrow[col] if col < len(hrow) else u''
+                if label:
+                    current[dix] = lookup(col_index[dix], label, 'column')
+            colixes.append(tuple(current))
+
+        inputs_by_cix = ddict.Ddict(default = dict)
+        current = [None] * len(rowdims)
+        for row in rows:
+            for dix in range(len(rowdims)):
+                if dix < len(row) and row[dix]:
+                    current[dix] = lookup(row_index[dix], row[dix], 'row')
+            rixes = tuple(current)
+
+            for cixes, valuestr in zip(colixes, row[len(rowdims):]):
+                if not valuestr: continue
+                if None in rixes or None in cixes: continue
+
+                cellix = dimtable.make_cellindex(rixes, cixes)
+                try:
+                    value = self.validate_cell(cellix, valuestr)
+                except exceptions.ValidationError, err:
+                    self.cell_errors[cellix] = CellError(err, cellix, valuestr)
+                    continue
+                cix = self.data.valuerange_cellindex(cellix)
+                inputs_by_cix[cix][cellix] = value
+
+        if self.cell_errors or self.other_errors:
+            return False
+
+        self.data.bulk_save(inputs_by_cix)
+        return True
+            
+    def check_writable(self):
+        if self.data.read_only:
+            raise ReadOnlyError("Cells of %s can't be saved" 
+                                % type(self.data).__name__)
+
     def save_data(self, args):
+        self.check_writable()
         inputs_by_cix = ddict.Ddict(default = dict)
 
         instanceids = self.read_instanceids(args)
@@ -674,11 +2083,136 @@ class Presenter(object):
 
                 inputs_by_cix[cix][cellix] = (instance_id, valuestr)
 
-        for cix, inputs in inputs_by_cix.iteritems():
-            self.save_cells(cix, inputs)
+        if self.constraints and not self.validate_constraints(inputs_by_cix):
+            return False
+
+        if self.data.upsert_mode and self.data.write_behind is None:
+            self.upsert_cells(inputs_by_cix)
+            return not (self.cell_errors or self.other_errors)
+
+        with self.data.journaling():
+            for cix, inputs in inputs_by_cix.iteritems():
+                self.save_cells(cix, inputs)
 
         return not (self.cell_errors or self.other_errors)
 
+# ----------------------------------------------------------------------
+# SparseLayout
+# 
+# Data is usually sparse, so in sparse mode Table renders only filled
+# cells (cells with an instance or an error) through Presenter.render_cell.
+# Empty cells are joined from pieces precomputed per column: the id
+# prefix, the cell number and the rest of the td, which depends only on
+# the css classes of the row and column items and on the input item.
+# ----------------------------------------------------------------------
+
+class SparseLayout(object):
+    def __init__(self, table):
+        data = table.data
+        self.prefix  = table.prefix
+        self.rowdims = data.rowdims
+        self.editable = table.editable
+        self.lean    = table.lean
+        self.inputdim = data.inputdim
+        self.single_input = data.is_single_input()
+        self.computed_fixes = set(fix for fix, item 
+                                  in enumerate(self.inputdim.items)
+                                  if isinstance(item, ComputedItem))
+
+        self.cols = []
+        citer = dimtable.DimIter(data.coldims)
+        while not citer.end():
+            self.cols.append(citer.get())
+            citer.next()
+        colints = dict((cixes, c) for c, cixes in enumerate(self.cols))
+
+        self.col_classes = []
+        self.col_editable = []
+        for cixes in self.cols:
+            items = [dim.items[ix] for dim, ix in zip(data.coldims, cixes)]
+            classes = set()
+            for item in items: classes.update(item.css_classes())
+            self.col_classes.append(classes)
+            self.col_editable.append(all(item.editable() for item in items))
+
+        lens = [len(dim) for dim in self.rowdims]
+        self.row_strides = [dimtable.product(lens[i+1:]) 
+                            for i in range(len(lens))]
+
+        # filled column numbers by row indexes, in row-major order
+        filled = {}
+        for cix in data.instdict:
+            c = colints[cix.col_indexes()]
+            if self.single_input:
+                filled.setdefault(cix.row_indexes(), set()).add(c)
+            else:
+                for fix in range(len(self.inputdim)):
+                    rixes = cix.row_indexes() + (fix,)
+                    filled.setdefault(rixes, set()).add(c)
+        for cellix in table.presenter.cell_errors:
+            c = colints[cellix.col_indexes()]
+            filled.setdefault(cellix.row_indexes(), set()).add(c)
+        self.filled = dict((rixes, sorted(cs)) for rixes, cs in filled.iteritems())
+
+        self._tails = {}
+
+    def rowint(self, rixes):
+        return sum(r * stride for r, stride in zip(rixes, self.row_strides))
+
+    def tails(self, rixes):
+        # the part of empty tds after the cell number, per column
+        items = [dim.items[ix] for dim, ix in zip(self.rowdims, rixes)]
+        classes = set()
+        for item in items: classes.update(item.css_classes())
+        editable = self.editable and all(item.editable() for item in items)
+        fix = 0 if self.single_input else rixes[-1]
+
+        key = (frozenset(classes), editable, fix)
+        tails = self._tails.get(key, None)
+        if tails is None:
+            content = html.escape(self.inputdim.items[fix].render_instance(None, None))
+            tails = []
+            for col_classes, col_editable in zip(self.col_classes, 
+                                                 self.col_editable):
+                cssclasses = classes | col_classes
+                if editable and col_editable: cssclasses.add('editable')
+                cssclass = ' '.join(cssclasses)
+                classattr = ('class="%s"' % (cssclass)) if cssclass else ''
+                tails.append(u''.join(['" ', classattr, ' >', content, '</td>']))
+            self._tails[key] = tails
+        return tails
+
+    def row_cells(self, rixes, render_cell):
+        # computed cells may have a value without an instance
+        fix = 0 if self.single_input else rixes[-1]
+        if fix in self.computed_fixes:
+            return [render_cell(dimtable.make_cellindex(rixes, cixes))
+                    for cixes in self.cols]
+
+        if self.lean:
+            # empty cells of lean tables are all alike
+            content = self.inputdim.items[fix].render_instance(None, None)
+            empty = u''.join([u'<td>', html.escape(content), u'</td>'])
+        else:
+            head = u''.join(['<td id="', self.prefix, '_cell_'])
+            tails = self.tails(rixes)
+            base = self.rowint(rixes) * len(self.cols)
+
+        tds = []
+        start = 0
+        for c in self.filled.get(rixes, []) + [len(self.cols)]:
+            # a run of empty cells before the filled one
+            if self.lean:
+                tds.extend([empty] * (c - start))
+            else:
+                tds.extend([u''.join([head, str(base + i), tails[i]]) 
+                            for i in xrange(start, c)])
+            if c < len(self.cols):
+                tds.append(render_cell(dimtable.make_cellindex(rixes, 
+                                                               self.cols[c])))
+            start = c + 1
+        return tds
+
 # ----------------------------------------------------------------------
 # Table
 # ----------------------------------------------------------------------
@@ -691,23 +2225,132 @@ class Table(dimtable.Table):
     def __init__(self,
                  data,
                  **kwargs):
+        kwargs.setdefault('probe', data.probe)
         dimtable.Table.__init__(self, data.coldims, data.rowdims, **kwargs)
         self.data       = data
 
         self.presenter = kwargs.get('presenter', None)
         if self.presenter is None:
-            self.presenter = Presenter(data, self.prefix)
+            self.presenter = Presenter(data, self.prefix, 
+                                       kwargs.get('constraints', ()))
 
         self.editable  = kwargs.get('editable', False)
+        if self.editable and data.read_only:
+            raise ReadOnlyError("Table of read-only data can't be editable")
+
+        # sparse rendering, optionally leaving out rows without any data
+        self.collapse_empty_rows = kwargs.get('collapse_empty_rows', False)
+        self.sparse = kwargs.get('sparse', False) or self.collapse_empty_rows
+        self._sparse_layout = None
 
     # ----------------------------------------------------------------------
     # Access cells
     # ----------------------------------------------------------------------
 
     def cell(self, cellindex):
+        if self.lean:
+            return self.presenter.render_lean_cell(cellindex)
         return self.presenter.render_cell(cellindex, 
                                           prefix   = self.prefix,
                                           editable = self.editable)
+
+    def cell_value(self, cellindex):
+        inst, valuestr = self.presenter.instance_and_value_string(cellindex)
+        return valuestr
+
+    def row_classes(self, rixes):
+        return self.editable_classes(self.rowdims, rixes)
+
+    def col_classes(self, cixes):
+        return self.editable_classes(self.coldims, cixes)
+
+    def editable_classes(self, dims, ixes):
+        classes = dimtable.item_classes(dims, ixes)
+        items = [dim.items[ix] for dim, ix in zip(dims, ixes)]
+        if self.editable and all(item.editable() for item in items):
+            classes.append('editable')
+        return classes
+
+    def row_cells(self, rixes):
+        if self._sparse_layout is None:
+            return dimtable.Table.row_cells(self, rixes)
+        return self._sparse_layout.row_cells(rixes, self.cell)
+    
+    def rows(self):
+        if not self.sparse:
+            return dimtable.Table.rows(self)
+
+        # the layout reflects instdict and errors at the time of rendering
+        self._sparse_layout = SparseLayout(self)
+        try:
+            if self.collapse_empty_rows:
+                return self.filled_rows()
+            return dimtable.Table.rows(self)
+        finally:
+            self._sparse_layout = None
+
+    def group_rows(self, index):
+        """
+        Rows of one item of the outermost row dimension, used by drill-down
+        tables. The outer header is replaced by an empty th, as the group
+        row above the rows shows it.
+        """
+        attrs = {'class': 'group-member', 
+                 'data-group': index, 'data-prefix': self.prefix}
+        rs = []
+        riter = dimtable.DimIter(self.rowdims[1:])
+        dix = 0
+        while not riter.end():
+            rixes = (index,) + riter.get()
+            ths, tds = self.row_parts(dix + 1, rixes)
+            rs.append(html.tr([u'<th></th>'] + ths + tds, **attrs))
+            dix = riter.next()
+        return rs
+
+    def filled_rows(self):
+        displayed = sorted(self._sparse_layout.filled.keys())
+
+        # rowspans count only the displayed rows of each group
+        spans = {}
+        for rixes in displayed:
+            for dix in range(len(rixes)):
+                spans[rixes[:dix+1]] = spans.get(rixes[:dix+1], 0) + 1
+
+        use_groups = len(self.rowdims) > 1
+        rs = []
+        prev = None
+        for i, rixes in enumerate(displayed):
+            dix = 0
+            if prev is not None:
+                while rixes[dix] == prev[dix]: dix += 1
+
+            with self.probe.phase('row_headers'):
+                ths = []
+                for d in range(dix, len(rixes)):
+                    item = self.rowdims[d].items[rixes[d]]
+                    if self.lean:
+                        ths.append(dimtable.lean_th(item.representation(),
+                                                    'rowspan',
+                                                    spans[rixes[:d+1]],
+                                                    item.css_classes()))
+                        continue
+                    ths.append(dimtable.HEADER_TH.text(item.representation(),
+                                                       spans[rixes[:d+1]],
+                                                       u' '.join(item.css_classes())))
+            with self.probe.phase('cells'):
+                tds = self.row_cells(rixes)
+            self.probe.count('cells', len(tds))
+
+            attrs = {}
+            if use_groups:
+                if prev is None or dix == 0:
+                    attrs = {'class': 'first-of-group'}
+                elif (i + 1 == len(displayed) or 
+                      displayed[i + 1][0] != rixes[0]):
+                    attrs = {'class': 'last-of-group'}
+            rs.append(self.render_row(ths + tds, rixes, attrs))
+            prev = rixes
+        return rs
     
 
     # ----------------------------------------------------------------------
@@ -732,32 +2375,181 @@ class Table(dimtable.Table):
 
 
     def render_hidden(self):
-        output = []
-        output.append(self.presenter.hidden_data_instanceids(self.prefix))
-        output.append(self.presenter.hidden_data_dimvalues(self.prefix))
-        output.append(self.presenter.render_fixed_data(self.prefix))
-        return mark_safe(u"\n".join(output))
+        with self.probe.phase('hidden'):
+            output = []
+            output.append(self.presenter.hidden_data_instanceids(self.prefix))
+            output.append(self.presenter.hidden_data_dimvalues(self.prefix))
+            output.append(self.presenter.render_fixed_data(self.prefix))
+            result = u"\n".join(output)
+        if self.probe.enabled:
+            self.probe.count('bytes', len(result.encode('utf-8')))
+        return mark_safe(result)
 
     def render_errors(self):
         return mark_safe(self.presenter.render_errors())
 
     # Renders everything but the form wrapper and submit button
     def as_form(self):
+        with self.probe.report():
+            with counting_queries(self.probe):
+                output = []
+                output.append(self.render_hidden())
+                output.append(self.render_errors())
+                output.append(self.render())
+            return mark_safe(u"\n".join(output))
+
+    # Renders everything but the form wrapper and submit button
+    def as_table(self):
+        return self.render()
+
+    # ----------------------------------------------------------------------
+    # Virtualized rendering
+    #
+    # Instead of a full HTML table, the table is sent as a compact JSON 
+    # payload that dimtable.VirtualTable renders, keeping only the visible
+    # rows and columns in the DOM. Edited cells are posted as the usual
+    # <prefix>_cell_<int> fields, so saving works as with as_form.
+    #
+    # The page carries only the cells of the first window of rows and
+    # columns; VirtualTable fetches the others from virtual_response as 
+    # they are scrolled into view, so computed cells are evaluated only
+    # for windows that are shown.
+    # ----------------------------------------------------------------------
+
+    # rows and columns of a window of virtual_payload
+    virtual_window = (100, 50)
+
+    def virtual_payload(self, rows=None, cols=None):
+        """
+        Labels of all dimensions, and values of the cells in rows
+        rows[0] <= r < rows[1] and columns cols[0] <= c < cols[1] of the 
+        grid. By default the first virtual_window.
+        """
+        def dims_data(dims):
+            return {'labels':   [dim.representations() for dim in dims],
+                    'editable': [[item.editable() for item in dim.items]
+                                 for dim in dims]}
+
+        nrows = dimtable.product(len(dim) for dim in self.rowdims)
+        ncols = dimtable.product(len(dim) for dim in self.coldims)
+        r0, r1 = rows or (0, self.virtual_window[0])
+        c0, c1 = cols or (0, self.virtual_window[1])
+        r0, r1 = max(r0, 0), min(r1, nrows)
+        c0, c1 = max(c0, 0), min(c1, ncols)
+
+        # values of filled cells, and of computed cells, by cell number
+        cells = []
+        computed = [fix for fix, item in enumerate(self.data.inputdim.items)
+                    if isinstance(item, ComputedItem)]
+        for cix in self.data.instdict:
+            for fix in range(len(self.data.inputdim)):
+                if fix in computed: continue
+                cellix = self.full_cellindex(cix, fix)
+                r, c = divmod(self.indexer.cellindex_to_int(cellix), ncols)
+                if r0 <= r < r1 and c0 <= c < c1:
+                    cells.append(self.cell_payload(cellix))
+        if computed:
+            for r in range(r0, r1):
+                rixes = self.indexer.int_to_cellindex(r * ncols).row_indexes()
+                if self.data.input_index(dimtable.make_cellindex(rixes, ())) in computed:
+                    for c in range(c0, c1):
+                        cellix = self.indexer.int_to_cellindex(r * ncols + c)
+                        cells.append(self.cell_payload(cellix))
+
+        errors = []
+        for cellix, err in self.presenter.cell_errors.iteritems():
+            errors.append([self.indexer.cellindex_to_int(cellix),
+                           err.inputted_value, err.messages()])
+
+        return {'prefix':   self.prefix,
+                'editable': self.editable,
+                'rdims':    dims_data(self.rowdims),
+                'cdims':    dims_data(self.coldims),
+                'window':   [r0, r1, c0, c1],
+                'cells':    [c for c in cells if c[1] != u''],
+                'errors':   errors}
+
+    def virtual_response(self, request):
+        """
+        JSON of the cells of the window given by the GET parameters rows
+        and cols as <start>:<stop>, for the url of dimtable.VirtualTable
+        """
+        from django.http import HttpResponse, HttpResponseBadRequest
+        try:
+            rows, cols = [tuple(int(n) for n in request.GET[name].split(':'))
+                          for name in ('rows', 'cols')]
+            assert len(rows) == 2 and len(cols) == 2
+        except (KeyError, ValueError, AssertionError):
+            return HttpResponseBadRequest()
+        payload = self.virtual_payload(rows, cols)
+        return HttpResponse(json.dumps({'window': payload['window'],
+                                        'cells':  payload['cells']}),
+                            content_type = 'application/json')
+
+    def full_cellindex(self, cix, fix):
+        if self.data.is_single_input(): return cix
+        return dimtable.make_cellindex(cix.row_indexes() + (fix,),
+                                       cix.col_indexes())
+
+    def cell_payload(self, cellix):
+        inst, valuestr = self.presenter.instance_and_value_string(cellix)
+        return [self.indexer.cellindex_to_int(cellix), valuestr]
+
+    def render_virtual(self):
+        # </ can't appear inside a script element
+        payload = json.dumps(self.virtual_payload()).replace('</', '<\\/')
+        output = []
+        output.append(self.hidden_data_dimensions(self.prefix))
+        output.append(u'<div class="%s dimtable-virtual" id="%s_grid"></div>' 
+                      % (self.css_class, self.prefix))
+        output.append(u'<script type="application/json" id="%s_payload">%s</script>' 
+                      % (self.prefix, payload))
+        return mark_safe(u"\n".join(output))
+
+    # Like as_form, but with a virtualized grid, see render_js_virtual
+    def as_virtual_form(self):
         output = []
         output.append(self.render_hidden())
         output.append(self.render_errors())
-        output.append(self.render())
+        output.append(self.render_virtual())
         return mark_safe(u"\n".join(output))
 
-    # Renders everything but the form wrapper and submit button
-    def as_table(self):
-        return self.render()
+    # url is that of a view returning virtual_response, without it only
+    # the first window has values
+    def render_js_virtual(self, url=None):
+        return mark_safe(u"""
+$(document).ready(function() {
+   dimtable.VirtualTable(%s); 
+});
+""" % json.dumps({'prefix': self.prefix, 'url': url}).replace('</', '<\\/'))
+
+    def export_response(self, format='csv', filename=None, merged=False):
+        # HttpResponse would join the chunks in memory, and a length isn't
+        # known before the last row, so no Content-Length is set
+        from django.http import StreamingHttpResponse
+        import export
+        if filename is None:
+            filename = '.'.join([self.prefix, format])
+        response = StreamingHttpResponse(
+            self.export(format, stream=True, merged=merged),
+            content_type=export.CONTENT_TYPES[format])
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        return response
+
+    def import_csv(self, fileobj, encoding='utf-8', **fmtparams):
+        import csv
+        rows = ([v.decode(encoding) for v in row] 
+                for row in csv.reader(fileobj, **fmtparams))
+        return self.presenter.import_rows(rows)
 
     def save(self, args):
         prefix = self.prefix + '_'
         table_args = [(key,val) 
                       for key,val in args.iteritems() if key.startswith(prefix)]
-        return self.presenter.save_data(table_args)
+        with self.probe.report():
+            with self.probe.phase('save'):
+                with counting_queries(self.probe):
+                    return self.presenter.save_data(table_args)
             
         
 
@@ -0,0 +1,259 @@
+# ----------------------------------------------------------------------
+# snapshot
+#
+# On-disk snapshots of the cells of read-only tables. A snapshot file
+# has a fixed header, a JSON block of metadata and flat little-endian
+# arrays of 64-bit values, so it can be opened with mmap and read in
+# place: worker processes share one page-cached copy and opening it
+# doesn't depend on the number of cells.
+#
+#    header   magic, version, layout, number of cells, number of cells
+#             of the full range, metadata length
+#    metadata signature and stamp (see modeltable.AggregateData),
+#             column names and types
+#    cells    dense layout: one byte per cell of the full range, 1 for
+#             cells that have values; sparse layout: sorted cell ints
+#    columns  one array per column, in the same order as the cells
+#
+# Columns are 'q' (integers), 'd' (floats) or 'decimal' (integers
+# scaled by 10 ** scale). Missing values are INT_NULL and NaN.
+# ----------------------------------------------------------------------
+
+import os
+import json
+import mmap
+import math
+import struct
+import decimal
+import tempfile
+
+MAGIC   = 'DIMSNAP\0'
+VERSION = 1
+HEADER  = struct.Struct('<8sIIQQQ')
+
+DENSE, SPARSE = 0, 1
+INT_NULL = -2 ** 63
+
+class SnapshotError(Exception):
+    pass
+
+def column_type(values):
+    """Returns (type, scale) of a column, raises SnapshotError for others"""
+    kind, scale = 'q', 0
+    for v in values:
+        if v is None or isinstance(v, bool):
+            continue
+        elif isinstance(v, decimal.Decimal):
+            kind = 'decimal'
+            scale = max(scale, -v.as_tuple().exponent)
+        elif isinstance(v, float):
+            if kind == 'decimal':
+                raise SnapshotError("Column mixes floats and decimals")
+            kind = 'd'
+        elif not isinstance(v, (int, long)):
+            raise SnapshotError("Can't store %r in a snapshot" % (v,))
+    return kind, scale
+
+def encode(v, kind, scale):
+    if kind == 'd':
+        return float('nan') if v is None else float(v)
+    if v is None:
+        return INT_NULL
+    if kind == 'decimal':
+        return int(v.scaleb(scale))
+    return int(v)
+
+def decode(v, kind, scale):
+    if kind == 'd':
+        return None if math.isnan(v) else v
+    if v == INT_NULL:
+        return None
+    if kind == 'decimal':
+        return decimal.Decimal(v).scaleb(-scale)
+    return v
+
+def write(path, signature, stamp, size, cells, names=None):
+    """
+    Writes a snapshot of cells, a dict {cell int: {column: value}}, where
+    cell ints are in range(size). names are the columns, by default the
+    names found in cells; give them so that an empty snapshot has them.
+    The file is written next to path and renamed over it, so readers 
+    never see a partial snapshot.
+    """
+    names = sorted(set(names or ()) | 
+                   set(name for row in cells.itervalues() for name in row))
+    types = [column_type(row.get(name) for row in cells.itervalues())
+             for name in names]
+    layout = DENSE if len(cells) * 4 >= size else SPARSE
+
+    meta = json.dumps({'signature': signature,
+                       'stamp': stamp,
+                       'columns': [[name, kind, scale] for name, (kind, scale)
+                                   in zip(names, types)]})
+    meta += ' ' * (-(HEADER.size + len(meta)) % 8) # align the arrays
+
+    # dense columns have a slot for every cell int, sparse ones for ints
+    ints = sorted(cells)
+    if layout == DENSE:
+        flags = bytearray(size)
+        for i in ints: flags[i] = 1
+        index = bytes(flags) + '\0' * (-size % 8)
+        slots = xrange(size)
+    else:
+        index = struct.pack('<%dq' % len(ints), *ints)
+        slots = ints
+    empty = {}
+
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, layout, len(ints), size,
+                                len(meta)))
+            f.write(meta)
+            f.write(index)
+            for name, (kind, scale) in zip(names, types):
+                fmt = '<%d%s' % (len(slots), 'd' if kind == 'd' else 'q')
+                values = [cells.get(i, empty).get(name) for i in slots]
+                f.write(struct.pack(fmt, *[encode(v, kind, scale)
+                                           for v in values]))
+        os.rename(tmppath, path)
+    except:
+        os.remove(tmppath)
+        raise
+
+
+class Snapshot(object):
+    """
+    Read-only view of a snapshot file. Cells are looked up from the
+    mmapped file, nothing is copied when the snapshot is opened.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mm) < HEADER.size:
+            raise SnapshotError("Truncated snapshot %s" % path)
+        magic, version, layout, ncells, size, metalen = \
+            HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError("Not a version %d snapshot: %s"
+                                % (VERSION, path))
+
+        meta = json.loads(self._mm[HEADER.size:HEADER.size + metalen])
+        self.signature = meta['signature']
+        self.stamp     = meta['stamp']
+        self.columns   = [tuple(c) for c in meta['columns']]
+        self.layout    = layout
+        self.ncells    = ncells
+        self.size      = size
+
+        self._index_offset = HEADER.size + metalen
+        if layout == DENSE:
+            self._nslots = size
+            index_length = size + (-size % 8)
+        else:
+            self._nslots = ncells
+            index_length = 8 * ncells
+        offset = self._index_offset + index_length
+        self._column_offsets = []
+        for name, kind, scale in self.columns:
+            self._column_offsets.append(offset)
+            offset += 8 * self._nslots
+        if len(self._mm) < offset:
+            raise SnapshotError("Truncated snapshot %s" % path)
+
+    def _slot(self, cellint):
+        # position of the cell in the column arrays, or None
+        if not 0 <= cellint < self.size:
+            return None
+        if self.layout == DENSE:
+            if self._mm[self._index_offset + cellint] == '\0':
+                return None
+            return cellint
+
+        lo, hi = 0, self.ncells
+        unpack, offset = struct.unpack_from, self._index_offset
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if unpack('<q', self._mm, offset + 8 * mid)[0] < cellint:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.ncells and unpack('<q', self._mm,
+                                       offset + 8 * lo)[0] == cellint:
+            return lo
+        return None
+
+    def get(self, cellint):
+        """Returns {column: value} of a cell, or None for an empty cell"""
+        slot = self._slot(cellint)
+        if slot is None:
+            return None
+        row = {}
+        for (name, kind, scale), offset in zip(self.columns,
+                                               self._column_offsets):
+            fmt = '<d' if kind == 'd' else '<q'
+            value = struct.unpack_from(fmt, self._mm, offset + 8 * slot)[0]
+            row[name] = decode(value, kind, scale)
+        return row
+
+    def cellints(self):
+        if self.layout == DENSE:
+            offset = self._index_offset
+            flags = self._mm[offset:offset + self.size]
+            return [i for i, flag in enumerate(flags) if flag != '\0']
+        return list(struct.unpack_from('<%dq' % self.ncells, self._mm,
+                                       self._index_offset))
+
+    def arrays(self):
+        """
+        Returns (cell ints, {column: values}) of the filled cells as NumPy
+        arrays, values as floats with NaN for missing values. The arrays
+        are computed from views of the mmapped file.
+        """
+        import numpy
+        if self.layout == DENSE:
+            flags = numpy.frombuffer(self._mm, numpy.uint8, self.size,
+                                     self._index_offset)
+            ints = numpy.flatnonzero(flags)
+        else:
+            ints = numpy.frombuffer(self._mm, '<i8', self.ncells,
+                                    self._index_offset)
+
+        columns = {}
+        for (name, kind, scale), offset in zip(self.columns,
+                                               self._column_offsets):
+            raw = numpy.frombuffer(self._mm, '<f8' if kind == 'd' else '<i8',
+                                   self._nslots, offset)
+            if self.layout == DENSE:
+                raw = raw[ints]
+            if kind == 'd':
+                columns[name] = raw
+                continue
+            values = raw.astype(float)
+            values[raw == INT_NULL] = numpy.nan
+            if kind == 'decimal':
+                values /= 10 ** scale
+            columns[name] = values
+        return ints.astype(numpy.int64), columns
+
+    def close(self):
+        self._mm.close()
+
+
+# Opened snapshots are kept per process, a snapshot that is replaced by
+# write has a new inode and is opened again
+_open = {}
+
+def load(path):
+    """Returns the Snapshot of path, or None if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (st.st_ino, st.st_mtime, st.st_size)
+    cached = _open.get(path)
+    if cached is None or cached[0] != key:
+        cached = (key, Snapshot(path))
+        _open[path] = cached
+    return cached[1]
@@ -0,0 +1,344 @@
+# ----------------------------------------------------------------------
+# writebehind
+#
+# Write-behind saving of cell edits. A Data with write_behind=SaveQueue
+# doesn't save validated cells to the model table, but appends them to
+# a local SQLite queue, and a background Worker flushes the queue to the
+# database in batches:
+#
+#    queue = writebehind.SaveQueue('/var/lib/dimtable/queue.db')
+#    writebehind.Worker(queue).start()
+#    ...
+#    table = Table(model, celldim, rowdims, coldims, write_behind=queue)
+#
+# Cells are identified by a natural key: the values of the dimension
+# fields and fixed fields of the cell. Queued writes of the same cell
+# and input field are coalesced, the last write wins. Each write gets a
+# new sequence number, and flushing removes only the entries it has
+# written, so a write that arrives during a flush is kept for the next.
+#
+# Until the queue is flushed, Data loaded with the same queue shows the
+# pending values on top of the instances read from the database.
+#
+# Several processes may flush one queue file. A flush first claims its
+# rows in one UPDATE, so no two flushes apply the same rows, and it
+# doesn't claim rows of a cell that another flush has in flight. A write
+# of a cell in flight is queued beside the claimed one, with the values
+# its editor saw (which include the in-flight write) as expected values.
+# If a flush fails, or its process dies and its claim is older than
+# claim_timeout, its rows go back to the queue.
+#
+# Each write also records the value the cell had when it was edited (the
+# first one, when writes are coalesced). A row is applied only if the
+# database still has those values, so a change made meanwhile by someone
+# else isn't overwritten. Rows are applied one by one, each in its own
+# savepoint: a row that conflicts or fails, e.g. on a unique constraint,
+# is moved to the dead_letters table with its error instead of blocking
+# the rows after it. Errors that aren't about the row, such as a lost
+# database connection, abort the flush and it's retried later.
+# ----------------------------------------------------------------------
+
+import json
+import time
+import uuid
+import logging
+import sqlite3
+import datetime
+import threading
+import contextlib
+
+logger = logging.getLogger('dimtable.writebehind')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cells (
+    seq         INTEGER PRIMARY KEY AUTOINCREMENT,
+    model       TEXT NOT NULL,
+    rowkey      TEXT NOT NULL,
+    fieldname   TEXT NOT NULL,
+    instance_id INTEGER,
+    op          TEXT NOT NULL,
+    value       TEXT,
+    expected    TEXT NOT NULL,
+    claimed     TEXT NOT NULL DEFAULT '',
+    claimed_at  REAL,
+    UNIQUE (model, rowkey, fieldname, claimed) ON CONFLICT REPLACE
+);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    seq         INTEGER PRIMARY KEY,
+    model       TEXT NOT NULL,
+    rowkey      TEXT NOT NULL,
+    fieldname   TEXT NOT NULL,
+    instance_id INTEGER,
+    op          TEXT NOT NULL,
+    value       TEXT,
+    expected    TEXT NOT NULL,
+    error       TEXT NOT NULL,
+    failed_at   TEXT NOT NULL
+);
+"""
+
+COLUMNS = 'seq, model, rowkey, fieldname, instance_id, op, value, expected'
+
+SET, DELETE = 'set', 'delete'
+
+class Conflict(Exception):
+    """The row was changed in the database after the write was queued"""
+    pass
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+def to_string(value):
+    return None if value is None else unicode(value)
+
+
+class SaveQueue(object):
+    """
+    claim_timeout is the age in seconds after which rows claimed by a 
+    flush are taken to be left by a dead process, and should be longer 
+    than any flush takes.
+    """
+    def __init__(self, path, claim_timeout=600):
+        self.path = path
+        self.claim_timeout = claim_timeout
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def connect(self):
+        # a connection per use, as connections can't be shared by threads.
+        # The connection's own context manager commits but doesn't close.
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def put(self, model, entries):
+        """
+        Appends writes of a model, entries is a list of
+        (rowkey, fieldname, instance id, op, value, expected) where rowkey
+        is a dict {fieldname: value string}, value a string or None and
+        expected {fieldname: value string or None} of the values the row 
+        had when it was edited. A write that replaces a queued one keeps 
+        the expected values of the queued one, unless that one is being
+        flushed.
+        """
+        label = model_label(model)
+        rows = []
+        for rowkey, fieldname, instance_id, op, value, expected in entries:
+            rowkey = json.dumps(rowkey, sort_keys=True)
+            rows.append((label, rowkey, fieldname, instance_id or 0, op, 
+                         value, label, rowkey, fieldname, 
+                         json.dumps(expected, sort_keys=True)))
+        with self.connect() as conn:
+            conn.executemany(
+                "INSERT INTO cells (model, rowkey, fieldname, instance_id, "
+                "op, value, expected) VALUES (?, ?, ?, ?, ?, ?, "
+                "COALESCE((SELECT expected FROM cells WHERE model = ? AND "
+                "rowkey = ? AND fieldname = ? AND claimed = ''), ?))", rows)
+
+    def pending(self, model):
+        """Queued writes of a model as (rowkey, fieldname, op, value)"""
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT rowkey, fieldname, op, value FROM cells "
+                "WHERE model = ? ORDER BY seq", (model_label(model),))
+            return [(json.loads(rowkey), fieldname, op, value)
+                    for rowkey, fieldname, op, value in rows]
+
+    def __len__(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM cells").fetchone()[0]
+
+    def dead_letters(self):
+        """Writes that failed, as dicts of the queued columns and error"""
+        with self.connect() as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(
+                    "SELECT * FROM dead_letters ORDER BY seq")]
+
+    def flush(self, batch_size=1000):
+        """
+        Writes up to batch_size queued cells to the database, returns the
+        number of cells taken from the queue, written or dead.
+        """
+        claim = uuid.uuid4().hex
+        with self.connect() as conn:
+            now = time.time()
+            for (stale,) in conn.execute(
+                "SELECT DISTINCT claimed FROM cells WHERE claimed != '' "
+                "AND claimed_at < ?", (now - self.claim_timeout,)).fetchall():
+                logger.warning(u"Releasing the rows of a stale flush")
+                release(conn, stale)
+            conn.execute(
+                "UPDATE cells SET claimed = ?, claimed_at = ? WHERE seq IN ("
+                "SELECT seq FROM cells WHERE claimed = '' AND NOT EXISTS ("
+                "SELECT 1 FROM cells AS c WHERE c.claimed != '' AND "
+                "c.model = cells.model AND c.rowkey = cells.rowkey) "
+                "ORDER BY seq LIMIT ?)", (claim, now, batch_size))
+            entries = conn.execute(
+                "SELECT %s FROM cells WHERE claimed = ? ORDER BY seq" 
+                % COLUMNS, (claim,)).fetchall()
+        if not entries:
+            return 0
+
+        try:
+            dead = self._apply(entries)
+        except BaseException:
+            with self.connect() as conn:
+                release(conn, claim)
+            raise
+
+        failed_at = datetime.datetime.utcnow().isoformat()
+        with self.connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO dead_letters (%s, error, failed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % COLUMNS,
+                [entry + (failed_at,) for entry in dead])
+            conn.execute("DELETE FROM cells WHERE claimed = ?", (claim,))
+        return len(entries)
+
+    def _apply(self, entries):
+        # Applies claimed entries, returns the dead ones with their errors.
+        # Entries are in the order of writes, so a delete drops the values
+        # written before it and values written after it create a new row.
+        rows = {}
+        order = []
+        for entry in entries:
+            seq, label, rowkey, fieldname, instance_id, op, value, expected \
+                = entry
+            row = rows.get((label, rowkey), None)
+            if row is None:
+                row = rows[(label, rowkey)] = {
+                    'instance_id': instance_id, 'op': SET, 'values': {},
+                    'expected': {}, 'entries': []}
+                order.append((label, rowkey))
+            row['entries'].append(entry)
+            row['instance_id'] = instance_id or row['instance_id']
+            for name, old in json.loads(expected).iteritems():
+                row['expected'].setdefault(name, old)
+            if op == DELETE:
+                row['op'] = DELETE
+                row['values'] = {}
+            else:
+                row['op'] = SET
+                row['values'][fieldname] = value
+
+        from django.apps import apps
+        from django.db import transaction, IntegrityError, DataError
+        from django.core.exceptions import ValidationError
+        dead = []
+        with transaction.atomic():
+            for label, rowkey in order:
+                row = rows[(label, rowkey)]
+                try:
+                    with transaction.atomic():
+                        apply_row(apps.get_model(label), json.loads(rowkey), 
+                                  row)
+                except (Conflict, IntegrityError, DataError, ValidationError,
+                        LookupError, ValueError, TypeError), err:
+                    error = u'%s: %s' % (type(err).__name__, err)
+                    logger.warning(u"Dead write of %s %s: %s" 
+                                   % (label, rowkey, error))
+                    dead.extend(entry + (error,) for entry in row['entries'])
+        return dead
+
+
+def release(conn, claim):
+    """
+    Returns the rows of a claim to the queue. A write queued beside a 
+    claimed row replaces it, but with the claimed row's expected values,
+    as that row was never applied.
+    """
+    same_cell = ("c.model = cells.model AND c.rowkey = cells.rowkey AND "
+                 "c.fieldname = cells.fieldname")
+    conn.execute(
+        "UPDATE cells SET expected = (SELECT c.expected FROM cells AS c "
+        "WHERE c.claimed = ? AND %s) WHERE claimed = '' AND EXISTS ("
+        "SELECT 1 FROM cells AS c WHERE c.claimed = ? AND %s)" 
+        % (same_cell, same_cell), (claim, claim))
+    conn.execute(
+        "DELETE FROM cells WHERE claimed = ? AND EXISTS (SELECT 1 FROM "
+        "cells AS c WHERE c.claimed = '' AND %s)" % same_cell, (claim,))
+    conn.execute("UPDATE cells SET claimed = '', claimed_at = NULL "
+                 "WHERE claimed = ?", (claim,))
+
+
+def parse_rowkey(model, rowkey):
+    # {fieldname: value string} -> {attname: value}
+    import modeltable
+    result = {}
+    for fieldname, s in rowkey.iteritems():
+        field = modeltable.get_model_field(model, fieldname)
+        # ForeignKey.to_python of Django 1.8 returns the string as is
+        target = field.rel.get_related_field() if field.rel else field
+        result[field.attname] = target.to_python(s)
+    return result
+
+def parse_value(model, fieldname, value):
+    import modeltable
+    field = modeltable.get_model_field(model, fieldname)
+    if value is None:
+        if field.has_default(): return field.get_default()
+        return None
+    return field.to_python(value)
+
+def check_expected(instance, expected):
+    # raises Conflict if the row's values aren't the ones that were edited
+    for fieldname, old in sorted(expected.iteritems()):
+        current = (None if instance is None 
+                   else to_string(getattr(instance, fieldname)))
+        if current != old:
+            raise Conflict(u"%s is %s, expected %s" % (fieldname, current, old))
+
+def apply_row(model, rowkey, row):
+    """Applies the coalesced writes of a row, see SaveQueue.flush"""
+    key = parse_rowkey(model, rowkey)
+    manager = model._default_manager
+    instance = None
+    if row['instance_id']:
+        instance = manager.filter(pk=row['instance_id']).first()
+    if instance is None:
+        instance = manager.filter(**key).first()
+    check_expected(instance, row['expected'])
+
+    if row['op'] == DELETE:
+        if instance is not None: instance.delete()
+        return
+
+    if instance is None:
+        instance = model(**key)
+    for fieldname, value in row['values'].iteritems():
+        setattr(instance, fieldname, parse_value(model, fieldname, value))
+    instance.save()
+
+
+class Worker(threading.Thread):
+    """Daemon thread that flushes a SaveQueue every interval seconds"""
+    def __init__(self, queue, interval=1.0, batch_size=1000):
+        threading.Thread.__init__(self, name='dimtable-writebehind')
+        self.daemon = True
+        self.queue = queue
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+
+    def run(self):
+        from django.db import connection, close_old_connections
+        while not self._stopped.is_set():
+            # Django closes connections at the end of requests, which this
+            # thread has none of: drop broken and expired ones here
+            close_old_connections()
+            try:
+                # a full batch means that there's more to write right away
+                while self.queue.flush(self.batch_size) == self.batch_size:
+                    pass
+            except Exception:
+                logger.exception("Flushing the save queue failed")
+            self._stopped.wait(self.interval)
+        connection.close()
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,15 @@
+# Settings for running benchmarks against an in-memory SQLite database:
+#
+#    python manage.py benchmark_dimtable --settings=benchmark_settings
+
+from settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3', 
+        'NAME': ':memory:',
+    }
+}
+
+# the change journal's table, for the tests
+INSTALLED_APPS = INSTALLED_APPS + ('dimtable',)
@@ -0,0 +1,185 @@
+# ----------------------------------------------------------------------
+# Benchmarks for loading, rendering and saving dimtables, using the ex1
+# models and synthetic data. Run them with
+#
+#    python manage.py benchmark_dimtable --settings=benchmark_settings
+#
+# Each scenario measures wall time, query count and peak memory growth
+# (peak resident set size over the size before the phase, Linux only) of
+# - data:              building Data (querying and creating instdict)
+# - render:            Table.render
+# - as_form:           Table.as_form (render + hidden metadata)
+# - cell_instance_ids: Presenter.cell_instance_ids
+# - save_data:         Table.save with every filled cell edited
+# ----------------------------------------------------------------------
+
+import time
+import json
+import random
+import datetime
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from models import *
+from dimtable.django_dimtable import Model, Table, Dim
+from management.commands.create_ex1_data import (create_employees,
+                                                 create_products,
+                                                 create_sales)
+
+PHASES = ['data', 'render', 'as_form', 'cell_instance_ids', 'save_data']
+
+# employees x products x days gives the table size
+SCENARIOS = [
+    dict(name='small',         employees=10,  products=3,  days=7,   density=0.2),
+    dict(name='week-sparse',   employees=200, products=10, days=7,   density=0.05),
+    dict(name='week-dense',    employees=200, products=10, days=7,   density=0.8),
+    dict(name='year-sparse',   employees=50,  products=3,  days=365, density=0.05),
+    dict(name='year-1-rowdim', employees=150, products=1,  days=365, density=0.05,
+         rowdims=1),
+]
+
+QUICK_SCENARIOS = ['small', 'week-sparse']
+
+# Differences below these are noise, not regressions
+MIN_SLACK = {'ms': 1.0, 'peak_kb': 1024}
+
+def memory_kb():
+    # (peak, current) resident set size in kB
+    status = dict(line.split(':', 1) for line in open('/proc/self/status'))
+    return int(status['VmHWM'].split()[0]), int(status['VmRSS'].split()[0])
+
+def reset_peak_memory():
+    # Sets the peak to the current size (Linux 4.0+), so that each phase
+    # gets its own peak. ru_maxrss can't be reset: it's the peak of the 
+    # whole process and doesn't grow in phases after the largest one.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+def measure(fn):
+    # CaptureQueriesContext records queries also when DEBUG is off
+    queries = CaptureQueriesContext(connection)
+    mem_before = memory_kb()[1] if reset_peak_memory() else None
+    start = time.time()
+    with queries:
+        result = fn()
+    elapsed = time.time() - start
+    stats = {'ms':        round(elapsed * 1000, 1),
+             'queries':   len(queries),
+             'peak_kb':   (None if mem_before is None 
+                           else memory_kb()[0] - mem_before)}
+    return result, stats
+
+def populate(scenario, seed=0):
+    DailySale.objects.all().delete()
+    Employee.objects.all().delete()
+    Product.objects.all().delete()
+
+    random.seed(seed)
+    employees = create_employees(scenario['employees'])
+    products  = create_products(scenario['products'])
+    dates     = dates_for(scenario)
+    create_sales(employees, products, dates, scenario['density'])
+
+def dates_for(scenario):
+    first = datetime.date(2012, 1, 1)
+    return [first + datetime.timedelta(x) for x in xrange(scenario['days'])]
+
+def build_table(scenario):
+    employees = list(Employee.objects.all())
+    products  = list(Product.objects.all())
+    dates     = dates_for(scenario)
+
+    sales = DailySale.objects.filter(date__gte = dates[0],
+                                     date__lte = dates[-1])
+    model = Model(sales)
+    rowdims = [Dim(model.valueitems('employee', employees))]
+    if scenario.get('rowdims', 2) > 1:
+        rowdims.append(Dim(model.valueitems('product', products)))
+    else:
+        sales = sales.filter(product = products[0])
+        model = Model(sales)
+
+    return Table(model = model,
+                 celldim = Dim([model.cellitem('amount')]),
+                 rowdims = rowdims,
+                 coldims = [Dim(model.valueitems('date', dates))],
+                 editable = True,
+                 fixed_fields = ([] if scenario.get('rowdims', 2) > 1
+                                 else [('product', products[0])]))
+
+def save_args(table):
+    args = {}
+    ids = table.presenter.cell_instance_ids()
+    args['_'.join([table.prefix, 'instanceids'])] = json.dumps(ids)
+    for cellint, instance_id in ids:
+        args['_'.join([table.prefix, 'cell', str(cellint)])] = str(cellint % 97)
+    return args
+
+def run_scenario(scenario):
+    populate(scenario)
+    results = {}
+    table, results['data'] = measure(lambda: build_table(scenario))
+    _, results['render'] = measure(table.render)
+    _, results['as_form'] = measure(table.as_form)
+    _, results['cell_instance_ids'] = measure(table.presenter.cell_instance_ids)
+    args = save_args(table)
+    _, results['save_data'] = measure(lambda: table.save(args))
+    return results
+
+def run(scenarios, repeat=1):
+    """
+    Runs the scenarios and returns {scenario: {phase: stats}}. With
+    repeat > 1, the fastest time of the runs is kept.
+    """
+    results = {}
+    for scenario in scenarios:
+        best = None
+        for i in xrange(repeat):
+            current = run_scenario(scenario)
+            if best is None:
+                best = current
+            else:
+                for phase in PHASES:
+                    if current[phase]['ms'] < best[phase]['ms']:
+                        best[phase] = current[phase]
+        results[scenario['name']] = best
+    return results
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compares results to a baseline. Returns a list of (scenario, phase,
+    metric, baseline value, current value) for metrics that got worse
+    by more than tolerance (a fraction) and more than MIN_SLACK. Query 
+    counts must not grow at all. Unmeasured (None) values are skipped.
+    """
+    regressions = []
+    for name, phases in sorted(results.iteritems()):
+        for phase, stats in sorted(phases.iteritems()):
+            old = baseline.get(name, {}).get(phase, None)
+            if old is None: continue
+            for metric, value in sorted(stats.iteritems()):
+                if value is None or old.get(metric) is None: continue
+                limit = old[metric]
+                if metric != 'queries':
+                    limit += max(old[metric] * tolerance, MIN_SLACK[metric])
+                if value > limit:
+                    regressions.append((name, phase, metric, old[metric], value))
+    return regressions
+
+def format_results(results):
+    lines = ['%-16s %-18s %10s %8s %10s' % ('scenario', 'phase', 'ms',
+                                           'queries', 'peak kB')]
+    for name, phases in sorted(results.iteritems()):
+        for phase in PHASES:
+            stats = phases[phase]
+            peak = '-' if stats['peak_kb'] is None else stats['peak_kb']
+            lines.append('%-16s %-18s %10.1f %8d %10s' % (name, phase,
+                                                          stats['ms'],
+                                                          stats['queries'],
+                                                          peak))
+    return '\n'.join(lines)
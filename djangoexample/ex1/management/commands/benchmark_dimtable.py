@@ -0,0 +1,57 @@
+import json
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ex1 import benchmark
+
+class Command(BaseCommand):
+    help = ('Benchmark loading, rendering and saving of dimtables. '
+            'Use --settings=benchmark_settings for an in-memory database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                            help='Run only these scenarios')
+        parser.add_argument('--repeat', type=int, default=3,
+                    help='Run each scenario this many times, keep the best')
+        parser.add_argument('--quick', action='store_true', default=False,
+                    help='Run only the small scenarios')
+        parser.add_argument('--baseline', default=None,
+                    help='JSON file of earlier results to compare against')
+        parser.add_argument('--save-baseline', default=None,
+                    help='Write the results as JSON to this file')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                    help='Allowed slowdown against the baseline (fraction)')
+
+    def handle(self, *args, **options):
+        if connection.settings_dict['NAME'] == ':memory:':
+            call_command('migrate', interactive=False, verbosity=0)
+
+        args = options['scenarios']
+        scenarios = benchmark.SCENARIOS
+        if args:
+            scenarios = [s for s in scenarios if s['name'] in args]
+        elif options['quick']:
+            scenarios = [s for s in scenarios 
+                         if s['name'] in benchmark.QUICK_SCENARIOS]
+        if not scenarios:
+            raise CommandError("No such scenarios: %s" % ', '.join(args))
+
+        results = benchmark.run(scenarios, repeat=options['repeat'])
+        self.stdout.write(benchmark.format_results(results) + '\n')
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = benchmark.compare(results, baseline, 
+                                            options['tolerance'])
+            for name, phase, metric, old, new in regressions:
+                self.stdout.write('REGRESSION %s %s %s: %s -> %s\n' % 
+                                  (name, phase, metric, old, new))
+            if regressions:
+                raise CommandError("%d regressions against %s" % 
+                                   (len(regressions), options['baseline']))
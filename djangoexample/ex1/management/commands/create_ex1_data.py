@@ -1,22 +1,63 @@
 import random
+import datetime
 from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
 from ex1.models import *
 
+FIRSTS = [u"Juhani", u'Ville', u'Andy', u'Tommi', u'Teemu']
+LASTS  = [u'Virtanen', u'Johnson', u'Tikkanen']
+PRODUCTS = ['iPhone 4S', 'Nokia N9', 'Galaxy S']
+
+def created_since(model, last):
+    # bulk_create doesn't set pks, the new rows are the ones after last
+    return list(model.objects.filter(pk__gt = last or 0).order_by('pk'))
+
+def last_pk(model):
+    return model.objects.aggregate(last = Max('pk'))['last']
+
+def create_employees(n):
+    last = last_pk(Employee)
+    Employee.objects.bulk_create([Employee(first_name = random.choice(FIRSTS),
+                                           last_name  = random.choice(LASTS))
+                                  for i in xrange(n)])
+    return created_since(Employee, last)
+
+def create_products(n):
+    names = [PRODUCTS[i] if i < len(PRODUCTS) else 'Product %d' % i 
+             for i in xrange(n)]
+    last = last_pk(Product)
+    Product.objects.bulk_create([Product(name = name) for name in names])
+    return created_since(Product, last)
+
+def create_sales(employees, products, dates, density):
+    """
+    Creates a DailySale for each (employee, product, date) with 
+    probability density, i.e. density=0.05 fills 5% of the cells.
+    """
+    sales = [DailySale(date = d, employee = e, product = p, 
+                       amount = random.randint(1, 100))
+             for e in employees for p in products for d in dates
+             if random.random() < density]
+    DailySale.objects.bulk_create(sales, batch_size = 500)
+    return len(sales)
+
 class Command(BaseCommand):
-    args = ''
-    help = 'Create a few employees and products' 
+    help = 'Create employees, products and optionally random daily sales' 
+
+    def add_arguments(self, parser):
+        parser.add_argument('--employees', type=int, default=10)
+        parser.add_argument('--products', type=int, default=3)
+        parser.add_argument('--days', type=int, default=0,
+                    help='Create sales for this many days starting today')
+        parser.add_argument('--density', type=float, default=0.2,
+                    help='Fraction of table cells that have a sale')
+        parser.add_argument('--seed', type=int, default=None)
+
     def handle(self, *args, **options):
-        firsts = [u"Juhani", u'Ville', u'Andy', u'Tommi', u'Teemu']
-        lasts  = [u'Virtanen', u'Johnson', u'Tikkanen']
-        
-        for i in xrange(10):
-            e = Employee.objects.create(first_name = random.choice(firsts),
-                                        last_name  = random.choice(lasts))
-            e.save()
-            
-        for p in ['iPhone 4S', 'Nokia N9', 'Galaxy S']:
-            p = Product.objects.create(name = p)
-            p.save()
-        
-
- 
+        random.seed(options['seed'])
+        employees = create_employees(options['employees'])
+        products  = create_products(options['products'])
+
+        today = datetime.date.today()
+        dates = [today + datetime.timedelta(x) for x in xrange(options['days'])]
+        create_sales(employees, products, dates, options['density'])
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def drop_duplicates(apps, schema_editor):
+    # Keeps the last row of each cell, so that the unique constraint can
+    # be added to tables that have duplicates
+    DailySale = apps.get_model('ex1', 'DailySale')
+    duplicates = (DailySale.objects.order_by()
+                  .values('date', 'employee', 'product')
+                  .annotate(rows=Count('id'), last=Max('id'))
+                  .filter(rows__gt=1))
+    for cell in duplicates:
+        (DailySale.objects.filter(date=cell['date'], 
+                                  employee=cell['employee'],
+                                  product=cell['product'])
+         .exclude(id=cell['last']).delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ex1', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='dailysale',
+            unique_together=set([('date', 'employee', 'product')]),
+        ),
+    ]
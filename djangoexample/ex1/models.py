@@ -25,3 +25,8 @@ class DailySale(models.Model):
     employee    = models.ForeignKey(Employee)
     product     = models.ForeignKey(Product)
     amount      = models.IntegerField()
+
+    class Meta:
+        # natural key of a cell, keeps concurrent upserts from inserting
+        # duplicates (see upsert=True of tables)
+        unique_together = ('date', 'employee', 'product')
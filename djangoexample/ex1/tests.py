@@ -1,16 +1,1031 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+# ----------------------------------------------------------------------
+# Tests of dimtable against the ex1 models. Run them with
+#
+#    python manage.py test ex1.tests --settings=benchmark_settings
+# ----------------------------------------------------------------------
 
-Replace this with more appropriate tests for your application.
-"""
+import json
+import datetime
+import StringIO
+import unittest
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.db.models import Sum, Count
 
+from models import *
+import benchmark
+from dimtable import modeltable, instrument
+from dimtable import django_dimtable
+from dimtable.django_dimtable import Model, Table, PivotTable, Dim
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+D0 = datetime.date(2020, 1, 6) # a Monday
+
+def installed(module):
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+class SalesTestCase(TestCase):
+    """
+    Two employees, two products and three days of sales, with a sale of
+    5 by the first employee of the first product on the first day.
+    """
+    def setUp(self):
+        self.employees = [Employee.objects.create(first_name=u'E%d' % i,
+                                                  last_name=u'L')
+                          for i in range(2)]
+        self.products = [Product.objects.create(name=u'P%d' % i)
+                         for i in range(2)]
+        self.dates = [D0 + datetime.timedelta(i) for i in range(3)]
+        self.sale = DailySale.objects.create(date=self.dates[0],
+                                             employee=self.employees[0],
+                                             product=self.products[0],
+                                             amount=5)
+
+    def table(self, **kwargs):
+        # employees x products as rows, dates as columns
+        model = Model(DailySale.objects.all())
+        kwargs.setdefault('prefix', 'table')
+        return Table(model=model, celldim=Dim([model.cellitem('amount')]),
+                     rowdims=[Dim(model.valueitems('employee', self.employees)),
+                              Dim(model.valueitems('product', self.products))],
+                     coldims=[Dim(model.valueitems('date', self.dates))],
+                     **kwargs)
+
+    def post(self, table, values):
+        # a POST of {cell int: value}, with the instance ids of the form
+        args = {table.prefix + '_instanceids':
+                json.dumps(table.presenter.cell_instance_ids())}
+        for cellint, value in values.iteritems():
+            args['%s_cell_%d' % (table.prefix, cellint)] = value
+        return args
+
+    def amounts(self):
+        return sorted(DailySale.objects.values_list('employee', 'product',
+                                                    'date', 'amount'))
+
+
+class ExportTest(SalesTestCase):
+    def test_csv(self):
+        lines = self.table().export('csv', stream=False).splitlines()
+        self.assertEqual(lines[0], ',,2020-01-06,2020-01-07,2020-01-08')
+        self.assertEqual(lines[1], 'E0 L,P0,5,,')
+        self.assertEqual(len(lines), 5)
+
+    def test_merged_headers(self):
+        lines = self.table().export('csv', stream=False, merged=True)
+        self.assertEqual(lines.splitlines()[2], ',P1,,,')
+
+    def test_response_is_streamed(self):
+        response = self.table().export_response('csv')
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="table.csv"')
+        self.assertEqual(''.join(response.streaming_content),
+                         self.table().export('csv', stream=False))
+
+
+class ImportTest(SalesTestCase):
+    def import_csv(self, replace):
+        csv = self.table().export('csv', stream=False)
+        for old, new in replace:
+            csv = csv.replace(old, new)
+        table = self.table(editable=True)
+        return table, table.import_csv(StringIO.StringIO(csv))
+
+    def test_round_trip(self):
+        # updates the existing sale and creates two new ones
+        table, ok = self.import_csv([('E0 L,P0,5,,', 'E0 L,P0,6,7,'),
+                                     ('E1 L,P1,,,', 'E1 L,P1,,,8')])
+        self.assertTrue(ok)
+        e0, e1 = self.employees
+        p0, p1 = self.products
+        self.assertEqual(self.amounts(), [(e0.pk, p0.pk, self.dates[0], 6),
+                                          (e0.pk, p0.pk, self.dates[1], 7),
+                                          (e1.pk, p1.pk, self.dates[2], 8)])
+        self.assertEqual(DailySale.objects.get(pk=self.sale.pk).amount, 6)
+        # created instances get their pks
+        stored = set(DailySale.objects.values_list('pk', flat=True))
+        self.assertEqual(set(inst.pk for inst in table.data.instdict.values()),
+                         stored)
+        self.assertEqual(self.table().export('csv', stream=False),
+                         table.export('csv', stream=False))
+
+    def test_invalid_values_write_nothing(self):
+        table, ok = self.import_csv([('E0 L,P0,5,,', 'E0 L,P0,6,x,')])
+        self.assertFalse(ok)
+        self.assertEqual(len(table.presenter.cell_errors), 1)
+        self.assertEqual(DailySale.objects.get().amount, 5)
+
+    def test_unknown_labels(self):
+        table, ok = self.import_csv([('E1 L,P1', 'E9 L,P1')])
+        self.assertFalse(ok)
+        self.assertEqual(len(table.presenter.other_errors), 1)
+
+
+class BulkSaveTest(SalesTestCase):
+    def test_new_and_existing_rows(self):
+        table = self.table(editable=True, journal='sales')
+        data = table.data
+        inputs = {}
+        for cellint, value in [(0, 6), (1, 7), (11, 2)]:
+            cellix = table.indexer.int_to_cellindex(cellint)
+            inputs[data.valuerange_cellindex(cellix)] = {cellix: value}
+        data.bulk_save(inputs)
+        e0, e1 = self.employees
+        p0, p1 = self.products
+        self.assertEqual(self.amounts(), [(e0.pk, p0.pk, self.dates[0], 6),
+                                          (e0.pk, p0.pk, self.dates[1], 7),
+                                          (e1.pk, p1.pk, self.dates[2], 2)])
+        self.assertEqual(data.instdict[data.valuerange_cellindex(
+                    table.indexer.int_to_cellindex(0))].pk, self.sale.pk)
+        self.assertTrue(all(inst.pk for inst in data.instdict.values()))
+        self.assertEqual(sorted(change[1:] for change in data.changes_since(0)),
+                         [(0, u'5', u'6'), (1, None, u'7'), (11, None, u'2')])
+
+
+class PivotTest(SalesTestCase):
+    def setUp(self):
+        SalesTestCase.setUp(self)
+        e0, e1 = self.employees
+        p0, p1 = self.products
+        DailySale.objects.create(date=self.dates[0], employee=e0, product=p1,
+                                 amount=2)
+        DailySale.objects.create(date=self.dates[2], employee=e1, product=p1,
+                                 amount=3)
+
+    def pivot(self, rowitems, **kwargs):
+        model = Model(DailySale.objects.all())
+        celldim = Dim([model.aggregateitem('total', Sum('amount')),
+                       model.aggregateitem('sales', Count('pk'))])
+        return PivotTable(model, celldim, [Dim(rowitems)],
+                          [Dim(model.valueitems('date', self.dates))], 
+                          prefix='pivot', **kwargs)
+
+    def test_one_grouped_query(self):
+        model = Model(DailySale.objects.all())
+        with self.assertNumQueries(1):
+            table = self.pivot(model.valueitems('employee', self.employees))
+        cells = dict((cix, (row['total'], row['sales']))
+                     for cix, row in table.data.instdict.iteritems())
+        self.assertEqual(sorted(cells.values()), [(3, 1), (7, 2)])
+        self.assertIn(u'id="pivot_cell_0"  >7</td>', table.render())
+
+    def test_custom_items_stay_empty(self):
+        model = Model(DailySale.objects.all())
+        items = (model.valueitems('employee', self.employees) 
+                 + [modeltable.CustomItem(u'All')])
+        table = self.pivot(items)
+        self.assertEqual(len(table.data.instdict), 2)
+        self.assertFalse(any(cix.row_indexes() == (2,)
+                             for cix in table.data.instdict))
+
+    def test_read_only(self):
+        model = Model(DailySale.objects.all())
+        items = model.valueitems('employee', self.employees)
+        self.assertRaises(modeltable.ReadOnlyError,
+                          self.pivot, items, editable=True)
+        table = self.pivot(items)
+        self.assertRaises(modeltable.ReadOnlyError, 
+                          table.save, {'pivot_cell_0': '1'})
+        self.assertEqual(DailySale.objects.count(), 3)
+
+
+class DimFromFieldTest(SalesTestCase):
+    def setUp(self):
+        SalesTestCase.setUp(self)
+        django_dimtable.field_dims.clear()
+        e0, e1 = self.employees
+        DailySale.objects.create(date=self.dates[1], employee=e1,
+                                 product=self.products[0], amount=1)
+
+    def test_limit_in_query(self):
+        e0, e1 = self.employees
+        e0.last_name = u'M'
+        e0.save()
+        with self.assertNumQueries(1):
+            dim = Model(DailySale.objects.all()).dim_from_field('employee',
+                                                                limit=1)
+        self.assertEqual([item.value() for item in dim.items], [e1])
+
+    def test_shared_by_models(self):
+        dim = Model(DailySale.objects.all()).dim_from_field('employee')
+        with self.assertNumQueries(0):
+            again = Model(DailySale.objects.all()).dim_from_field('employee')
+        self.assertIs(again, dim)
+        other = Model(DailySale.objects.filter(amount=1))
+        self.assertEqual(len(other.dim_from_field('employee').items), 1)
+
+    def test_dropped_on_save(self):
+        dim = Model(DailySale.objects.all()).dim_from_field('product')
+        self.assertEqual(len(dim.items), 1)
+        DailySale.objects.create(date=self.dates[2], employee=self.employees[0],
+                                 product=self.products[1], amount=1)
+        dim = Model(DailySale.objects.all()).dim_from_field('product')
+        self.assertEqual(len(dim.items), 2)
+
+
+class SparseRenderTest(SalesTestCase):
+    def assertSameRender(self, **kwargs):
+        dense = self.table(**kwargs)
+        sparse = self.table(sparse=True, **kwargs)
+        self.assertEqual(sparse.render(), dense.render())
+        return dense, sparse
+
+    def test_read_only(self):
+        self.assertSameRender()
+
+    def test_editable(self):
+        self.assertSameRender(editable=True)
+
+    def test_lean(self):
+        self.assertSameRender(editable=True, lean=True)
+
+    def test_cell_errors(self):
+        dense, sparse = self.assertSameRender(editable=True)
+        dense.save(self.post(dense, {4: 'x', 0: '6'}))
+        sparse.save(self.post(sparse, {4: 'x', 0: '6'}))
+        self.assertEqual(len(sparse.presenter.cell_errors), 1)
+        self.assertEqual(sparse.render(), dense.render())
+
+    def test_collapse_empty_rows(self):
+        html = self.table(collapse_empty_rows=True).render()
+        self.assertEqual(html.count(u'<tr'), 2) # header and E0 L / P0
+        self.assertNotIn(u'E1 L', html)
+
+
+class BenchmarkTest(TestCase):
+    def test_run(self):
+        results = benchmark.run([benchmark.SCENARIOS[0]])
+        stats = results['small']
+        self.assertEqual(sorted(stats), sorted(benchmark.PHASES))
+        self.assertEqual(stats['render']['queries'], 0)
+        self.assertTrue(stats['save_data']['queries'] > 0)
+
+    def test_compare(self):
+        old = {'small': {'render': {'ms': 100.0, 'queries': 2,
+                                    'peak_kb': None}}}
+        new = {'small': {'render': {'ms': 130.0, 'queries': 2,
+                                    'peak_kb': 5000}}}
+        self.assertEqual(benchmark.compare(new, old),
+                         [('small', 'render', 'ms', 100.0, 130.0)])
+        new['small']['render'].update(ms=110.0, queries=3)
+        self.assertEqual(benchmark.compare(new, old),
+                         [('small', 'render', 'queries', 2, 3)])
+
+
+class InstrumentTest(SalesTestCase):
+    def setUp(self):
+        SalesTestCase.setUp(self)
+        self.probes = []
+        instrument.add_listener(self.listen)
+
+    def tearDown(self):
+        instrument.remove_listener(self.listen)
+
+    def listen(self, probe):
+        self.probes.append((probe.name, dict(probe.timings), 
+                            dict(probe.counts)))
+
+    def test_counts_queries_without_debug(self):
+        from django.conf import settings
+        self.assertFalse(settings.DEBUG)
+        table = self.table(editable=True)
+        table.render()
+        table.save(self.post(table, {0: '6'}))
+        render, save = [counts for name, timings, counts in self.probes]
+        self.assertEqual(render['queries'], 1) # the table's queryset
+        self.assertEqual(render['instances'], 1)
+        self.assertEqual(save['queries'], 2) # get and update
+
+
+class LazyImportTest(TestCase):
+    def test_optional_subsystems_not_loaded(self):
+        # a fresh interpreter, since other tests load them
+        import os, sys, subprocess
+        code = ('import sys; from dimtable import modeltable; '
+                'print(",".join(m for m in ("writebehind", "journal", '
+                '"snapshot", "labelcache", "export") '
+                'if "dimtable." + m in sys.modules or m in sys.modules))')
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='benchmark_settings')
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        self.assertEqual(output.strip(), '')
+
+
+class CompactObjectsTest(SalesTestCase):
+    def test_items_have_no_dict(self):
+        model = Model(DailySale.objects.all())
+        for item in (model.valueitems('date', self.dates)[0],
+                     model.cellitem('amount'), modeltable.CustomItem(u'All')):
+            self.assertFalse(hasattr(item, '__dict__'))
+
+    def test_index_tuples_are_shared(self):
+        DailySale.objects.create(date=self.dates[1],
+                                 employee=self.employees[0],
+                                 product=self.products[0], amount=1)
+        first, second = sorted(self.table().data.instdict)
+        self.assertIs(first.row_indexes(), second.row_indexes())
+
+    def test_cell_error_keeps_messages_only(self):
+        table = self.table(editable=True)
+        table.save(self.post(table, {0: 'x'}))
+        error, = table.presenter.cell_errors.values()
+        self.assertFalse(hasattr(error, '__dict__'))
+        self.assertEqual(len(error.messages()), 1)
+        self.assertEqual(error.inputted_value, 'x')
+
+
+class HtmlTest(SalesTestCase):
+    def test_escape(self):
+        from dimtable import html
+        from django.utils.safestring import mark_safe
+        self.assertEqual(html.escape(u'<a href="x">&\'</a>'),
+                         u'&lt;a href=&quot;x&quot;&gt;&amp;&#39;&lt;/a&gt;')
+        self.assertEqual(html.escape(mark_safe(u'<b>')), u'<b>')
+        self.assertEqual(html.escape(5), u'5')
+
+    def test_template(self):
+        from dimtable import html
+        th = html.Template('th', ('rowspan', 'class'), scope='row')
+        self.assertEqual(th.text(u'Smith & Co', 2, 'first'),
+                         u'<th scope="row" rowspan="2" class="first">'
+                         u'Smith &amp; Co</th>')
+        self.assertEqual(html.hidden_input('a"b', u'<'),
+                         u'<input type="hidden" name="a&quot;b" value="&lt;" />')
+
+    def test_labels_and_values_are_escaped(self):
+        product = self.products[0]
+        product.name = u'<script>'
+        product.save()
+        html = self.table(editable=True).render()
+        self.assertNotIn(u'<script>', html)
+        self.assertIn(u'&lt;script&gt;', html)
+
+
+class SpanTest(SalesTestCase):
+    def test_spans(self):
+        table = self.table()
+        self.assertEqual([table.rowspan(i) for i in range(2)], [2, 1])
+        self.assertEqual(table.colspan(0), 1)
+        self.assertEqual(table.colrepeat(0), 1)
+        html = table.render()
+        self.assertEqual(html.count(u'rowspan="2"'), 2)
+
+    def test_cell_index_round_trip(self):
+        indexer = self.table().indexer
+        for i in range(12):
+            cix = indexer.int_to_cellindex(i)
+            self.assertEqual(indexer.cellindex_to_int(cix), i)
+        self.assertEqual(indexer.int_to_cellindex(5).row_indexes(), (0, 1))
+
+
+class TableGroupTest(SalesTestCase):
+    def add(self, group, queryset, product):
+        model = Model(queryset)
+        group.add(model, Dim([model.cellitem('amount')]),
+                  [Dim(model.valueitems('employee', self.employees))],
+                  [Dim(model.valueitems('date', self.dates))],
+                  prefix='p%d' % product.pk, fixed_fields=[('product', product)])
+
+    def test_same_queryset_is_shared(self):
+        p0, p1 = self.products
+        DailySale.objects.create(date=self.dates[1], employee=self.employees[1],
+                                 product=p1, amount=3)
+        group = django_dimtable.TableGroup()
+        self.add(group, DailySale.objects.all(), p0)
+        self.add(group, DailySale.objects.all(), p1)
+        with self.assertNumQueries(1):
+            t0, t1 = group.tables()
+        self.assertEqual([inst.amount for inst in t0.data.instdict.values()],
+                         [5])
+        self.assertEqual([inst.amount for inst in t1.data.instdict.values()],
+                         [3])
+
+    def test_different_querysets_are_not(self):
+        p0, p1 = self.products
+        group = django_dimtable.TableGroup()
+        self.add(group, DailySale.objects.filter(product=p0), p0)
+        self.add(group, DailySale.objects.filter(product=p1), p1)
+        with self.assertNumQueries(2):
+            group.tables()
+
+
+class ComputedTest(SalesTestCase):
+    def setUp(self):
+        SalesTestCase.setUp(self)
+        self.evaluated = []
+
+    def double(self, cell):
+        # tables trace the names an expression reads once, with a TraceRef
+        if isinstance(cell, modeltable.CellRef):
+            self.evaluated.append(cell)
+        return cell['amount'] * 2
+
+    def table(self, **kwargs):
+        model = Model(DailySale.objects.all())
+        return Table(model=model, 
+                     celldim=Dim([model.cellitem('amount'),
+                                  model.computeditem('double', self.double)]),
+                     rowdims=[Dim(model.valueitems('employee', self.employees)),
+                              Dim(model.valueitems('product', self.products))],
+                     coldims=[Dim(model.valueitems('date', self.dates))],
+                     prefix='table', **kwargs)
+
+    def test_render(self):
+        html = self.table().render()
+        self.assertIn(u'id="table_cell_3"  >10</td>', html)
+        # one evaluation per rendered computed cell, empty ones included
+        self.assertEqual(len(self.evaluated), 12)
+
+    def test_virtual_payload_window(self):
+        table = self.table()
+        payload = table.virtual_payload((0, 2), (0, 2))
+        self.assertEqual(payload['window'], [0, 2, 0, 2])
+        self.assertEqual(payload['cells'], [[0, u'5'], [3, u'10']])
+        self.assertEqual(len(self.evaluated), 2)
+
+        payload = table.virtual_payload((2, 4), (0, 3))
+        self.assertEqual(payload['cells'], [])
+        self.assertEqual(len(self.evaluated), 5)
+
+    def test_virtual_response(self):
+        from django.test import RequestFactory
+        table = self.table()
+        factory = RequestFactory()
+        response = table.virtual_response(factory.get('/', {'rows': '1:2', 
+                                                            'cols': '0:9'}))
+        self.assertEqual(json.loads(response.content),
+                         {'window': [1, 2, 0, 3], 'cells': [[3, u'10']]})
+        response = table.virtual_response(factory.get('/', {'rows': '1'}))
+        self.assertEqual(response.status_code, 400)
+
+    def test_first_window_in_page(self):
+        table = self.table()
+        table.virtual_window = (1, 3)
+        html = table.render_virtual()
+        self.assertIn(u'"window": [0, 1, 0, 3]', html)
+        self.assertEqual(self.evaluated, [])
+
+    def test_edit_is_shown(self):
+        table = self.table(editable=True)
+        table.save(self.post(table, {0: '6'}))
+        self.assertIn(u'id="table_cell_3"  >12</td>', self.table().render())
+
+
+rendered = []
+
+def render_employee(employee):
+    rendered.append(employee.pk)
+    return employee.last_name
+
+class LabelCacheTest(SalesTestCase):
+    def setUp(self):
+        SalesTestCase.setUp(self)
+        from dimtable import labelcache
+        self.labelcache = labelcache
+        labelcache.enable(maxsize=100)
+        del rendered[:]
+
+    def tearDown(self):
+        self.labelcache.disable()
+
+    def labels(self):
+        model = Model(DailySale.objects.all())
+        items = model.valueitems('employee', self.employees, 
+                                 renderer=render_employee)
+        return Dim(items).representations()
+
+    def test_cached_across_tables(self):
+        self.assertEqual(self.labels(), [u'L', u'L'])
+        self.assertEqual(len(rendered), 2)
+        self.assertEqual(self.labels(), [u'L', u'L'])
+        self.assertEqual(len(rendered), 2)
+
+    def test_dropped_on_save(self):
+        self.labels()
+        e0 = self.employees[0]
+        e0.last_name = u'M'
+        e0.save()
+        self.assertEqual(self.labels(), [u'M', u'L'])
+        self.assertEqual(rendered, [e0.pk, self.employees[1].pk, e0.pk])
+
+    def test_eviction(self):
+        cache = self.labelcache.LRUCache(1)
+        cache.set('a', 1, ('model', 1))
+        cache.set('b', 2, ('model', 2))
+        self.assertRaises(KeyError, cache.get, 'a')
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache._by_instance, {('model', 2): set(['b'])})
+
+
+class DrilldownTest(SalesTestCase):
+    def drilldown(self):
+        model = Model(DailySale.objects.all())
+        return django_dimtable.DrilldownTable(
+            model, Dim([model.cellitem('amount')]),
+            [Dim(model.valueitems('employee', self.employees)),
+             Dim(model.valueitems('product', self.products))],
+            [Dim(model.valueitems('date', self.dates))],
+            aggregate=Sum('amount'), prefix='dd', editable=True)
+
+    def test_groups(self):
+        html = self.drilldown().render()
+        self.assertEqual(html.count(u'class="group collapsed"'), 2)
+        self.assertNotIn(u'dd_cell_', html)
+        rows = self.drilldown().group_data(0)['rows']
+        self.assertIn(u'id="dd_cell_0"', rows)
+        self.assertNotIn(u'id="dd_cell_6"', rows) # first of the second group
+
+    def test_save_loaded_group(self):
+        drill = self.drilldown()
+        args = {'dd_instanceids': 
+                    json.dumps(drill.table.presenter.cell_instance_ids()),
+                'dd_instanceids_0': drill.group_data(0)['instanceids'],
+                'dd_cell_0': '6', 'dd_cell_4': '2'}
+        self.assertTrue(self.drilldown().save(args))
+        e0 = self.employees[0]
+        p0, p1 = self.products
+        self.assertEqual(self.amounts(), [(e0.pk, p0.pk, self.dates[0], 6),
+                                          (e0.pk, p1.pk, self.dates[1], 2)])
+
+    def test_js_uses_prefix(self):
+        js = self.drilldown().render_js('/groups')
+        self.assertIn(u'dimtable.EditableTable({"prefix": "dd"})', js)
+        self.assertIn(u'dimtable.Drilldown({"prefix": "dd"', js)
+
+
+class DateDimTest(SalesTestCase):
+    def setUp(self):
+        SalesTestCase.setUp(self)
+        e0, e1 = self.employees
+        p0, p1 = self.products
+        DailySale.objects.create(date=self.dates[2], employee=e0, product=p1,
+                                 amount=2)
+        DailySale.objects.create(date=datetime.date(2020, 2, 3), employee=e0,
+                                 product=p0, amount=4)
+
+    def pivot(self, periods):
+        model = Model(DailySale.objects.all())
+        celldim = Dim([model.aggregateitem('total', Sum('amount'))])
+        return PivotTable(model, celldim, 
+                          [Dim(model.valueitems('employee', self.employees))],
+                          [periods], prefix='pivot')
+
+    def totals(self, table):
+        return sorted((cix.row_indexes() + cix.col_indexes(), row['total'])
+                      for cix, row in table.data.instdict.iteritems())
+
+    def test_months(self):
+        model = Model(DailySale.objects.all())
+        months = model.date_dim('date', D0, datetime.date(2020, 2, 10), 'month')
+        self.assertEqual(len(months.items), 2)
+        with self.assertNumQueries(1):
+            table = self.pivot(months)
+        self.assertEqual(self.totals(table), [((0, 0), 7), ((0, 1), 4)])
+        self.assertFalse(months.items[0].editable())
+
+    def test_zoom(self):
+        model = Model(DailySale.objects.all())
+        months = model.date_dim('date', D0, datetime.date(2020, 2, 10), 'month')
+        start, end, level = months.items[0].zoom()
+        self.assertEqual((start, end, level), 
+                         (datetime.date(2020, 1, 1), datetime.date(2020, 1, 31),
+                          'week'))
+        weeks = model.date_dim('date', start, end, level)
+        self.assertEqual(weeks.items[1].value(), D0)
+        self.assertEqual(self.totals(self.pivot(weeks)), [((0, 1), 7)])
+        days = model.date_dim('date', D0, D0, 'day')
+        self.assertTrue(days.items[0].editable())
+
+
+class SnapshotTest(SalesTestCase):
+    def setUp(self):
+        SalesTestCase.setUp(self)
+        import tempfile, shutil
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = self.dir + '/sales.snap'
+
+    def pivot(self):
+        model = Model(DailySale.objects.all())
+        celldim = Dim([model.aggregateitem('total', Sum('amount'))])
+        return PivotTable(model, celldim, 
+                          [Dim(model.valueitems('employee', self.employees))],
+                          [Dim(model.valueitems('date', self.dates))],
+                          prefix='pivot', snapshot=self.path)
+
+    def test_read_from_snapshot(self):
+        import os
+        html = self.pivot().render()
+        self.assertTrue(os.path.exists(self.path))
+        with self.assertNumQueries(1): # the stamp
+            table = self.pivot()
+        self.assertIsInstance(table.data.instdict, modeltable.SnapshotCells)
+        self.assertEqual(table.render(), html)
+
+    def test_new_rows_rebuild(self):
+        self.pivot()
+        DailySale.objects.create(date=self.dates[1], 
+                                 employee=self.employees[1],
+                                 product=self.products[0], amount=3)
+        table = self.pivot()
+        self.assertNotIsInstance(table.data.instdict, modeltable.SnapshotCells)
+        self.assertEqual(len(table.data.instdict), 2)
+        self.assertEqual(len(self.pivot().data.instdict), 2)
+
+    def test_broken_snapshot_is_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('garbage')
+        import logging
+        warnings = []
+        handler = logging.Handler()
+        handler.emit = warnings.append
+        logger = logging.getLogger('dimtable')
+        logger.addHandler(handler)
+        try:
+            table = self.pivot()
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(len(table.data.instdict), 1)
+        self.assertEqual(len(warnings), 1)
+
+
+@unittest.skipUnless(installed('numpy'), "numpy isn't installed")
+class ArrayTest(SalesTestCase):
+    def test_dense(self):
+        import numpy
+        values, labels = self.table().data.to_numpy()
+        self.assertEqual(values.shape, (2, 2, 3))
+        self.assertEqual(values[0, 0, 0], 5)
+        self.assertEqual(numpy.isnan(values).sum(), 11)
+        self.assertEqual(list(labels[2]), [unicode(d) for d in self.dates])
+
+    def test_sparse(self):
+        (ints, values), labels = self.table().data.to_numpy(sparse=True)
+        self.assertEqual(list(ints), [0])
+        self.assertEqual(list(values), [5.0])
+
+    def test_empty_snapshot(self):
+        import tempfile, shutil
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        model = Model(DailySale.objects.filter(amount=0))
+        def pivot():
+            return PivotTable(model, 
+                              Dim([model.aggregateitem('total', Sum('amount'))]),
+                              [Dim(model.valueitems('employee', self.employees))],
+                              [Dim(model.valueitems('date', self.dates))],
+                              snapshot=path + '/empty.snap')
+        pivot()
+        table = pivot()
+        self.assertIsInstance(table.data.instdict, modeltable.SnapshotCells)
+        (ints, values), labels = table.data.to_numpy(sparse=True)
+        self.assertEqual((len(ints), len(values)), (0, 0))
+
+    @unittest.skipUnless(installed('pyarrow'), "pyarrow isn't installed")
+    def test_arrow(self):
+        arrow = self.table().data.to_arrow()
+        self.assertEqual(arrow.column_names, 
+                         ['employee', 'product', 'date', 'value'])
+        self.assertEqual(arrow.num_rows, 1)
+
+
+class LeanTest(SalesTestCase):
+    def test_markup(self):
+        lean = self.table(editable=True, lean=True).render()
+        self.assertNotIn(u'table_cell_', lean)
+        self.assertIn(u'<tr class="editable" data-row="0"><th rowspan="2">'
+                      u'E0 L</th><th>P0</th><td>5</td><td></td><td></td></tr>',
+                      lean)
+        self.assertIn(u'<col span="3" class="editable">', lean)
+        self.assertTrue(len(lean) < len(self.table(editable=True).render()))
+
+    def test_save(self):
+        table = self.table(editable=True, lean=True)
+        self.assertIn(u'dimtable.LeanTable(', table.render_js())
+        table.save(self.post(table, {0: '6'}))
+        self.assertEqual(DailySale.objects.get().amount, 6)
+
+
+class ETagTest(SalesTestCase):
+    def etag(self, **kwargs):
+        model = Model(DailySale.objects.all())
+        return django_dimtable.table_etag(
+            model, Dim([model.cellitem('amount')]),
+            [Dim(model.valueitems('employee', self.employees, **kwargs))],
+            [Dim(model.valueitems('date', self.dates))])
+
+    def test_changes(self):
+        with self.assertNumQueries(1):
+            etag = self.etag()
+        self.assertEqual(self.etag(), etag)
+        # updated in place, without changing count or max pk
+        DailySale.objects.filter(pk=self.sale.pk).update(amount=6)
+        self.assertNotEqual(self.etag(), etag)
+        # rows outside the table's dimensions don't change it
+        etag = self.etag()
+        DailySale.objects.create(date=D0 + datetime.timedelta(9), 
+                                 employee=self.employees[0],
+                                 product=self.products[0], amount=1)
+        self.assertEqual(self.etag(), etag)
+
+    def test_lambda_renderers_need_key(self):
+        from django.core.exceptions import ImproperlyConfigured
+        self.assertRaises(ImproperlyConfigured, self.etag, 
+                          renderer=lambda e: e.last_name)
+
+    def test_not_modified(self):
+        from django.test import RequestFactory
+        from django.http import HttpResponse
+        etag = self.etag()
+        factory = RequestFactory()
+        rendered = []
+        def make_response():
+            rendered.append(True)
+            return HttpResponse('table')
+
+        response = django_dimtable.etag_response(factory.get('/'), etag,
+                                                 make_response)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], '"%s"' % etag)
+
+        request = factory.get('/', HTTP_IF_NONE_MATCH='W/"x", "%s"' % etag)
+        response = django_dimtable.etag_response(request, etag, make_response)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(rendered), 1)
+
+        request = factory.post('/', HTTP_IF_NONE_MATCH='"%s"' % etag)
+        response = django_dimtable.etag_response(request, etag, make_response)
+        self.assertEqual(response.status_code, 200)
+
+
+class WriteBehindTest(SalesTestCase):
+    def setUp(self):
+        SalesTestCase.setUp(self)
+        import tempfile, shutil
+        from dimtable import writebehind
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.queue = writebehind.SaveQueue(path + '/queue.db')
+
+    def edit(self, values, queue=None):
+        table = self.table(editable=True, write_behind=queue or self.queue)
+        table.save(self.post(table, values))
+        return table
+
+    def test_flush(self):
+        self.edit({0: '6', 1: '2'})
+        self.assertEqual(DailySale.objects.get().amount, 5)
+        self.assertIn(u'>6</td>', self.table(write_behind=self.queue).render())
+        self.assertEqual(self.queue.flush(), 2)
+        e0, p0 = self.employees[0], self.products[0]
+        self.assertEqual(self.amounts(), [(e0.pk, p0.pk, self.dates[0], 6),
+                                          (e0.pk, p0.pk, self.dates[1], 2)])
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.dead_letters(), [])
+
+    def test_conflict(self):
+        self.edit({0: '6', 1: '2'})
+        DailySale.objects.filter(pk=self.sale.pk).update(amount=9)
+        self.queue.flush()
+        self.assertEqual(DailySale.objects.get(pk=self.sale.pk).amount, 9)
+        dead, = self.queue.dead_letters()
+        self.assertTrue(dead['error'].startswith('Conflict'))
+        # the other row is still written
+        self.assertEqual(DailySale.objects.count(), 2)
+
+    def test_emptied_queued_cell(self):
+        self.edit({1: '2'})
+        self.edit({1: ''})
+        self.queue.flush()
+        self.assertEqual(DailySale.objects.count(), 1)
+        self.assertEqual(self.queue.dead_letters(), [])
+
+    def test_edit_during_flush(self):
+        self.edit({0: '6'})
+        apply = self.queue._apply
+        def edit_and_apply(entries):
+            self.edit({0: '7'})
+            return apply(entries)
+        self.queue._apply = edit_and_apply
+        self.assertEqual(self.queue.flush(), 1)
+        del self.queue._apply
+        self.assertEqual(DailySale.objects.get().amount, 6)
+        self.assertEqual(self.queue.flush(), 1)
+        self.assertEqual(DailySale.objects.get().amount, 7)
+        self.assertEqual(self.queue.dead_letters(), [])
+
+    def test_rows_are_claimed(self):
+        from dimtable import writebehind
+        other = writebehind.SaveQueue(self.queue.path)
+        self.edit({0: '6', 4: '1'})
+        apply = self.queue._apply
+        flushed = []
+        def flush_other(entries):
+            flushed.append(other.flush())
+            return apply(entries)
+        self.queue._apply = flush_other
+        self.assertEqual(self.queue.flush(batch_size=1), 1)
+        self.assertEqual(flushed, [1]) # the row of the other cell
+        self.assertEqual(DailySale.objects.count(), 2)
+
+    def test_failed_flush_releases_rows(self):
+        self.edit({0: '6'})
+        def fail(entries):
+            self.edit({0: '7'})
+            raise RuntimeError("database went away")
+        self.queue._apply = fail
+        self.assertRaises(RuntimeError, self.queue.flush)
+        del self.queue._apply
+        self.assertEqual(len(self.queue), 1)
+        self.queue.flush()
+        # the write replaced the unapplied one and kept its expected value
+        self.assertEqual(DailySale.objects.get().amount, 7)
+        self.assertEqual(self.queue.dead_letters(), [])
+
+
+class JournalTest(SalesTestCase):
+    def edit(self, values):
+        table = self.table(editable=True, journal='sales')
+        table.save(self.post(table, values))
+        return table
+
+    def test_changes(self):
+        from dimtable import journal
+        self.edit({0: '6', 1: '2'})
+        self.edit({0: ''})
+        changes = journal.changes_since('sales')
+        self.assertEqual([change[1:] for change in changes],
+                         [(0, u'5', u'6'), (1, None, u'2'), (0, u'6', None)])
+        seqs = [change[0] for change in changes]
+        self.assertEqual(seqs, sorted(seqs))
+        self.assertEqual(journal.changes_since('sales', seqs[0], limit=1),
+                         changes[1:2])
+        self.assertEqual(journal.changes_since('other'), [])
+
+    def test_invalid_cells_are_not_recorded(self):
+        from dimtable import journal
+        table = self.edit({0: '6', 1: 'x'})
+        self.assertEqual(len(table.presenter.cell_errors), 1)
+        changes = journal.changes_since('sales')
+        self.assertEqual([change[1:] for change in changes], [(0, u'5', u'6')])
+        self.assertEqual(journal.last_seq('sales'), changes[0][0])
+
+    def test_changes_response(self):
+        from django.test import RequestFactory
+        self.edit({0: '6'})
+        seq, = [change[0] for change in 
+                self.table(journal='sales').data.changes_since(0)]
+        factory = RequestFactory()
+        response = django_dimtable.changes_response(factory.get('/'), 'sales')
+        self.assertEqual(json.loads(response.content),
+                         {'seq': seq, 'changes': [[seq, 0, u'5', u'6']]})
+        response = django_dimtable.changes_response(
+            factory.get('/', {'since': seq}), 'sales')
+        self.assertEqual(json.loads(response.content), 
+                         {'seq': seq, 'changes': []})
+
+
+class UpsertTest(SalesTestCase):
+    def setUp(self):
+        SalesTestCase.setUp(self)
+        e1, p1 = self.employees[1], self.products[1]
+        self.other = DailySale.objects.create(date=self.dates[2], employee=e1,
+                                              product=p1, amount=3)
+
+    def upsert(self, values, native=True):
+        table = self.table(editable=True, upsert=True, journal='sales')
+        # a row of the table that someone else added after it was loaded
+        DailySale.objects.create(date=self.dates[1], 
+                                 employee=self.employees[0],
+                                 product=self.products[0], amount=1)
+        table.data.native_upsert = lambda: native
+        ok = table.save(self.post(table, values))
+        return table, ok
+
+    def test_new_and_existing_rows(self):
+        table, ok = self.upsert({0: '6', 1: '7', 4: '2'})
+        self.assertTrue(ok)
+        e0, e1 = self.employees
+        p0, p1 = self.products
+        self.assertEqual(self.amounts(), [(e0.pk, p0.pk, self.dates[0], 6),
+                                          (e0.pk, p0.pk, self.dates[1], 7),
+                                          (e0.pk, p1.pk, self.dates[1], 2),
+                                          (e1.pk, p1.pk, self.dates[2], 3)])
+        stored = dict(((s.employee_id, s.product_id, s.date), s.pk)
+                      for s in DailySale.objects.all())
+        for cix, inst in table.data.instdict.iteritems():
+            self.assertEqual(inst.pk, stored[(inst.employee_id, 
+                                              inst.product_id, inst.date)])
+        self.assertEqual(len(table.data.changes_since(0)), 3)
+
+    def test_one_statement(self):
+        table = self.table(editable=True, upsert=True)
+        data = table.data
+        inputs = {}
+        for cellint, value in [(0, 6), (1, 7), (4, 2)]:
+            cellix = table.indexer.int_to_cellindex(cellint)
+            inputs[data.valuerange_cellindex(cellix)] = {cellix: value}
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        with CaptureQueriesContext(connection) as queries:
+            data.upsert(inputs)
+        writes = [q['sql'] for q in queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(len(writes), 2) # the upsert, pks of new rows
+        self.assertIn('ON CONFLICT', writes[0])
+
+    def test_fallback(self):
+        # a row of the table inserted meanwhile makes the insert fail
+        table, ok = self.upsert({0: '6', 1: '7'}, native=False)
+        self.assertFalse(ok)
+        self.assertEqual(len(table.presenter.other_errors), 1)
+        self.assertEqual(DailySale.objects.get(pk=self.sale.pk).amount, 5)
+
+    def test_fallback_new_and_existing_rows(self):
+        table = self.table(editable=True, upsert=True)
+        table.data.native_upsert = lambda: False
+        self.assertTrue(table.save(self.post(table, {0: '6', 4: '2', 
+                                                     11: '4'})))
+        e0, e1 = self.employees
+        p0, p1 = self.products
+        self.assertEqual(self.amounts(), [(e0.pk, p0.pk, self.dates[0], 6),
+                                          (e0.pk, p1.pk, self.dates[1], 2),
+                                          (e1.pk, p1.pk, self.dates[2], 4)])
+
+
+class DedupeMigrationTest(TransactionTestCase):
+    def test_duplicates_are_dropped(self):
+        from django.core.management import call_command
+        call_command('migrate', 'ex1', '0001', verbosity=0)
+        try:
+            employee = Employee.objects.create(first_name=u'E', last_name=u'L')
+            product = Product.objects.create(name=u'P')
+            for amount in (1, 2, 3):
+                last = DailySale.objects.create(date=D0, employee=employee,
+                                                product=product, 
+                                                amount=amount)
+            DailySale.objects.create(date=D0, employee=employee, 
+                                     product=Product.objects.create(name=u'Q'),
+                                     amount=4)
+        finally:
+            call_command('migrate', 'ex1', verbosity=0)
+        self.assertEqual(sorted(DailySale.objects.values_list('amount', 
+                                                              flat=True)),
+                         [3, 4])
+        self.assertEqual(DailySale.objects.get(product=product).pk, last.pk)
+
+
+class ConstraintTest(SalesTestCase):
+    def save(self, values, constraints, **kwargs):
+        table = self.table(editable=True, constraints=constraints, **kwargs)
+        return table, table.save(self.post(table, values))
+
+    def at_most(self, limit):
+        return modeltable.row_constraint(lambda values: sum(values) <= limit,
+                                         u"Over %d" % limit)
+
+    def test_stored_values_count(self):
+        table, ok = self.save({1: '6'}, [self.at_most(10)])
+        self.assertFalse(ok)
+        self.assertEqual(table.presenter.cell_errors.keys(), 
+                         [table.indexer.int_to_cellindex(1)])
+        self.assertIn(u'Over 10', table.render())
+        self.assertEqual(DailySale.objects.count(), 1)
+
+    def test_posted_values_replace_stored(self):
+        table, ok = self.save({0: '1', 1: '9'}, [self.at_most(10)])
+        self.assertTrue(ok)
+        self.assertEqual(sorted(DailySale.objects.values_list('amount', 
+                                                              flat=True)),
+                         [1, 9])
+
+    def test_all_or_nothing(self):
+        # a violation in one row saves none of the posted cells
+        table, ok = self.save({3: '2', 6: '11'}, [self.at_most(10)])
+        self.assertFalse(ok)
+        self.assertEqual(len(table.presenter.cell_errors), 1)
+        self.assertEqual(DailySale.objects.count(), 1)
+
+    def test_groups(self):
+        # the sales of an employee on a day, over products
+        per_day = modeltable.Constraint(lambda values: sum(values) <= 6, 
+                                        u"Over 6 a day", rows=[0], cols=[0])
+        table, ok = self.save({3: '2', 4: '6'}, [per_day])
+        self.assertFalse(ok) # 5 + 2 on the first day
+        self.assertEqual(table.presenter.cell_errors.keys(),
+                         [table.indexer.int_to_cellindex(3)])
+        table, ok = self.save({3: '1', 4: '6'}, [per_day])
+        self.assertTrue(ok)
+
+    def test_invalid_values_are_left_out(self):
+        table, ok = self.save({1: 'x', 2: '6'}, [self.at_most(10)])
+        self.assertFalse(ok)
+        self.assertEqual(len(table.presenter.cell_errors), 2)
+
+    def test_upsert(self):
+        table, ok = self.save({1: '6'}, [self.at_most(10)], upsert=True)
+        self.assertFalse(ok)
+        self.assertEqual(DailySale.objects.count(), 1)
@@ -1,8 +1,7 @@
 import datetime
 
-from django.shortcuts import render_to_response
+from django.shortcuts import render
 from django.db.models import Q, Sum, Avg, Count
-from django.template  import RequestContext
 from django.http      import (HttpResponse, HttpResponseRedirect,
                               HttpResponseBadRequest, Http404)
 
@@ -39,7 +38,6 @@ def edit_sales(request):
             return HttpResponseRedirect('')
 
 
-    return render_to_response('edit_sales_view.html', locals(), 
-                              context_instance=RequestContext(request))
+    return render(request, 'edit_sales_view.html', locals())
 
 
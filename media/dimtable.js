@@ -63,8 +63,8 @@ var dimtable = function() {
     };
     
     var EditableTable = function(args) {
-        // TODO(teemu): doesn't support table prefix yet, but assumes 
-        //              that prefix is always 'table'            
+        var prefix = args.prefix || 'table';
+        var cell_prefix = prefix + '_cell_';
 
         var create_input = undefined 
         if ("create_input" in args) {
@@ -76,25 +76,26 @@ var dimtable = function() {
         }
 
 
-        var rdimN = $('input[name=table_rdim_dimN]').val();
-        var cdimN = $('input[name=table_cdim_dimN]').val();
+        var rdimN = $('input[name=' + prefix + '_rdim_dimN]').val();
+        var cdimN = $('input[name=' + prefix + '_cdim_dimN]').val();
         var rdim_lengths = [];
         var cdim_lengths = [];
 
         for (i=0; i<rdimN; i++) {
-            var v = $('input[name=table_rdim_length_' + i + ']').val();
+            var v = $('input[name=' + prefix + '_rdim_length_' + i + ']').val();
             rdim_lengths[i] = parseInt(v);
         }
 
         for (i=0; i<cdimN; i++) {
-            var v = $('input[name=table_cdim_length_' + i + ']').val();
+            var v = $('input[name=' + prefix + '_cdim_length_' + i + ']').val();
             cdim_lengths[i] = parseInt(v);
         }
         
         var make_editable = function() {
             if ($(this).hasClass('edit')) return;
             
-            var val = $(this).html();
+            // text() unescapes the HTML-escaped cell content
+            var val = $(this).text();
             var name = $(this).attr('id');
           
             var input = create_input(val, name).addClass('detect-keys');
@@ -113,7 +114,7 @@ var dimtable = function() {
             var backwards = e.shiftKey;
 
             var cellid = $(this).attr('name');
-            var ix = parseInt(cellid.slice(11));
+            var ix = parseInt(cellid.slice(cell_prefix.length));
             var dimdata= { rdim_lengths:rdim_lengths,
                            cdim_lengths:cdim_lengths
                          };
@@ -137,7 +138,7 @@ var dimtable = function() {
                 while(true) {
                     newix = newix + delta;
                     if (0 <= newix && newix < cellcount) {
-                        var cellid = "table_cell_" + newix;
+                        var cellid = cell_prefix + newix;
                         var next = $('td[id="' + cellid + '"]');
                         if (next.hasClass('editable')) {
                             edit.call(next);   
@@ -150,8 +151,9 @@ var dimtable = function() {
             }
         }; 
 
-        $('td.editable').one('click', edit);
-        $('input.detect-keys').live('keydown', on_key_down);
+        // only cells of this table, there may be others on the page
+        $('td.editable[id^=' + cell_prefix + ']').one('click', edit);
+        $('input.detect-keys[name^=' + cell_prefix + ']').live('keydown', on_key_down);
         
         return {
             on_key_down: on_key_down,
@@ -160,10 +162,337 @@ var dimtable = function() {
         };
     };
         
+    // ----------------------------------
+    // LeanTable makes cells of a lean table (modeltable.Table with 
+    // lean=True) editable. Lean cells have no ids: the cell number is
+    // derived from data-row of the row and the position of the cell, 
+    // and a cell is editable if both its row and its col are.
+    // ----------------------------------
+    var LeanTable = function(args) {
+        var prefix = args.prefix || 'table';
+        var table = $('table.lean[data-prefix=' + prefix + ']');
+        var create_input = args.create_input || function(val, name) {
+            return $('<input type="text"/>').val(val).attr({size: 3, maxlength: 3, name: name});
+        };
+
+        var lengths = function(tag) {
+            var n = parseInt($('input[name=' + prefix + '_' + tag + '_dimN]').val());
+            var result = [];
+            for (var i = 0; i < n; i++) {
+                result.push(parseInt($('input[name=' + prefix + '_' + tag + '_length_' + i + ']').val()));
+            }
+            return result;
+        };
+        var colcount  = product(lengths('cdim'));
+        var cellcount = colcount * product(lengths('rdim'));
+
+        // editability of columns, from the spans of the colgroup
+        var col_editable = [];
+        table.find('colgroup col').slice(1).each(function() {
+            var span = parseInt($(this).attr('span') || 1);
+            for (var i = 0; i < span; i++) col_editable.push($(this).hasClass('editable'));
+        });
+
+        var cellint = function(td) {
+            var row = parseInt(td.parent().attr('data-row'));
+            return row * colcount + td.prevAll('td').length;
+        };
+
+        var cell = function(ix) {
+            var row = table.find('tr[data-row=' + intdiv(ix, colcount) + ']');
+            return row.children('td').eq(ix % colcount);
+        };
+
+        var is_editable = function(td) {
+            return (td.length > 0 && td.parent().hasClass('editable') &&
+                    col_editable[td.prevAll('td').length]);
+        };
+
+        var edit = function(td) {
+            if (!td.hasClass('edit')) {
+                var input = create_input(td.text(), prefix + '_cell_' + cellint(td));
+                td.html(input.addClass('detect-keys').data('cellint', cellint(td)));
+                td.addClass('edit');
+            }
+            td.find('input').focus();
+        };
+
+        var on_key_down = function(e) {
+            var keyCode = e.keyCode || e.which;
+            var delta = undefined;
+            if (keyCode == $.ui.keyCode.UP)    { delta = -colcount; }
+            if (keyCode == $.ui.keyCode.DOWN)  { delta = +colcount; }
+            if (keyCode == $.ui.keyCode.LEFT)  { delta = -1; }
+            if (keyCode == $.ui.keyCode.RIGHT) { delta = +1; }
+            if (keyCode == $.ui.keyCode.TAB)   { delta = e.shiftKey ? -1 : 1; }
+            if (delta == undefined) return;
+
+            e.preventDefault();
+            for (var ix = $(this).data('cellint') + delta; 
+                 0 <= ix && ix < cellcount; ix += delta) {
+                var next = cell(ix);
+                if (is_editable(next)) { edit(next); break; }
+            }
+        };
+
+        table.delegate('tr.editable > td', 'click', function() {
+            if (is_editable($(this))) edit($(this));
+        });
+        table.delegate('input.detect-keys', 'keydown', on_key_down);
+
+        return {
+            cellint: cellint,
+            edit: edit,
+            on_key_down: on_key_down
+        };
+    };
+
+    // ----------------------------------
+    // VirtualTable renders a table from the JSON payload of 
+    // modeltable.Table.render_virtual. Only the visible rows and columns 
+    // are in the DOM. Edited values are kept in hidden inputs named 
+    // <prefix>_cell_<int>, so the form posts like an EditableTable.
+    // Cells beyond the first window are fetched from args.url, if given.
+    // ----------------------------------
+    var escape = function(s) {
+        return String(s).replace(/&/g, '&amp;').replace(/</g, '&lt;')
+                        .replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+    };
+
+    var VirtualTable = function(args) {
+        var prefix       = args.prefix || 'table';
+        var row_height   = args.row_height || 22;
+        var col_width    = args.col_width || 60;
+        var header_width = args.header_width || 160;
+        var overscan     = 2;
+        var create_input = args.create_input || function(val) {
+            return $('<input type="text"/>').val(val).attr({size: 5, maxlength: 6});
+        };
+
+        var payload = $.parseJSON($('#' + prefix + '_payload').html());
+        var grid = $('#' + prefix + '_grid');
+        var form = grid.closest('form');
+
+        var lengths = function(dims) { 
+            return dims.labels.map(function(labels) { return labels.length; });
+        };
+        var dimdata = { rdim_lengths: lengths(payload.rdims),
+                        cdim_lengths: lengths(payload.cdims) };
+        var rowcount = product(dimdata.rdim_lengths);
+        var colcount = product(dimdata.cdim_lengths);
+
+        var values = {};
+        var errors = {};
+        var edited = {};
+        var add_cells = function(cells) {
+            cells.forEach(function(c) { if (!(c[0] in edited)) values[c[0]] = c[1]; });
+        };
+        add_cells(payload.cells);
+        payload.errors.forEach(function(e) { 
+            values[e[0]] = e[1]; 
+            errors[e[0]] = e[2].join('\n'); 
+            edited[e[0]] = true;
+        });
+
+        // the payload has the cells of the first window, the others are 
+        // fetched from args.url (see modeltable.Table.virtual_response) in
+        // windows of the same size when they are scrolled into view
+        var window_rows = Math.max(1, payload.window[1] - payload.window[0]);
+        var window_cols = Math.max(1, payload.window[3] - payload.window[2]);
+        var loaded = { '0,0': true };
+        var load = function(r0, r1, c0, c1) {
+            if (!args.url) return;
+            for (var wr = intdiv(r0, window_rows); wr * window_rows < r1; wr++) {
+                for (var wc = intdiv(c0, window_cols); wc * window_cols < c1; wc++) {
+                    if ((wr + ',' + wc) in loaded) continue;
+                    loaded[wr + ',' + wc] = true;
+                    $.getJSON(args.url, {
+                        rows: wr * window_rows + ':' + (wr + 1) * window_rows,
+                        cols: wc * window_cols + ':' + (wc + 1) * window_cols
+                    }, function(data) {
+                        add_cells(data.cells);
+                        // don't take the input away from a cell being edited
+                        if (view.find('td.edit').length == 0) render();
+                    });
+                }
+            }
+        };
+
+        var label = function(dims, ixes) {
+            return ixes.map(function(ix, d) { return dims.labels[d][ix]; }).join(' / ');
+        };
+        var row_label = function(r) { 
+            return label(payload.rdims, core.int_to_dimindex(r * colcount, dimdata)[0]);
+        };
+        var col_label = function(c) { 
+            return label(payload.cdims, core.int_to_dimindex(c, dimdata)[1]);
+        };
+        var is_editable = function(ix) {
+            if (!payload.editable) return false;
+            var cellix = core.int_to_dimindex(ix, dimdata);
+            return (cellix[0].every(function(r, d) { return payload.rdims.editable[d][r]; }) &&
+                    cellix[1].every(function(c, d) { return payload.cdims.editable[d][c]; }));
+        };
+
+        // posted values, one hidden input per edited cell
+        var set_value = function(ix, val) {
+            var name = prefix + '_cell_' + ix;
+            var field = form.find('input[name=' + name + ']');
+            if (field.length == 0) {
+                field = $('<input type="hidden"/>').attr('name', name).appendTo(form);
+            }
+            field.val(val);
+            values[ix] = val;
+            edited[ix] = true;
+        };
+
+        var viewport = $('<div class="viewport"/>').css({
+            position: 'relative', overflow: 'auto', height: args.height || 400
+        });
+        var spacer = $('<div/>').css({ 
+            height: (rowcount + 1) * row_height, 
+            width: header_width + colcount * col_width 
+        });
+        var view = $('<table/>').addClass(grid.attr('class')).css({
+            position: 'absolute', top: 0, left: 0
+        });
+        viewport.append(spacer).append(view);
+        grid.append(viewport);
+
+        var render = function() {
+            // keep the value of a cell being edited when it's re-rendered
+            view.find('td.edit input').each(function() {
+                commit(parseInt($(this).parent().attr('data-ix')), $(this));
+            });
+
+            var r0 = Math.max(0, intdiv(viewport.scrollTop(), row_height) - overscan);
+            var r1 = Math.min(rowcount, r0 + intdiv(viewport.height(), row_height) + 2 * overscan);
+            var c0 = Math.max(0, intdiv(viewport.scrollLeft(), col_width) - overscan);
+            var c1 = Math.min(colcount, c0 + intdiv(viewport.width(), col_width) + 2 * overscan);
+
+            var out = ['<tr><th style="width:', header_width, 'px"></th>'];
+            for (var c = c0; c < c1; c++) {
+                out.push('<th style="width:', col_width, 'px">', escape(col_label(c)), '</th>');
+            }
+            out.push('</tr>');
+            for (var r = r0; r < r1; r++) {
+                out.push('<tr style="height:', row_height, 'px"><th>', escape(row_label(r)), '</th>');
+                for (var c = c0; c < c1; c++) {
+                    var ix = r * colcount + c;
+                    var classes = [];
+                    if (is_editable(ix)) classes.push('editable');
+                    if (ix in errors) classes.push('error');
+                    out.push('<td data-ix="', ix, '" class="', classes.join(' '), '"');
+                    if (ix in errors) out.push(' title="', escape(errors[ix]), '"');
+                    out.push('>', ix in values ? escape(values[ix]) : '', '</td>');
+                }
+                out.push('</tr>');
+            }
+            view.html(out.join('')).css({ top: r0 * row_height, left: c0 * col_width });
+            load(r0, r1, c0, c1);
+        };
+
+        var scroll_to = function(ix) {
+            var top  = intdiv(ix, colcount) * row_height;
+            var left = (ix % colcount) * col_width;
+            if (top < viewport.scrollTop() || top > viewport.scrollTop() + viewport.height() - 2 * row_height) {
+                viewport.scrollTop(top);
+            }
+            if (left < viewport.scrollLeft() || left > viewport.scrollLeft() + viewport.width() - header_width - col_width) {
+                viewport.scrollLeft(left);
+            }
+        };
+
+        var edit = function(ix) {
+            scroll_to(ix);
+            render();
+            var td = view.find('td[data-ix=' + ix + ']');
+            var input = create_input(ix in values ? values[ix] : '');
+            td.addClass('edit').empty().append(input);
+            input.focus();
+            input.bind('keydown', function(e) {
+                var keyCode = e.keyCode || e.which;
+                var delta = undefined;
+                if (keyCode == $.ui.keyCode.UP)    { delta = -colcount; }
+                if (keyCode == $.ui.keyCode.DOWN)  { delta = +colcount; }
+                if (keyCode == $.ui.keyCode.TAB)   { delta = e.shiftKey ? -1 : 1; }
+                if (keyCode == $.ui.keyCode.ENTER) { delta = 0; }
+                if (delta == undefined) return;
+
+                e.preventDefault();
+                commit(ix, input);
+                var next = ix + delta;
+                while (delta != 0 && 0 <= next && next < rowcount * colcount) {
+                    if (is_editable(next)) { edit(next); return; }
+                    next += delta;
+                }
+                render();
+            });
+            input.bind('blur', function() { commit(ix, input); });
+        };
+
+        var commit = function(ix, input) {
+            var val = input.val();
+            if (val != (ix in values ? values[ix] : '')) set_value(ix, val);
+        };
+
+        viewport.scroll(render);
+        view.delegate('td.editable', 'click', function() {
+            if (!$(this).hasClass('edit')) edit(parseInt($(this).attr('data-ix')));
+        });
+        render();
+
+        return {
+            render: render,
+            edit: edit,
+            set_value: set_value
+        };
+    };
+        
+    // ----------------------------------
+    // Drilldown loads rows of collapsed groups of a 
+    // django_dimtable.DrilldownTable when a group row is clicked.
+    // args.table is the EditableTable of the page, if any.
+    // ----------------------------------
+    var Drilldown = function(args) {
+        var prefix = args.prefix || 'table';
+        var group_rows = function(group) {
+            return $('tr.group-member[data-prefix=' + prefix + '][data-group=' + group + ']');
+        };
+
+        var toggle = function() {
+            var row = $(this);
+            var group = row.attr('data-group');
+            if (row.hasClass('loading')) return;
+            if (row.hasClass('loaded')) {
+                row.toggleClass('collapsed');
+                group_rows(group).toggle();
+                return;
+            }
+
+            row.addClass('loading');
+            $.getJSON(args.url, {group: group}, function(data) {
+                var rows = $(data.rows);
+                row.after(rows).removeClass('loading collapsed').addClass('loaded');
+                $('<input type="hidden"/>')
+                    .attr('name', prefix + '_instanceids_' + group)
+                    .val(data.instanceids)
+                    .appendTo(row.closest('form'));
+                if (args.table) rows.find('td.editable').one('click', args.table.edit);
+            });
+        };
+
+        $('tr.group[data-prefix=' + prefix + ']').live('click', toggle);
+        return { toggle: toggle };
+    };
+
     // Public
     return {
         core: core,
         EditableTable: EditableTable,
+        LeanTable: LeanTable,
+        VirtualTable: VirtualTable,
+        Drilldown: Drilldown,
 
         // TODO(teemu): temporarily expose these for debugging,
         //              should be moved somewhere else